@@ -5,6 +5,34 @@ from hotel.models import Hotel
 from django.contrib import admin
 from django.apps import apps
 
+from hotel.deadletters import dead_letter_stats
+from hotel.models import DeadLetter
+
+
+@admin.register(DeadLetter)
+class DeadLetterAdmin(admin.ModelAdmin):
+    """
+    Lists the dead letters with their counts per hotel above the list.
+    """
+
+    change_list_template = "admin/hotel/deadletter/change_list.html"
+    list_display = ["pms_reservation_id", "hotel", "attempts", "error", "last_failed_at", "retry_at"]
+    list_filter = ["hotel", "attempts"]
+    search_fields = ["pms_reservation_id", "error"]
+    list_select_related = ["hotel"]
+
+    def changelist_view(self, request, extra_context=None):
+        stats = list(dead_letter_stats())
+        extra_context = {
+            **(extra_context or {}),
+            "dead_letter_stats": stats,
+            "dead_letter_totals": {
+                key: sum(row[key] for row in stats) for key in ("total", "due", "exhausted")
+            },
+        }
+        return super().changelist_view(request, extra_context=extra_context)
+
+
 # Dynamically register all models
 app = apps.get_app_config("hotel")
 
@@ -0,0 +1,371 @@
+import asyncio
+import contextlib
+import copy
+import datetime
+import importlib
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from unittest import mock
+
+from hotel import external_api
+from hotel.external_api import APIError
+
+"""
+Synthetic data and a configurable stand-in for hotel.external_api, for the benchmark management commands.
+The stand-in draws errors and latencies from a seeded RNG, so a run can be repeated exactly. Latencies follow
+a latency model: fixed, uniform, lognormal, or a histogram of latencies that were recorded from the API.
+Responses are synthesized, or replayed from a fixture archive that `RecordingExternalAPI` recorded.
+"""
+
+
+def make_catalog(samples: list, size: int) -> list:
+    """
+    Returns a catalog of `size` upsell products, copies of the samples with unique ids.
+    """
+    catalog = []
+    for index in range(size):
+        product = copy.deepcopy(samples[index % len(samples)])
+        product["id"] = f"{product['id']}-{index}"
+        catalog.append(product)
+    return catalog
+
+
+def make_webhook_payload(pms_hotel_id: str, events: int, rng: Optional[random.Random] = None) -> str:
+    """
+    Returns a webhook payload shaped like hotel/tests/api_fixtures/webhook_payload.json
+    with the given number of ReservationUpdated events.
+    """
+    rng = rng or random.Random()
+    return json.dumps(
+        {
+            "HotelId": pms_hotel_id,
+            "IntegrationId": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            "Events": [
+                {
+                    "Name": "ReservationUpdated",
+                    "Value": {"ReservationId": str(uuid.UUID(int=rng.getrandbits(128), version=4))},
+                }
+                for _ in range(events)
+            ],
+        }
+    )
+
+
+class LatencyModel:
+    """
+    Draws the latency of a single PMS API call, in seconds.
+    """
+
+    def sample(self, rng: random.Random) -> float:
+        raise NotImplementedError("Subclasses must implement this method")
+
+
+class FixedLatency(LatencyModel):
+    def __init__(self, seconds: float) -> None:
+        self.seconds = seconds
+
+    def sample(self, rng: random.Random) -> float:
+        return self.seconds
+
+
+class UniformLatency(LatencyModel):
+    def __init__(self, low: float, high: float) -> None:
+        self.low = low
+        self.high = high
+
+    def sample(self, rng: random.Random) -> float:
+        return rng.uniform(self.low, self.high)
+
+
+class LognormalLatency(LatencyModel):
+    """
+    Lognormal latencies around a median, the long tail that real APIs have. A sigma of 0.5 puts the p99
+    at about three times the median.
+    """
+
+    def __init__(self, median: float, sigma: float) -> None:
+        self.median = median
+        self.sigma = sigma
+
+    def sample(self, rng: random.Random) -> float:
+        return rng.lognormvariate(math.log(self.median), self.sigma) if self.median else 0.0
+
+
+class HistogramLatency(LatencyModel):
+    """
+    Latencies drawn from recorded samples: a sample is picked at random, so the distribution of the
+    recording is reproduced, tail included.
+    """
+
+    def __init__(self, samples: List[float]) -> None:
+        if not samples:
+            raise ValueError("A latency histogram needs at least one sample.")
+        self.samples = sorted(samples)
+
+    def sample(self, rng: random.Random) -> float:
+        return self.samples[rng.randrange(len(self.samples))]
+
+
+def parse_latency(spec: str) -> LatencyModel:
+    """
+    Parses a latency model from the command line, with times in milliseconds:
+    "fixed:20", "uniform:10,30", "lognormal:20,0.5" (median and sigma) or "histogram:<fixture archive>".
+    """
+    kind, _, arguments = spec.partition(":")
+    try:
+        if kind == "histogram":
+            return HistogramLatency(FixtureArchive.load(arguments).latencies)
+        values = [float(value) for value in arguments.split(",")]
+        if kind == "fixed":
+            (milliseconds,) = values
+            return FixedLatency(milliseconds / 1000)
+        if kind == "uniform":
+            low, high = values
+            return UniformLatency(low / 1000, high / 1000)
+        if kind == "lognormal":
+            median, sigma = values
+            return LognormalLatency(median / 1000, sigma)
+    except (ValueError, OSError) as e:
+        raise ValueError(f"Invalid latency {spec!r}: {e}") from e
+    raise ValueError(f"Unknown latency model {kind!r}, use fixed, uniform, lognormal or histogram.")
+
+
+class FixtureArchive:
+    """
+    Recorded responses of PMS API calls by function name and arguments, and the recorded latencies,
+    stored as a JSON file. A failed call is recorded with its error and replayed as an APIError.
+    """
+
+    def __init__(self, responses: Optional[Dict[str, dict]] = None, latencies: Optional[List[float]] = None) -> None:
+        self.responses = responses or {}
+        self.latencies = latencies or []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str) -> "FixtureArchive":
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data["responses"], data["latencies"])
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump({"responses": self.responses, "latencies": self.latencies}, f, indent=1, sort_keys=True)
+
+    @staticmethod
+    def key(name: str, args: Tuple) -> str:
+        return f"{name}:{json.dumps(args)}"
+
+    def record(self, name: str, args: Tuple, latency: float, response: Any = None, error: str = None) -> None:
+        """
+        Records a call. An error does not replace a response that was recorded for the same call before.
+        """
+        key = self.key(name, args)
+        with self._lock:
+            if error is None:
+                self.responses[key] = {"response": response}
+            else:
+                self.responses.setdefault(key, {"error": error})
+            self.latencies.append(latency)
+
+    def replay(self, name: str, args: Tuple) -> Any:
+        """
+        Returns the recorded response, raises the recorded APIError, or KeyError if the call was not recorded.
+        """
+        entry = self.responses[self.key(name, args)]
+        if "error" in entry:
+            raise APIError(entry["error"])
+        return entry["response"]
+
+    def reservations(self) -> List[dict]:
+        """
+        Returns the recorded reservation details, to build webhooks for the recorded reservations.
+        """
+        prefix = "get_reservation_details:"
+        return [
+            json.loads(entry["response"])
+            for key, entry in self.responses.items()
+            if key.startswith(prefix) and "response" in entry
+        ]
+
+
+class RecordingExternalAPI:
+    """
+    Wraps the functions of hotel.external_api and records every response, error and latency in an archive.
+    """
+
+    FUNCTIONS = (
+        "get_reservations_for_given_checkin_date",
+        "get_reservation_details",
+        "get_guest_details",
+        "get_apaleo_upsell_products",
+        "get_guest_line_upsell_product",
+    )
+
+    def __init__(self, archive: FixtureArchive, api=external_api) -> None:
+        self.archive = archive
+        self.api = api
+
+    def __getattr__(self, name: str) -> Callable:
+        if name not in self.FUNCTIONS:
+            raise AttributeError(name)
+        func = getattr(self.api, name)
+
+        def record(*args):
+            started = time.perf_counter()
+            try:
+                response = func(*args)
+            except APIError as e:
+                self.archive.record(name, args, time.perf_counter() - started, error=str(e))
+                raise
+            self.archive.record(name, args, time.perf_counter() - started, response=response)
+            return response
+
+        return record
+
+
+class StubExternalAPI:
+    """
+    Stand-in for the reservation, guest and upsell calls of hotel.external_api, sync and async. Every call waits
+    for a latency drawn from the latency model and fails with probability error_rate.
+    The draws of a call are seeded with the seed, the call and how often it was made before, so a run gives
+    the same results whatever order concurrent calls are made in.
+    Responses are replayed from the archive when one is given. Otherwise they are synthesized, and
+    reservations belong to the hotel of the payload they were registered from. Synthesized upsell catalogs
+    have catalog_size products, or the products of hotel.external_api.
+    """
+
+    def __init__(
+        self,
+        latency: Optional[LatencyModel] = None,
+        error_rate: float = 0.0,
+        seed: Optional[int] = None,
+        archive: Optional[FixtureArchive] = None,
+        catalog_size: Optional[int] = None,
+    ) -> None:
+        self.latency = latency or FixedLatency(0.0)
+        self.catalog_size = catalog_size
+        self.error_rate = error_rate
+        self.seed = random.getrandbits(64) if seed is None else seed
+        self.archive = archive
+        self.calls = 0
+        self._calls_by_key: Dict[str, int] = {}
+        self._hotels: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def register_payload(self, payload: str) -> None:
+        payload_json = json.loads(payload)
+        for event in payload_json["Events"]:
+            self._hotels[event["Value"]["ReservationId"]] = payload_json["HotelId"]
+
+    def get_reservation_details(self, reservation_id: str) -> str:
+        self._call("get_reservation_details", (reservation_id,))
+        return self._reservation_details(reservation_id)
+
+    async def aget_reservation_details(self, reservation_id: str) -> str:
+        await self._acall("get_reservation_details", (reservation_id,))
+        return self._reservation_details(reservation_id)
+
+    def _reservation_details(self, reservation_id: str) -> str:
+        if self.archive:
+            return self.archive.replay("get_reservation_details", (reservation_id,))
+        today = datetime.date.today()
+        return json.dumps(
+            {
+                "HotelId": self._hotels.get(reservation_id),
+                "ReservationId": reservation_id,
+                "GuestId": str(uuid.uuid5(uuid.NAMESPACE_OID, reservation_id)),
+                "Status": "booked",
+                "CheckInDate": today.strftime("%Y-%m-%d"),
+                "CheckOutDate": (today + datetime.timedelta(days=2)).strftime("%Y-%m-%d"),
+                "BreakfastIncluded": False,
+                "RoomNumber": 1,
+            }
+        )
+
+    def get_guest_details(self, guest_id: str) -> str:
+        self._call("get_guest_details", (guest_id,))
+        return self._guest_details(guest_id)
+
+    async def aget_guest_details(self, guest_id: str) -> str:
+        await self._acall("get_guest_details", (guest_id,))
+        return self._guest_details(guest_id)
+
+    def _guest_details(self, guest_id: str) -> str:
+        if self.archive:
+            return self.archive.replay("get_guest_details", (guest_id,))
+        return json.dumps(
+            {
+                "GuestId": guest_id,
+                "Name": "Bench Guest",
+                "Phone": f"+3162{uuid.UUID(guest_id).int % 10 ** 7:07d}",
+                "Country": "NL",
+            }
+        )
+
+    def get_apaleo_upsell_products(self) -> dict:
+        self._call("get_apaleo_upsell_products", ())
+        return self._upsell_products("get_apaleo_upsell_products", "services")
+
+    async def aget_apaleo_upsell_products(self) -> dict:
+        await self._acall("get_apaleo_upsell_products", ())
+        return self._upsell_products("get_apaleo_upsell_products", "services")
+
+    def get_guest_line_upsell_product(self) -> dict:
+        self._call("get_guest_line_upsell_product", ())
+        return self._upsell_products("get_guest_line_upsell_product", "products")
+
+    async def aget_guest_line_upsell_product(self) -> dict:
+        await self._acall("get_guest_line_upsell_product", ())
+        return self._upsell_products("get_guest_line_upsell_product", "products")
+
+    def _upsell_products(self, name: str, key: str) -> dict:
+        if self.archive:
+            return self.archive.replay(name, ())
+        products = getattr(external_api, name)()
+        if self.catalog_size is not None:
+            products[key] = make_catalog(products[key], self.catalog_size)
+        return products
+
+    def patch(self, *modules: str) -> contextlib.ExitStack:
+        """
+        Returns a context manager that replaces the sync and async API functions that the given PMS modules
+        (the Apaleo module by default) imported with this stand-in, and seeds the backoff jitter of the retries.
+        """
+        stack = contextlib.ExitStack()
+        for module in modules or ("hotel.pms.apaleo.apaleo",):
+            imported = importlib.import_module(module)
+            for name in RecordingExternalAPI.FUNCTIONS:
+                for patched in (name, f"a{name}"):
+                    if hasattr(self, patched) and hasattr(imported, patched):
+                        stack.enter_context(mock.patch(f"{module}.{patched}", getattr(self, patched)))
+        stack.enter_context(mock.patch("hotel.pms.resilience.jitter", random.Random(f"{self.seed}:jitter")))
+        return stack
+
+    def _call(self, name: str, args: Tuple) -> None:
+        failed, delay = self._draw(name, args)
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise APIError("The API is temporarily not available. Please try again.")
+
+    async def _acall(self, name: str, args: Tuple) -> None:
+        failed, delay = self._draw(name, args)
+        await asyncio.sleep(delay)
+        if failed:
+            raise APIError("The API is temporarily not available. Please try again.")
+
+    def _draw(self, name: str, args: Tuple) -> Tuple[bool, float]:
+        """
+        Returns whether the call fails, and its latency.
+        """
+        key = FixtureArchive.key(name, args)
+        with self._lock:
+            self.calls += 1
+            self._calls_by_key[key] = count = self._calls_by_key.get(key, 0) + 1
+        rng = random.Random(f"{self.seed}:{key}:{count}")
+        return rng.random() < self.error_rate, self.latency.sample(rng)
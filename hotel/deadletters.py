@@ -0,0 +1,156 @@
+import logging
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Count, Max, Q
+from django.utils import timezone
+
+from hotel.models import DeadLetter
+from hotel.pms.base import CleanedWebhookPayload, WebhookResult, gather_bounded
+from hotel.pms.cache import hotel_cache
+from hotel.pms.resilience import Deadline
+
+"""
+Dead-letter store for reservations that failed on a PMS API error.
+The webhook worker records them with `record_dead_letters`, the `replay_dead_letters` management command
+replays the due ones in bounded batches per hotel, several batches at a time, with `areplay_dead_letters`.
+"""
+
+logger = logging.getLogger(__name__)
+
+# A batch of dead letters: the hotel id and the attempts so far by reservation id.
+_ReplayBatch = Tuple[int, Dict[str, int]]
+
+
+def retry_delay(attempts: int) -> timedelta:
+    """
+    Exponential backoff after the given number of failed attempts.
+    """
+    seconds = settings.DEAD_LETTER_RETRY_BASE_DELAY * 2 ** (attempts - 1)
+    return timedelta(seconds=min(settings.DEAD_LETTER_RETRY_MAX_DELAY, seconds))
+
+
+def record_dead_letters(hotel_id: int, errors: Dict[str, str]) -> None:
+    """
+    Stores failed reservations with their error, or counts another failed attempt of the ones that are stored.
+    """
+    if not errors:
+        return
+    attempts = dict(
+        DeadLetter.objects.filter(hotel_id=hotel_id, pms_reservation_id__in=errors).values_list(
+            "pms_reservation_id", "attempts"
+        )
+    )
+    now = timezone.now()
+    dead_letters = []
+    for reservation_id, error in errors.items():
+        count = attempts.get(reservation_id, 0) + 1
+        dead_letters.append(
+            DeadLetter(
+                hotel_id=hotel_id,
+                pms_reservation_id=reservation_id,
+                error=error,
+                attempts=count,
+                retry_at=now + retry_delay(count),
+            )
+        )
+    DeadLetter.objects.bulk_create(
+        dead_letters,
+        update_conflicts=True,
+        unique_fields=["hotel", "pms_reservation_id"],
+        update_fields=["error", "attempts", "last_failed_at", "retry_at"],
+    )
+    logger.warning(f"Recorded {len(dead_letters)} dead letters for hotel {hotel_id}.")
+
+
+def claim_dead_letters(limit: int) -> List[_ReplayBatch]:
+    """
+    Claims up to `limit` due dead letters that did not reach DEAD_LETTER_MAX_ATTEMPTS, in batches of at most
+    DEAD_LETTER_REPLAY_BATCH_SIZE reservations of one hotel. Claimed dead letters are not due again
+    until DEAD_LETTER_CLAIM_TIMEOUT has passed, so two replays do not replay the same reservations.
+    """
+    now = timezone.now()
+    due = Q(retry_at__lte=now, attempts__lt=settings.DEAD_LETTER_MAX_ATTEMPTS)
+    rows = list(
+        DeadLetter.objects.filter(due)
+        .order_by("retry_at", "id")
+        .values_list("id", "hotel_id", "pms_reservation_id", "attempts")[:limit]
+    )
+    if not rows:
+        return []
+    # A reservation that two replays claim at the same time is fetched twice, which is harmless.
+    DeadLetter.objects.filter(id__in=[row[0] for row in rows]).update(
+        retry_at=now + timedelta(seconds=settings.DEAD_LETTER_CLAIM_TIMEOUT)
+    )
+
+    by_hotel: Dict[int, Dict[str, int]] = {}
+    for _, hotel_id, reservation_id, attempts in rows:
+        by_hotel.setdefault(hotel_id, {})[reservation_id] = attempts
+    batch_size = settings.DEAD_LETTER_REPLAY_BATCH_SIZE
+    batches = []
+    for hotel_id, attempts in by_hotel.items():
+        reservation_ids = list(attempts)
+        for start in range(0, len(reservation_ids), batch_size):
+            batches.append((hotel_id, {rid: attempts[rid] for rid in reservation_ids[start:start + batch_size]}))
+    return batches
+
+
+async def areplay_dead_letters(limit: int, concurrency: Optional[int] = None) -> Dict[str, int]:
+    """
+    Claims up to `limit` due dead letters and replays their batches concurrently, at most `concurrency`
+    (DEAD_LETTER_REPLAY_CONCURRENCY by default) at a time. Recovered reservations are removed from the store,
+    the others are kept with their new error and a longer backoff.
+    Returns the number of replayed, recovered and failed reservations.
+    """
+    batches = await sync_to_async(claim_dead_letters)(limit)
+    results = await gather_bounded(concurrency or settings.DEAD_LETTER_REPLAY_CONCURRENCY, _areplay, batches)
+    return await sync_to_async(_record_replay)(batches, results)
+
+
+async def _areplay(batch: _ReplayBatch) -> Tuple[Optional[WebhookResult], str]:
+    hotel_id, attempts = batch
+    payload = CleanedWebhookPayload(hotel_id=hotel_id, data={"DeadLetter": list(attempts)})
+    try:
+        pms = (await sync_to_async(hotel_cache.get)(hotel_id)).get_pms()
+        return await pms.ahandle_webhook(payload, Deadline(settings.WEBHOOK_DEADLINE_SECONDS)), ""
+    except Exception as e:
+        logger.exception(f"Error replaying dead letters of hotel {hotel_id}")
+        return None, str(e)
+
+
+def _record_replay(
+    batches: List[_ReplayBatch], results: List[Tuple[Optional[WebhookResult], str]]
+) -> Dict[str, int]:
+    replayed = recovered = 0
+    for (hotel_id, attempts), (result, error) in zip(batches, results):
+        replayed += len(attempts)
+        if result is None:
+            errors = {reservation_id: error for reservation_id in attempts}
+        else:
+            errors = {reservation_id: "The deadline passed before it was fetched." for reservation_id in result.deferred}
+            errors.update(result.errors)
+            # Reservations that failed without an API error (e.g. invalid data) are not worth replaying again.
+            done = [reservation_id for reservation_id in attempts if reservation_id not in errors]
+            DeadLetter.objects.filter(hotel_id=hotel_id, pms_reservation_id__in=done).delete()
+            recovered += len(result.processed)
+        record_dead_letters(hotel_id, errors)
+    return {"replayed": replayed, "recovered": recovered, "failed": replayed - recovered}
+
+
+def dead_letter_stats():
+    """
+    Returns the number of dead letters, of those that are due and of those that are given up, per hotel.
+    """
+    now = timezone.now()
+    return (
+        DeadLetter.objects.values("hotel_id", "hotel__name")
+        .annotate(
+            total=Count("id"),
+            due=Count("id", filter=Q(retry_at__lte=now, attempts__lt=settings.DEAD_LETTER_MAX_ATTEMPTS)),
+            exhausted=Count("id", filter=Q(attempts__gte=settings.DEAD_LETTER_MAX_ATTEMPTS)),
+            last_failed_at=Max("last_failed_at"),
+        )
+        .order_by("-total")
+    )
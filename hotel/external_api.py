@@ -1,3 +1,4 @@
+import asyncio
 import json
 import random
 import uuid
@@ -573,4 +574,25 @@ def get_guest_line_upsell_product():
       ],
       "count": 6
     }
-    return upsell_products
\ No newline at end of file
+    return upsell_products
+
+
+# Async variants of the API calls, as an async HTTP client would offer them.
+# They behave like the calls above, including the random failures. A call blocks like a request would,
+# so it runs in a worker thread rather than on the event loop.
+
+
+async def aget_reservation_details(reservation_id: str) -> str:
+    return await asyncio.to_thread(get_reservation_details, reservation_id)
+
+
+async def aget_guest_details(guest_id: str) -> str:
+    return await asyncio.to_thread(get_guest_details, guest_id)
+
+
+async def aget_apaleo_upsell_products():
+    return await asyncio.to_thread(get_apaleo_upsell_products)
+
+
+async def aget_guest_line_upsell_product():
+    return await asyncio.to_thread(get_guest_line_upsell_product)
@@ -0,0 +1,53 @@
+import re
+from typing import Callable, Optional
+
+from django.middleware.gzip import GZipMiddleware
+from django.utils.decorators import decorator_from_middleware
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_headers
+
+"""
+Conditional GETs of gzipped views.
+gzip_page weakens the ETag of the responses it compresses, since they differ from the uncompressed ones.
+Here the ETag is set after compression instead, and tells the encodings apart, so it stays strong.
+"""
+
+ACCEPTS_GZIP = re.compile(r"\bgzip\b")
+
+
+class DeterministicGZipMiddleware(GZipMiddleware):
+    # The same content always compresses to the same bytes, which a strong ETag requires. The views it is used
+    # for return no secrets, so they do not need the random bytes that mitigate BREACH.
+    max_random_bytes = 0
+
+
+deterministic_gzip_page = decorator_from_middleware(DeterministicGZipMiddleware)
+
+
+def encoded_etag(etag_func: Callable[..., Optional[str]]) -> Callable[..., Optional[str]]:
+    """
+    Returns an etag_func that gives the ETag of etag_func a "-gzip" suffix for requests that accept gzip.
+    The ETag is then the same for all responses with the same bytes, also when a small response is not compressed.
+    """
+
+    def etag(request, *args, **kwargs) -> Optional[str]:
+        value = etag_func(request, *args, **kwargs)
+        if value is None or not ACCEPTS_GZIP.search(request.META.get("HTTP_ACCEPT_ENCODING", "")):
+            return value
+        return f"{value}-gzip"
+
+    return etag
+
+
+def conditional_gzip_page(etag_func: Callable[..., Optional[str]]):
+    """
+    Decorator that gzips the responses of a view and answers conditional GETs with the ETag of etag_func,
+    like condition(etag_func=etag_func) around gzip_page, but with a strong ETag per content encoding.
+    """
+
+    def decorator(view):
+        return vary_on_headers("Accept-Encoding")(condition(etag_func=encoded_etag(etag_func))(
+            deterministic_gzip_page(view)
+        ))
+
+    return decorator
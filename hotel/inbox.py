@@ -0,0 +1,333 @@
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+from hotel.deadletters import record_dead_letters
+from hotel.models import DeferredReservation, WebhookInboxItem
+from hotel.pms.base import CleanedWebhookPayload, WebhookResult, get_pms
+from hotel.pms.cache import hotel_cache
+from hotel.pms.resilience import Deadline
+
+"""
+Durable inbox for PMS webhooks.
+The webhook view stores every call with `aenqueue_webhook` and answers right away, the
+`process_webhooks` management command drains the inbox in batches with `process_batch`
+(or `aprocess_batch`, which handles the hotels of a batch concurrently on an event loop).
+Webhooks in a batch are coalesced per hotel before they are handled.
+Reservations that could not be fetched before the deadline are kept in a deferred store and handled
+with a later batch, reservations that failed on an API error are recorded as dead letters (see hotel.deadletters).
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_webhook(pms_name: str, body: bytes, content_encoding: str = "") -> WebhookInboxItem:
+    return WebhookInboxItem.objects.create(pms_name=pms_name, body=body, content_encoding=content_encoding)
+
+
+async def aenqueue_webhook(pms_name: str, body: bytes, content_encoding: str = "") -> WebhookInboxItem:
+    return await WebhookInboxItem.objects.acreate(pms_name=pms_name, body=body, content_encoding=content_encoding)
+
+
+def claim_batch(batch_size: int) -> List[WebhookInboxItem]:
+    """
+    Claims up to batch_size pending items for this worker, oldest first.
+    New items are only claimed once they are older than WEBHOOK_COALESCE_WINDOW, so that
+    repeated updates of a reservation end up in the same batch and are fetched once.
+    Items that were claimed by a worker that never finished them are claimed again
+    once WEBHOOK_INBOX_CLAIM_TIMEOUT has passed. Every claim counts as an attempt.
+    """
+    now = timezone.now()
+    claimable = (
+        Q(status=WebhookInboxItem.Status.PENDING)
+        & Q(received_at__lte=now - timedelta(seconds=settings.WEBHOOK_COALESCE_WINDOW))
+        & (Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now))
+    ) | Q(
+        status=WebhookInboxItem.Status.PROCESSING,
+        claimed_at__lt=now - timedelta(seconds=settings.WEBHOOK_INBOX_CLAIM_TIMEOUT),
+    )
+    ids = list(
+        WebhookInboxItem.objects.filter(claimable).order_by("received_at", "id").values_list("id", flat=True)[
+            :batch_size
+        ]
+    )
+    if not ids:
+        return []
+
+    # The conditional update makes sure that two workers never claim the same item. The attempt is counted
+    # in the same update, so an item that crashes its worker is not claimed again forever.
+    token = str(uuid.uuid4())
+    WebhookInboxItem.objects.filter(claimable, id__in=ids).update(
+        status=WebhookInboxItem.Status.PROCESSING, claim_token=token, claimed_at=now, attempts=F("attempts") + 1
+    )
+    return list(WebhookInboxItem.objects.filter(claim_token=token).order_by("received_at", "id"))
+
+
+def coalesce_payloads(payloads: List[CleanedWebhookPayload]) -> List[CleanedWebhookPayload]:
+    """
+    Merges cleaned webhook payloads per hotel, so every reservation is handled once
+    per hotel, however often it was mentioned in the payloads.
+    """
+    merged: Dict[int, Dict[str, dict]] = {}
+    for payload in payloads:
+        events = merged.setdefault(payload["hotel_id"], {})
+        for name, reservation_ids in payload["data"].items():
+            events.setdefault(name, {}).update(dict.fromkeys(reservation_ids))
+    return [
+        CleanedWebhookPayload(hotel_id=hotel_id, data={name: list(ids) for name, ids in events.items()})
+        for hotel_id, events in merged.items()
+    ]
+
+
+def claim_deferred(limit: int) -> Tuple[Dict[int, Dict[str, int]], datetime]:
+    """
+    Claims up to `limit` deferred reservations that are due. They stay in the deferred store, but are not due
+    again until WEBHOOK_INBOX_CLAIM_TIMEOUT has passed, so the ones of a worker that never finished them are
+    claimed again then. Returns their number of attempts by reservation id, by hotel id, and the claim time,
+    see complete_deferred.
+    """
+    now = timezone.now()
+    due = list(
+        DeferredReservation.objects.filter(retry_at__lte=now)
+        .order_by("retry_at", "id")
+        .values_list("id", "hotel_id", "pms_reservation_id", "attempts")[:limit]
+    )
+    if not due:
+        return {}, now
+    # Two workers may claim the same reservation, which is then fetched twice, but it is never lost.
+    DeferredReservation.objects.filter(id__in=[row[0] for row in due]).update(
+        retry_at=now + timedelta(seconds=settings.WEBHOOK_INBOX_CLAIM_TIMEOUT)
+    )
+    deferred: Dict[int, Dict[str, int]] = {}
+    for _, hotel_id, reservation_id, attempts in due:
+        deferred.setdefault(hotel_id, {})[reservation_id] = attempts
+    return deferred, now
+
+
+def complete_deferred(hotel_id: int, reservation_ids: List[str], claimed_at: datetime) -> None:
+    """
+    Removes claimed deferred reservations that were handled from the deferred store, unless they were
+    deferred again since they were claimed.
+    """
+    if reservation_ids:
+        DeferredReservation.objects.filter(
+            hotel_id=hotel_id, pms_reservation_id__in=reservation_ids, deferred_at__lte=claimed_at
+        ).delete()
+
+
+def defer_reservations(hotel_id: int, attempts: Dict[str, int]) -> List[str]:
+    """
+    Stores reservations in the deferred store, with the number of times they were deferred.
+    Reservations that reached WEBHOOK_INBOX_MAX_ATTEMPTS are given up.
+    Returns the ids of the reservations that were stored.
+    """
+    now = timezone.now()
+    deferred = []
+    for reservation_id, count in attempts.items():
+        if count > settings.WEBHOOK_INBOX_MAX_ATTEMPTS:
+            logger.error(f"Giving up reservation {reservation_id} of hotel {hotel_id} after {count - 1} attempts.")
+            continue
+        deferred.append(
+            DeferredReservation(
+                hotel_id=hotel_id,
+                pms_reservation_id=reservation_id,
+                attempts=count,
+                retry_at=now + timedelta(seconds=settings.WEBHOOK_DEFERRED_RETRY_DELAY * count),
+            )
+        )
+    DeferredReservation.objects.bulk_create(
+        deferred,
+        update_conflicts=True,
+        unique_fields=["hotel", "pms_reservation_id"],
+        update_fields=["attempts", "deferred_at", "retry_at"],
+    )
+    return [reservation.pms_reservation_id for reservation in deferred]
+
+
+def process_batch(batch_size: int = None) -> Dict[str, int]:
+    """
+    Claims and processes one batch of the inbox, together with the deferred reservations that are due.
+    The webhooks in the batch are coalesced per hotel and every hotel is handled once by its PMS provider,
+    within WEBHOOK_DEADLINE_SECONDS. Reservations that were not fetched in time are deferred.
+    Returns the number of claimed, successful and failed items, and the number of deferred reservations
+    and of reservations that were not written because they did not change.
+    """
+    batch = _claim_and_clean(batch_size or settings.WEBHOOK_INBOX_BATCH_SIZE)
+    outcomes = [(payload, _handle(payload)) for payload in batch.payloads]
+    return _record_batch(batch, outcomes)
+
+
+async def aprocess_batch(batch_size: int = None) -> Dict[str, int]:
+    """
+    Async variant of process_batch: the hotels in the batch are handled concurrently with ahandle_webhook.
+    """
+    batch = await sync_to_async(_claim_and_clean)(batch_size or settings.WEBHOOK_INBOX_BATCH_SIZE)
+    results = await asyncio.gather(*(_ahandle(payload) for payload in batch.payloads))
+    return await sync_to_async(_record_batch)(batch, list(zip(batch.payloads, results)))
+
+
+@dataclass
+class _Batch:
+    items: List[WebhookInboxItem]
+    items_by_hotel: Dict[int, List[WebhookInboxItem]]
+    # Attempts by reservation id by hotel id, of the deferred reservations in the batch, and when they were claimed.
+    deferred: Dict[int, Dict[str, int]]
+    deferred_claimed_at: datetime
+    payloads: List[CleanedWebhookPayload]
+
+
+# What handling a hotel came to: the result of the PMS provider, or None and the error.
+_Outcome = Tuple[Optional[WebhookResult], str]
+
+
+def _claim_and_clean(batch_size: int) -> _Batch:
+    """
+    Claims and cleans a batch of items and takes the due deferred reservations.
+    Returns the items by hotel, with the payloads coalesced per hotel.
+    Items with an invalid payload are marked as failed.
+    """
+    items = claim_batch(batch_size)
+    items_by_hotel: Dict[int, List[WebhookInboxItem]] = {}
+    payloads = []
+    for item in items:
+        if item.attempts > settings.WEBHOOK_INBOX_MAX_ATTEMPTS:
+            # Only items whose worker never finished them get here.
+            _finish(item, WebhookInboxItem.Status.FAILED, f"Gave up after {item.attempts - 1} attempts")
+            continue
+        try:
+            cleaned_webhook_payload = get_pms(item.pms_name).clean_webhook_payload(
+                bytes(item.body), item.content_encoding
+            )
+        except Exception:
+            logger.exception(f"Error cleaning webhook inbox item {item.id}")
+            cleaned_webhook_payload = None
+        if not cleaned_webhook_payload:
+            # An invalid payload does not get better by trying again.
+            _finish(item, WebhookInboxItem.Status.FAILED, "Invalid webhook payload")
+            continue
+        items_by_hotel.setdefault(cleaned_webhook_payload["hotel_id"], []).append(item)
+        payloads.append(cleaned_webhook_payload)
+
+    deferred, deferred_claimed_at = claim_deferred(settings.WEBHOOK_DEFERRED_BATCH_SIZE)
+    payloads.extend(
+        CleanedWebhookPayload(hotel_id=hotel_id, data={"Deferred": list(attempts)})
+        for hotel_id, attempts in deferred.items()
+    )
+
+    payloads = coalesce_payloads(payloads)
+    for payload in payloads:
+        logger.info(
+            f"Handling {len(items_by_hotel.get(payload['hotel_id'], []))} webhooks and "
+            f"{len(deferred.get(payload['hotel_id'], {}))} deferred reservations for hotel {payload['hotel_id']} with "
+            f"{sum(len(ids) for ids in payload['data'].values())} distinct reservation events."
+        )
+    return _Batch(items, items_by_hotel, deferred, deferred_claimed_at, payloads)
+
+
+def _handle(payload: CleanedWebhookPayload) -> _Outcome:
+    try:
+        pms = hotel_cache.get(payload["hotel_id"]).get_pms()
+        return pms.handle_webhook(payload, Deadline(settings.WEBHOOK_DEADLINE_SECONDS)), ""
+    except Exception as e:
+        logger.exception(f"Error handling webhooks for hotel {payload['hotel_id']}")
+        return None, str(e)
+
+
+async def _ahandle(payload: CleanedWebhookPayload) -> _Outcome:
+    try:
+        pms = (await sync_to_async(hotel_cache.get)(payload["hotel_id"])).get_pms()
+        return await pms.ahandle_webhook(payload, Deadline(settings.WEBHOOK_DEADLINE_SECONDS)), ""
+    except Exception as e:
+        logger.exception(f"Error handling webhooks for hotel {payload['hotel_id']}")
+        return None, str(e)
+
+
+def _record_batch(batch: _Batch, outcomes: List[Tuple[CleanedWebhookPayload, _Outcome]]) -> Dict[str, int]:
+    """
+    Finishes the items of every hotel and stores the reservations that are deferred.
+    An item is done once its hotel was handled: reservations that were deferred are retried from the deferred
+    store, and the ones that failed from the dead letters, rather than with the item. Only the items of a hotel
+    whose handling raised are retried.
+    """
+    succeeded = deferred_count = skipped = 0
+    for payload, (result, error) in outcomes:
+        hotel_id = payload["hotel_id"]
+        previous = batch.deferred.get(hotel_id, {})
+        if result is None:
+            # The deferred reservations have no item to be retried with.
+            to_defer = list(previous)
+        else:
+            to_defer = list(result.deferred)
+            # Failures without an API error had invalid details, which may be valid when they are replayed.
+            errors = {reservation_id: "Invalid reservation details." for reservation_id in result.failed}
+            errors.update(result.errors)
+            for reservation_id in result.failed:
+                # A deferred reservation that failed again is deferred again until its attempts are spent,
+                # and only then becomes a dead letter.
+                if reservation_id in previous and previous[reservation_id] < settings.WEBHOOK_INBOX_MAX_ATTEMPTS:
+                    to_defer.append(reservation_id)
+                    errors.pop(reservation_id, None)
+            if result.failed:
+                error = f"Failed to fetch reservations: {', '.join(result.failed)}"
+            record_dead_letters(hotel_id, errors)
+            skipped += len(result.skipped)
+        stored = set(defer_reservations(
+            hotel_id, {reservation_id: previous.get(reservation_id, 0) + 1 for reservation_id in to_defer}
+        ))
+        complete_deferred(
+            hotel_id, [reservation_id for reservation_id in previous if reservation_id not in stored],
+            batch.deferred_claimed_at,
+        )
+        deferred_count += len(to_defer)
+
+        success = result is not None
+        hotel_items = batch.items_by_hotel.get(hotel_id, [])
+        for item in hotel_items:
+            _record_outcome(item, success, error)
+        succeeded += len(hotel_items) if success else 0
+    return {
+        "claimed": len(batch.items),
+        "succeeded": succeeded,
+        "failed": len(batch.items) - succeeded,
+        "deferred": deferred_count,
+        "skipped": skipped,
+    }
+
+
+def _record_outcome(item: WebhookInboxItem, success: bool, error: str) -> None:
+    if success:
+        # The error names the reservations that are replayed from the dead letters, if any.
+        _finish(item, WebhookInboxItem.Status.DONE, error)
+    elif item.attempts >= settings.WEBHOOK_INBOX_MAX_ATTEMPTS:
+        _finish(item, WebhookInboxItem.Status.FAILED, error)
+    else:
+        item.next_attempt_at = timezone.now() + timedelta(seconds=settings.WEBHOOK_INBOX_RETRY_DELAY * item.attempts)
+        _finish(item, WebhookInboxItem.Status.PENDING, error)
+
+
+def _finish(item: WebhookInboxItem, status: str, error: str) -> None:
+    item.status = status
+    item.last_error = error
+    item.claim_token = ""
+    item.claimed_at = None
+    if status == WebhookInboxItem.Status.DONE:
+        item.processed_at = timezone.now()
+    item.save(
+        update_fields=[
+            "status",
+            "attempts",
+            "last_error",
+            "claim_token",
+            "claimed_at",
+            "next_attempt_at",
+            "processed_at",
+        ]
+    )
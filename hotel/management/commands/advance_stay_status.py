@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from hotel.models import Hotel, Stay
+from hotel.stays import advance_stay_statuses
+
+
+class Command(BaseCommand):
+    help = (
+        "Advances the status of stays from their check-in and check-out dates and the local date of their hotel, "
+        "without calling the PMS. Meant to run on a schedule, e.g. every hour."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--hotel",
+            type=int,
+            action="append",
+            default=None,
+            help="Id of a hotel to advance the stays of, can be repeated. Defaults to every hotel.",
+        )
+
+    def handle(self, *args, **options):
+        hotels = Hotel.objects.order_by("id")
+        if options["hotel"]:
+            hotels = hotels.filter(id__in=options["hotel"])
+
+        totals = {Stay.Status.INSTAY: 0, Stay.Status.AFTER: 0}
+        for hotel in hotels:
+            advanced = advance_stay_statuses(hotel)
+            for status, count in advanced.items():
+                totals[status] += count
+            if any(advanced.values()):
+                self.stdout.write(
+                    f"{hotel} ({hotel.local_date()}): {advanced[Stay.Status.INSTAY]} checked in, "
+                    f"{advanced[Stay.Status.AFTER]} checked out"
+                )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Advanced stays: {totals[Stay.Status.INSTAY]} checked in, {totals[Stay.Status.AFTER]} checked out."
+            )
+        )
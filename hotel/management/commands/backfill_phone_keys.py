@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from hotel.models import Guest
+from hotel.pms.phone import LANGUAGE_COUNTRIES, normalize_phone
+
+
+class Command(BaseCommand):
+    help = "Fills in the normalized phone_key of guests that do not have one yet, in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Number of guests updated per query.")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        updated = invalid = duplicates = 0
+        last_id = 0
+        while True:
+            # Keyset pagination, guests without a valid phone number keep a null key and are passed by.
+            batch = list(
+                Guest.objects.filter(phone_key__isnull=True, id__gt=last_id)
+                .order_by("id")
+                .values_list("id", "phone", "language")[:batch_size]
+            )
+            if not batch:
+                break
+            last_id = batch[-1][0]
+
+            keys = {}
+            seen = set()
+            for guest_id, phone, language in batch:
+                key = normalize_phone(phone, LANGUAGE_COUNTRIES.get(language))
+                if key is None:
+                    invalid += 1
+                elif key in seen:
+                    duplicates += 1
+                else:
+                    keys[guest_id] = key
+                    seen.add(key)
+
+            with transaction.atomic():
+                taken = set(Guest.objects.filter(phone_key__in=seen).values_list("phone_key", flat=True))
+                # The first guest with a phone key keeps it, later duplicates are left for a manual merge.
+                to_update = [Guest(id=guest_id, phone_key=key) for guest_id, key in keys.items() if key not in taken]
+                duplicates += len(keys) - len(to_update)
+                Guest.objects.bulk_update(to_update, ["phone_key"])
+            updated += len(to_update)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Backfilled {updated} phone keys, {invalid} guests without a valid phone number, "
+                f"{duplicates} duplicate phone numbers."
+            )
+        )
@@ -0,0 +1,52 @@
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from hotel.benchmarks import make_catalog
+from hotel.external_api import get_apaleo_upsell_products, get_guest_line_upsell_product
+from hotel.pms.apaleo.apaleo import Apaleo
+from hotel.pms.apaleo.model import ApaleoUpsellProductAdapter
+from hotel.pms.guestline.guestline import GuestLine
+from hotel.pms.guestline.model import GuestLineUpsellProductAdapter
+
+# The PMS, its adapter and its sample catalog.
+PMS_CATALOGS = [
+    (Apaleo, ApaleoUpsellProductAdapter, lambda: get_apaleo_upsell_products()["services"]),
+    (GuestLine, GuestLineUpsellProductAdapter, lambda: get_guest_line_upsell_product()["products"]),
+]
+
+
+class Command(BaseCommand):
+    help = "Compares the compiled upsell product specs with the per-product adapters."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--products",
+            type=int,
+            nargs="+",
+            default=[10, 100, 1000, 10000],
+            help="Numbers of products per catalog to benchmark.",
+        )
+        parser.add_argument("--repeat", type=int, default=5, help="Number of timing runs, the best one is reported.")
+
+    def handle(self, *args, **options):
+        for pms, adapter, samples in PMS_CATALOGS:
+            spec = pms.upsell_product_spec
+            for size in options["products"]:
+                catalog = make_catalog(samples(), size)
+                adapted = [adapter(product).convert().model_dump() for product in catalog]
+                assert adapted == [product.model_dump() for product in spec.validate(catalog)]
+
+                number = max(1, 20000 // size)
+                legacy = min(
+                    timeit.repeat(
+                        lambda: [adapter(product).convert() for product in catalog],
+                        number=number,
+                        repeat=options["repeat"],
+                    )
+                )
+                compiled = min(timeit.repeat(lambda: spec.validate(catalog), number=number, repeat=options["repeat"]))
+                self.stdout.write(
+                    f"{pms.__name__:>9} {size:>6} products: adapters {legacy / number * 1e6:10.1f} us, "
+                    f"compiled {compiled / number * 1e6:10.1f} us, speedup {legacy / compiled:.2f}x"
+                )
@@ -0,0 +1,97 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from hotel.benchmarks import StubExternalAPI, parse_latency
+from hotel.models import Hotel
+from hotel.pms.upsert import UpsellProductUpsertResult
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the throughput of upsell catalog syncs (fetching, converting and saving the catalogs of hotels "
+        "on Apaleo and GuestLine) against a stubbed PMS API. Everything is written in a transaction that is "
+        "rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--hotels", type=int, default=10, help="Number of hotels, half of them on each PMS.")
+        parser.add_argument("--products", type=int, default=100, help="Number of products per catalog.")
+        parser.add_argument(
+            "--rounds",
+            type=int,
+            default=2,
+            help="Number of syncs of every catalog. The first one creates the products, the others find them unchanged.",
+        )
+        parser.add_argument(
+            "--latency",
+            type=parse_latency,
+            default="fixed:20",
+            help="Latency model of the PMS API calls: fixed:<ms>, uniform:<ms>,<ms>, lognormal:<median ms>,<sigma> "
+            "or histogram:<fixture archive>.",
+        )
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of PMS API calls that fail.")
+        parser.add_argument("--seed", type=int, default=None, help="Seed for the stubbed API.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        api = StubExternalAPI(
+            latency=options["latency"],
+            error_rate=options["error_rate"],
+            seed=rng.getrandbits(64),
+            catalog_size=options["products"],
+        )
+
+        with transaction.atomic():
+            pmses = [
+                Hotel.objects.create(
+                    name=f"Benchmark hotel {i}",
+                    city="Benchmark",
+                    pms=Hotel.PMS.APALEO if i % 2 == 0 else Hotel.PMS.GUESTLINE,
+                    pms_hotel_id=f"benchmark-{i}",
+                ).get_pms()
+                for i in range(options["hotels"])
+            ]
+            with api.patch("hotel.pms.apaleo.apaleo", "hotel.pms.guestline.guestline"):
+                for round_number in range(1, options["rounds"] + 1):
+                    self.sync(round_number, pmses, api)
+            transaction.set_rollback(True)
+
+    def sync(self, round_number, pmses, api):
+        calls = api.calls
+        latencies, queries, failed = [], [], 0
+        total = UpsellProductUpsertResult()
+        started = time.perf_counter()
+        for pms in pmses:
+            sync_started = time.perf_counter()
+            with CaptureQueriesContext(connection) as captured:
+                # What PMSProvider.get_upsell_products does, keeping the result of the upsert.
+                products = pms.retrieve_products_api()
+                result = pms.bulk_upsert(products) if products is not None else None
+            latencies.append(time.perf_counter() - sync_started)
+            queries.append(len(captured))
+            if result is None:
+                failed += 1
+                continue
+            total.created += result.created
+            total.updated += result.updated
+            total.unchanged += result.unchanged
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(f"Round {round_number}: {len(pmses)} catalogs in {elapsed:.2f} s ({failed} failed).")
+        if len(latencies) > 1:
+            percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+            p50, p95 = percentiles[49], percentiles[94]
+        else:
+            p50 = p95 = latencies[0] if latencies else 0.0
+        self.stdout.write(f"  Latency: p50 {p50 * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms")
+        if queries:
+            self.stdout.write(f"  DB queries: {sum(queries)} total, {statistics.mean(queries):.1f} per catalog")
+        self.stdout.write(
+            f"  Products: {total.created} created, {total.updated} updated, {total.unchanged} unchanged, "
+            f"PMS API calls: {api.calls - calls}"
+        )
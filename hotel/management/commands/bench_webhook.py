@@ -0,0 +1,158 @@
+import json
+import random
+import statistics
+import time
+import uuid
+from typing import Dict, List
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+
+from hotel.benchmarks import FixtureArchive, StubExternalAPI, UniformLatency, make_webhook_payload, parse_latency
+from hotel.models import Hotel
+from hotel.pms import resilience
+from hotel.pms.apaleo.apaleo import Apaleo
+from hotel.pms.cache import guest_cache, hotel_cache
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the throughput of webhook handling (clean_webhook_payload and handle_webhook) against a stubbed "
+        "PMS API. Everything is written in a transaction that is rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--hotels", type=int, default=10, help="Number of hotels.")
+        parser.add_argument("--events", type=int, default=20, help="Number of events per webhook.")
+        parser.add_argument("--webhooks", type=int, default=1, help="Number of webhooks per hotel.")
+        parser.add_argument("--latency-ms", type=float, default=20.0, help="Latency of every PMS API call.")
+        parser.add_argument("--jitter-ms", type=float, default=10.0, help="Random extra latency of every call.")
+        parser.add_argument("--error-rate", type=float, default=0.09, help="Fraction of PMS API calls that fail.")
+        parser.add_argument(
+            "--latency",
+            type=parse_latency,
+            default=None,
+            help="Latency model instead of --latency-ms and --jitter-ms: fixed:<ms>, uniform:<ms>,<ms>, "
+            "lognormal:<median ms>,<sigma> or histogram:<fixture archive>.",
+        )
+        parser.add_argument(
+            "--replay",
+            default=None,
+            help="Fixture archive of recorded PMS API responses (see record_api_fixtures). The webhooks are built "
+            "from the recorded reservations, --hotels is ignored.",
+        )
+        parser.add_argument("--seed", type=int, default=None, help="Seed for the payloads and the stubbed API.")
+        parser.add_argument(
+            "--rate-limits",
+            action="store_true",
+            help="Apply PMS_RATE_LIMITS and PMS_HOTEL_RATE_LIMITS, which are turned off by default.",
+        )
+
+    def handle(self, *args, **options):
+        if options["rate_limits"]:
+            self.bench(options)
+        else:
+            with override_settings(PMS_RATE_LIMITS={}, PMS_HOTEL_RATE_LIMITS={}):
+                self.bench(options)
+
+    def bench(self, options):
+        if options["replay"]:
+            try:
+                options["replay"] = FixtureArchive.load(options["replay"])
+            except (OSError, ValueError, KeyError) as e:
+                raise CommandError(f"Can not load the fixture archive {options['replay']}: {e}")
+        rng = random.Random(options["seed"])
+        latency = options["latency"] or UniformLatency(
+            options["latency_ms"] / 1000, (options["latency_ms"] + options["jitter_ms"]) / 1000
+        )
+        api = StubExternalAPI(
+            latency=latency, error_rate=options["error_rate"], seed=rng.getrandbits(64), archive=options["replay"]
+        )
+        resilience.reset_breakers()
+        resilience.stats.reset()
+
+        with transaction.atomic():
+            # The guest cache is stored in the database, clearing it is rolled back with everything else.
+            hotel_cache.clear()
+            guest_cache.clear()
+            webhooks = self.replayed_webhooks(options) if options["replay"] else self.webhooks(options, rng)
+            pms_hotel_ids = list(dict.fromkeys(json.loads(payload)["HotelId"] for payload in webhooks))
+            for i, pms_hotel_id in enumerate(pms_hotel_ids):
+                # Recorded reservations can belong to a hotel that exists already.
+                Hotel.objects.get_or_create(
+                    pms=Hotel.PMS.APALEO,
+                    pms_hotel_id=pms_hotel_id,
+                    defaults={"name": f"Benchmark hotel {i}", "city": "Benchmark"},
+                )
+            events = 0
+            for payload in webhooks:
+                api.register_payload(payload)
+                events += len(json.loads(payload)["Events"])
+            rng.shuffle(webhooks)
+
+            latencies, queries, failed = [], [], 0
+            with api.patch():
+                started = time.perf_counter()
+                for payload in webhooks:
+                    webhook_started = time.perf_counter()
+                    with CaptureQueriesContext(connection) as captured:
+                        cleaned_payload = Apaleo.clean_webhook_payload(payload)
+                        success = cleaned_payload is not None and \
+                            hotel_cache.get(cleaned_payload["hotel_id"]).get_pms().handle_webhook(cleaned_payload)
+                    latencies.append(time.perf_counter() - webhook_started)
+                    queries.append(len(captured))
+                    failed += not success
+                elapsed = time.perf_counter() - started
+
+            transaction.set_rollback(True)
+
+        self.report(len(pms_hotel_ids), events, latencies, queries, failed, elapsed, api.calls)
+
+    @staticmethod
+    def webhooks(options, rng: random.Random) -> List[str]:
+        webhooks = []
+        for _ in range(options["hotels"]):
+            pms_hotel_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+            webhooks.extend(
+                make_webhook_payload(pms_hotel_id, options["events"], rng) for _ in range(options["webhooks"])
+            )
+        return webhooks
+
+    @staticmethod
+    def replayed_webhooks(options) -> List[str]:
+        """
+        Webhooks of --events recorded reservations each, every reservation is in --webhooks webhooks.
+        """
+        reservation_ids: Dict[str, List[str]] = {}
+        for reservation in options["replay"].reservations():
+            reservation_ids.setdefault(reservation["HotelId"], []).append(reservation["ReservationId"])
+        webhooks = []
+        for pms_hotel_id, ids in reservation_ids.items():
+            for start in range(0, len(ids), options["events"]):
+                events = [
+                    {"Name": "ReservationUpdated", "Value": {"ReservationId": reservation_id}}
+                    for reservation_id in ids[start:start + options["events"]]
+                ]
+                payload = json.dumps({"HotelId": pms_hotel_id, "Events": events})
+                webhooks.extend([payload] * options["webhooks"])
+        return webhooks
+
+    def report(self, hotels, events, latencies, queries, failed, elapsed, api_calls):
+        self.stdout.write(
+            f"{len(latencies)} webhooks with {events} events for {hotels} hotels in {elapsed:.2f} s ({failed} incomplete)."
+        )
+        self.stdout.write(f"Throughput: {len(latencies) / elapsed:.1f} webhooks/s, {events / elapsed:.1f} events/s")
+        if len(latencies) > 1:
+            percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+            p50, p95, p99 = percentiles[49], percentiles[94], percentiles[98]
+        else:
+            p50 = p95 = p99 = latencies[0] if latencies else 0.0
+        self.stdout.write(f"Latency: p50 {p50 * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms")
+        if queries:
+            self.stdout.write(
+                f"DB queries: {sum(queries)} total, {statistics.mean(queries):.1f} per webhook, max {max(queries)}"
+            )
+        self.stdout.write(f"PMS API calls: {api_calls}, resilience: {resilience.stats.snapshot()}")
+        self.stdout.write(f"Guest cache: {guest_cache.stats()}")
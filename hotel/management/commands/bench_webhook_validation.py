@@ -0,0 +1,64 @@
+import json
+import timeit
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from hotel.benchmarks import make_webhook_payload
+from hotel.pms.schema import WebhookSchema
+
+
+def legacy_validate(payload: str):
+    """
+    The hand-written validation that clean_webhook_payload used before the compiled schemas.
+    """
+    payload_json = json.loads(payload)
+    pms_hotel_id = payload_json.get("HotelId")
+    if not pms_hotel_id:
+        raise ValueError("Invalid pms_hotel_id: None")
+    uuid.UUID(pms_hotel_id)
+
+    events = {}
+    for event in payload_json.get("Events", []):
+        name = event.get("Name")
+        reservation_id = event.get("Value", {}).get("ReservationId")
+        if not reservation_id:
+            continue
+        events.setdefault(name, {})[reservation_id] = None
+    return {name: list(reservation_ids) for name, reservation_ids in events.items()}
+
+
+def compiled_validate(payload: str, schema: WebhookSchema = WebhookSchema(), max_events: int = 100000):
+    """
+    The single-pass validation of PMSProvider.clean_webhook_payload, which validates the hotel id as well.
+    The early hotel lookup that comes before it is not part of the benchmark.
+    """
+    events, _ = schema.validate(payload, max_events)
+    return events
+
+
+class Command(BaseCommand):
+    help = "Compares the compiled webhook payload validation with the previous hand-written validation."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--events",
+            type=int,
+            nargs="+",
+            default=[3, 10, 100, 1000],
+            help="Numbers of events per payload to benchmark.",
+        )
+        parser.add_argument("--repeat", type=int, default=5, help="Number of timing runs, the best one is reported.")
+
+    def handle(self, *args, **options):
+        for events in options["events"]:
+            payload = make_webhook_payload(str(uuid.uuid4()), events)
+            assert legacy_validate(payload) == compiled_validate(payload)
+
+            number = max(1, 20000 // events)
+            legacy = min(timeit.repeat(lambda: legacy_validate(payload), number=number, repeat=options["repeat"]))
+            compiled = min(timeit.repeat(lambda: compiled_validate(payload), number=number, repeat=options["repeat"]))
+            self.stdout.write(
+                f"{events:>6} events: legacy {legacy / number * 1e6:10.1f} us, "
+                f"compiled {compiled / number * 1e6:10.1f} us, speedup {legacy / compiled:.2f}x"
+            )
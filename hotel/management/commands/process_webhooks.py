@@ -0,0 +1,62 @@
+import time
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from hotel.inbox import aprocess_batch, process_batch
+
+
+class Command(BaseCommand):
+    help = "Processes the webhooks stored in the webhook inbox."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.WEBHOOK_INBOX_BATCH_SIZE,
+            help="Number of inbox items claimed at once.",
+        )
+        parser.add_argument(
+            "--forever",
+            action="store_true",
+            help="Keep polling the inbox instead of stopping once it is empty.",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=1.0,
+            help="Seconds to wait before polling an empty inbox again (only with --forever).",
+        )
+        parser.add_argument(
+            "--async",
+            dest="use_async",
+            action="store_true",
+            help="Handle the hotels of a batch concurrently with the async PMS clients.",
+        )
+
+    def handle(self, *args, **options):
+        process = async_to_sync(aprocess_batch) if options["use_async"] else process_batch
+        totals = {"claimed": 0, "succeeded": 0, "failed": 0, "deferred": 0, "skipped": 0}
+        while True:
+            result = process(options["batch_size"])
+            for key, value in result.items():
+                totals[key] += value
+            if result["claimed"]:
+                self.stdout.write(
+                    f"Processed {result['claimed']} webhooks "
+                    f"({result['succeeded']} succeeded, {result['failed']} failed), "
+                    f"{result['deferred']} reservations deferred, {result['skipped']} unchanged."
+                )
+                continue
+            if not options["forever"]:
+                break
+            time.sleep(options["sleep"])
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Inbox drained: {totals['claimed']} webhooks processed "
+                f"({totals['succeeded']} succeeded, {totals['failed']} failed), "
+                f"{totals['deferred']} reservations deferred, {totals['skipped']} unchanged."
+            )
+        )
@@ -0,0 +1,52 @@
+import json
+import random
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from hotel.benchmarks import FixtureArchive, RecordingExternalAPI
+from hotel.external_api import APIError
+
+
+class Command(BaseCommand):
+    help = (
+        "Records responses and latencies of the PMS API to a fixture archive, "
+        "to replay them with bench_webhook --replay and --latency histogram:<archive>."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="Path of the fixture archive to write.")
+        parser.add_argument("--reservations", type=int, default=100, help="Number of reservations to record.")
+        parser.add_argument("--attempts", type=int, default=3, help="Attempts per call, failed calls are recorded too.")
+        parser.add_argument("--seed", type=int, default=None, help="Seed for the recorded reservation ids.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        archive = FixtureArchive()
+        api = RecordingExternalAPI(archive)
+
+        def call(name, *call_args):
+            for _ in range(options["attempts"]):
+                try:
+                    return getattr(api, name)(*call_args)
+                except APIError:
+                    continue
+            return None
+
+        recorded = 0
+        for _ in range(options["reservations"]):
+            reservation = call("get_reservation_details", str(uuid.UUID(int=rng.getrandbits(128), version=4)))
+            if reservation is None:
+                continue
+            recorded += 1
+            call("get_guest_details", json.loads(reservation)["GuestId"])
+        call("get_apaleo_upsell_products")
+        call("get_guest_line_upsell_product")
+
+        archive.save(options["output"])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Recorded {recorded} reservations, {len(archive.responses)} responses and "
+                f"{len(archive.latencies)} latencies to {options['output']}."
+            )
+        )
@@ -0,0 +1,40 @@
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from hotel.deadletters import areplay_dead_letters
+
+
+class Command(BaseCommand):
+    help = "Replays the reservations that failed on a PMS API error and are due, in concurrent batches per hotel."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit", type=int, default=1000, help="Maximum number of dead letters claimed per pass."
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=settings.DEAD_LETTER_REPLAY_CONCURRENCY,
+            help="Number of batches that are replayed at the same time.",
+        )
+
+    def handle(self, *args, **options):
+        totals = {"replayed": 0, "recovered": 0, "failed": 0}
+        while True:
+            # Failed dead letters are backed off, so every pass only gets reservations it did not try yet.
+            result = async_to_sync(areplay_dead_letters)(options["limit"], options["concurrency"])
+            if not result["replayed"]:
+                break
+            for key, value in result.items():
+                totals[key] += value
+            self.stdout.write(
+                f"Replayed {result['replayed']} reservations: {result['recovered']} recovered, {result['failed']} failed."
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Dead letters replayed: {totals['replayed']} reservations, {totals['recovered']} recovered, "
+                f"{totals['failed']} failed."
+            )
+        )
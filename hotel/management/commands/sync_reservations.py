@@ -0,0 +1,82 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from hotel.models import Hotel
+from hotel.pms.sync import sync_reservations
+
+
+def parse_date(value: str) -> datetime.date:
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+
+class Command(BaseCommand):
+    help = "Reconciles the stays with the reservations in the PMS, by check-in date, for webhooks that were missed."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--from",
+            dest="from_date",
+            type=parse_date,
+            default=None,
+            help="First check-in date (YYYY-MM-DD), defaults to today.",
+        )
+        parser.add_argument(
+            "--to",
+            dest="to_date",
+            type=parse_date,
+            default=None,
+            help=f"Last check-in date (YYYY-MM-DD), defaults to {settings.PMS_SYNC_DAYS} days after --from.",
+        )
+        parser.add_argument(
+            "--hotel",
+            type=int,
+            action="append",
+            default=None,
+            help="Id of a hotel to sync, can be repeated. Defaults to every hotel with a PMS.",
+        )
+
+    def handle(self, *args, **options):
+        from_date = options["from_date"] or datetime.date.today()
+        to_date = options["to_date"] or from_date + datetime.timedelta(days=settings.PMS_SYNC_DAYS - 1)
+        if to_date < from_date:
+            raise CommandError("--to can not be before --from.")
+        dates = [from_date + datetime.timedelta(days=i) for i in range((to_date - from_date).days + 1)]
+
+        hotels = Hotel.objects.exclude(pms__isnull=True).exclude(pms="").order_by("id")
+        if options["hotel"]:
+            hotels = hotels.filter(id__in=options["hotel"])
+
+        # The reservations of a date are fetched once for all hotels on the same PMS.
+        pmses_by_name = {}
+        for hotel in hotels:
+            pms = hotel.get_pms()
+            pmses_by_name.setdefault(pms.name, []).append(pms)
+
+        failed = False
+        for pmses in pmses_by_name.values():
+            try:
+                results = sync_reservations(pmses, dates)
+            except NotImplementedError as e:
+                for pms in pmses:
+                    self.stdout.write(self.style.WARNING(f"{pms.hotel}: {e}"))
+                continue
+            for pms in pmses:
+                hotel, result = pms.hotel, results[pms.hotel.id]
+                failed = failed or bool(result.failed_dates)
+                self.stdout.write(
+                    f"{hotel}: {result.reservations} reservations over {result.dates} dates, "
+                    f"{result.stays.created} missing, {result.stays.updated} stale, {result.stays.unchanged} in sync "
+                    f"(drift {result.drift:.1%})"
+                )
+                if result.failed_dates:
+                    self.stdout.write(
+                        self.style.ERROR(
+                            f"{hotel}: failed dates: {', '.join(date.isoformat() for date in result.failed_dates)}"
+                        )
+                    )
+
+        if failed:
+            raise CommandError("Some dates could not be synced, run the command again for those dates.")
+        self.stdout.write(self.style.SUCCESS(f"Synced check-in dates {from_date} to {to_date}."))
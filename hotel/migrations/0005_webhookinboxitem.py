@@ -0,0 +1,32 @@
+# Generated by Django 4.2.2 on 2026-10-17 05:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hotel', '0004_alter_hotel_pms'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookInboxItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pms_name', models.CharField(max_length=50)),
+                ('body', models.BinaryField(help_text='The raw request body, exactly as received from the PMS.')),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('status', models.CharField(choices=[('pending', 'Waiting to be processed'), ('processing', 'Claimed by a worker'), ('done', 'Processed'), ('failed', 'Processing failed')], default='pending', max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('claim_token', models.CharField(blank=True, help_text='Set by the worker that is currently processing this item.', max_length=36)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('next_attempt_at', models.DateTimeField(blank=True, help_text='A failed item is not retried before this time.', null=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'received_at'], name='hotel_webho_status_6b5e54_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.2 on 2026-10-17 05:55
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hotel', '0005_webhookinboxitem'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hotel',
+            name='max_concurrent_fetches',
+            field=models.PositiveSmallIntegerField(default=8, help_text='The maximum number of parallel calls to the PMS API while handling a webhook for this hotel.', validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-17 05:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hotel', '0006_hotel_max_concurrent_fetches'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookinboxitem',
+            name='content_encoding',
+            field=models.CharField(blank=True, help_text='The Content-Encoding of the body.', max_length=20),
+        ),
+    ]
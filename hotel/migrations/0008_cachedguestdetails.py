@@ -0,0 +1,26 @@
+# Generated by Django 4.2.2 on 2026-10-17 06:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hotel', '0007_webhookinboxitem_content_encoding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedGuestDetails',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pms_name', models.CharField(max_length=50)),
+                ('pms_guest_id', models.CharField(max_length=200)),
+                ('details', models.JSONField()),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'unique_together': {('pms_name', 'pms_guest_id')},
+            },
+        ),
+    ]
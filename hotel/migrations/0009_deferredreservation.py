@@ -0,0 +1,28 @@
+# Generated by Django 4.2.2 on 2026-10-17 06:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hotel', '0008_cachedguestdetails'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeferredReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pms_reservation_id', models.CharField(max_length=200)),
+                ('attempts', models.PositiveIntegerField(default=1, help_text='The number of times the deadline passed.')),
+                ('deferred_at', models.DateTimeField(auto_now=True)),
+                ('retry_at', models.DateTimeField(db_index=True)),
+                ('hotel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deferred_reservations', to='hotel.hotel')),
+            ],
+            options={
+                'unique_together': {('hotel', 'pms_reservation_id')},
+            },
+        ),
+    ]
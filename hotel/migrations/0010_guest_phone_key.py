@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-17 06:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hotel', '0009_deferredreservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='guest',
+            name='phone_key',
+            field=models.CharField(blank=True, help_text='The phone number in E.164 format, see hotel.pms.phone. Empty if the phone number is not valid.', max_length=16, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-17 06:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hotel', '0010_guest_phone_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stay',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', help_text='Hash of the reservation and guest details this stay was last written with, see hotel.pms.upsert.', max_length=32),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.2 on 2026-10-17 06:20
+
+from django.db import migrations, models
+import hotel.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hotel', '0011_stay_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hotel',
+            name='timezone',
+            field=models.CharField(default='UTC', help_text='The IANA time zone of the hotel, e.g. Europe/Amsterdam, that check-in and check-out dates are in.', max_length=64, validators=[hotel.models.validate_timezone]),
+        ),
+        migrations.AddIndex(
+            model_name='stay',
+            index=models.Index(fields=['hotel', 'status', 'checkin'], name='hotel_stay_status_checkin'),
+        ),
+    ]
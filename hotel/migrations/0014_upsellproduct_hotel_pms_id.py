@@ -0,0 +1,17 @@
+# Generated by Django 4.2.2 on 2026-10-17 06:26
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hotel', '0013_deadletter'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='upsellproduct',
+            unique_together={('hotel', 'pms_id')},
+        ),
+    ]
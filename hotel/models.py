@@ -1,5 +1,10 @@
+import datetime
+import zoneinfo
+
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator
 from django.db import models
+from django.utils import timezone
 
 
 class Language(models.TextChoices):
@@ -14,6 +19,11 @@ class Language(models.TextChoices):
     DANISH = "da", "Danish"
 
 
+def validate_timezone(value: str) -> None:
+    if value not in zoneinfo.available_timezones():
+        raise ValidationError(f"{value} is not a known time zone.")
+
+
 class Hotel(models.Model):
     class PMS(models.TextChoices):
         APALEO = "Apaleo", "Apaleo PMS"
@@ -23,12 +33,29 @@ class Hotel(models.Model):
     city = models.CharField(max_length=200, blank=False, null=False)
     pms = models.CharField(choices=PMS.choices, max_length=50, blank=True, null=True)
     pms_hotel_id = models.CharField(max_length=200)
+    max_concurrent_fetches = models.PositiveSmallIntegerField(
+        default=8,
+        validators=[MinValueValidator(1)],
+        help_text="The maximum number of parallel calls to the PMS API while handling a webhook for this hotel.",
+    )
+    timezone = models.CharField(
+        max_length=64,
+        default="UTC",
+        validators=[validate_timezone],
+        help_text="The IANA time zone of the hotel, e.g. Europe/Amsterdam, that check-in and check-out dates are in.",
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.city} - {self.name}"
 
+    def local_date(self) -> datetime.date:
+        """
+        Returns the current date at the hotel.
+        """
+        return timezone.now().astimezone(zoneinfo.ZoneInfo(self.timezone)).date()
+
     def get_pms(self):
         pms_cls = get_pms(self.pms) if self.pms else None
         return pms_cls(self) if pms_cls else None
@@ -93,13 +120,17 @@ class UpsellProduct(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # Catalog syncs match products by the PMS id within a hotel.
+        unique_together = ("hotel", "pms_id")
+
     def __str__(self):
         return f"{self.name} ({self.type}) - {self.hotel.name}"
 
 
 class Guest(models.Model):
     """
-    Guests are identified by their phone number.
+    Guests are identified by their phone number, normalized to E.164 in phone_key.
     """
 
     name = models.CharField(max_length=200)
@@ -107,6 +138,13 @@ class Guest(models.Model):
         max_length=200,
         unique=True,
     )
+    phone_key = models.CharField(
+        max_length=16,
+        unique=True,
+        null=True,
+        blank=True,
+        help_text="The phone number in E.164 format, see hotel.pms.phone. Empty if the phone number is not valid.",
+    )
     language = models.CharField(max_length=5, choices=Language.choices, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -145,11 +183,113 @@ class Stay(models.Model):
     status = models.CharField(choices=Status.choices, default=Status.UNKNOWN, max_length=50)
     checkin = models.DateField(blank=True, null=True)
     checkout = models.DateField(blank=True, null=True)
+    fingerprint = models.CharField(
+        max_length=32,
+        blank=True,
+        default="",
+        help_text="Hash of the reservation and guest details this stay was last written with, see hotel.pms.upsert.",
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = ("hotel", "pms_reservation_id")
+        indexes = [models.Index(fields=["hotel", "status", "checkin"], name="hotel_stay_status_checkin")]
+
+
+class WebhookInboxItem(models.Model):
+    """
+    A webhook call as it was received from the PMS.
+    The webhook view only stores the raw body, the processing happens in the
+    `process_webhooks` management command.
+    """
+
+    class Status(models.TextChoices):
+        PENDING = "pending", "Waiting to be processed"
+        PROCESSING = "processing", "Claimed by a worker"
+        DONE = "done", "Processed"
+        FAILED = "failed", "Processing failed"
+
+    pms_name = models.CharField(max_length=50)
+    body = models.BinaryField(help_text="The raw request body, exactly as received from the PMS.")
+    content_encoding = models.CharField(max_length=20, blank=True, help_text="The Content-Encoding of the body.")
+    received_at = models.DateTimeField(auto_now_add=True)
+    status = models.CharField(choices=Status.choices, default=Status.PENDING, max_length=20)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    claim_token = models.CharField(
+        max_length=36,
+        blank=True,
+        help_text="Set by the worker that is currently processing this item.",
+    )
+    claimed_at = models.DateTimeField(blank=True, null=True)
+    next_attempt_at = models.DateTimeField(
+        blank=True,
+        null=True,
+        help_text="A failed item is not retried before this time.",
+    )
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "received_at"])]
+
+    def __str__(self):
+        return f"{self.pms_name} webhook received at {self.received_at} ({self.status})"
+
+
+class DeferredReservation(models.Model):
+    """
+    A reservation from a webhook that could not be fetched before the deadline of the webhook.
+    The `process_webhooks` command fetches it again once retry_at has passed.
+    """
+
+    hotel = models.ForeignKey(Hotel, on_delete=models.CASCADE, related_name="deferred_reservations")
+    pms_reservation_id = models.CharField(max_length=200)
+    attempts = models.PositiveIntegerField(default=1, help_text="The number of times the deadline passed.")
+    deferred_at = models.DateTimeField(auto_now=True)
+    retry_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = ("hotel", "pms_reservation_id")
+
+    def __str__(self):
+        return f"Reservation {self.pms_reservation_id} of hotel {self.hotel_id}, retry at {self.retry_at}"
+
+
+class DeadLetter(models.Model):
+    """
+    A reservation whose details or guest could not be fetched from the PMS because of an API error.
+    The `replay_dead_letters` command fetches it again once retry_at has passed, with exponential backoff.
+    """
+
+    hotel = models.ForeignKey(Hotel, on_delete=models.CASCADE, related_name="dead_letters")
+    pms_reservation_id = models.CharField(max_length=200)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=1, help_text="The number of times fetching the reservation failed.")
+    first_failed_at = models.DateTimeField(auto_now_add=True)
+    last_failed_at = models.DateTimeField(auto_now=True)
+    retry_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = ("hotel", "pms_reservation_id")
+
+    def __str__(self):
+        return f"Reservation {self.pms_reservation_id} of hotel {self.hotel_id}, failed {self.attempts} times"
+
+
+class CachedGuestDetails(models.Model):
+    """
+    Guest details as fetched from a PMS, shared by all worker processes so a guest is not fetched over and over.
+    Entries expire after PMS_GUEST_CACHE_TTL seconds, the oldest are evicted beyond PMS_GUEST_CACHE_MAX_ENTRIES.
+    """
+
+    pms_name = models.CharField(max_length=50)
+    pms_guest_id = models.CharField(max_length=200)
+    details = models.JSONField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = ("pms_name", "pms_guest_id")
 
 
 from .pms.base import get_pms
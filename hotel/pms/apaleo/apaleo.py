@@ -1,68 +1,249 @@
+import datetime
 import json
 import logging
-import uuid
-from typing import Optional, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, List, Tuple, Union
 
-from hotel.external_api import get_apaleo_upsell_products
+from pydantic import ValidationError
+
+from hotel.external_api import (
+    APIError,
+    aget_apaleo_upsell_products,
+    aget_guest_details,
+    aget_reservation_details,
+    get_apaleo_upsell_products,
+    get_guest_details,
+    get_reservation_details,
+    get_reservations_for_given_checkin_date,
+)
 from hotel.models import Hotel, UpsellProduct
-from hotel.pms.apaleo.model import ApaleoUpsellProductAdapter
-from hotel.pms.base import CleanedWebhookPayload, PMSProvider
+from hotel.pms.apaleo.model import ApaleoGuestDetailsAdapter, ApaleoStayDetailsAdapter
+from hotel.pms.base import PMSProvider, WebhookResult, gather_bounded
+from hotel.pms.catalog import UpsellProductSpec
+from hotel.pms.schema import WebhookSchema
+from hotel.pms.model import GuestDetails, StayDetails
+from hotel.pms.resilience import Deadline, DeadlineExceeded
 
 logger = logging.getLogger(__name__)
 
+# The share of the deadline that fetching the reservations may take, the rest is left for their guests.
+RESERVATIONS_DEADLINE_SHARE = 2 / 3
+
+# A fetched reservation, None if it is invalid, or the APIError it failed with (DeadlineExceeded if it was not
+# fetched in time).
+FetchOutcome = Union[StayDetails, None, APIError]
+
 
 class Apaleo(PMSProvider):
 
+    webhook_schema = WebhookSchema(
+        hotel_id_key="HotelId",
+        events_key="Events",
+        event_name_key="Name",
+        reservation_id_path=("Value", "ReservationId"),
+    )
+    upsell_product_spec = UpsellProductSpec(
+        price_path=("defaultGrossPrice",),
+        age_category_path=("ageCategoryId",),
+        pricing_unit_path=("pricingUnit",),
+    )
+    hotel_pms = Hotel.PMS.APALEO
+
     def retrieve_products_api(self) -> Optional[List[UpsellProduct]]:
         try:
             data = get_apaleo_upsell_products()
             services = data.get("services", [])
-            products = [ApaleoUpsellProductAdapter(service).convert() for service in services]
+            products = self.upsell_product_spec.validate(services)
             return products
         except Exception as e:
             logger.error(f"Failed to retrieve upsell products: {e}")
             return None
 
-    @classmethod
-    def clean_webhook_payload(cls, payload: str) \
-            -> Optional[CleanedWebhookPayload]:
-        if not payload:  # Check for empty or invalid payload early
-            logger.error("Payload is missing or empty.")
+    async def aretrieve_products_api(self) -> Optional[List[UpsellProduct]]:
+        try:
+            data = await aget_apaleo_upsell_products()
+            return self.upsell_product_spec.validate(data.get("services", []))
+        except Exception as e:
+            logger.error(f"Failed to retrieve upsell products: {e}")
             return None
 
+    def handle_webhook(self, webhook_data: dict, deadline: Optional[Deadline] = None) -> WebhookResult:
+        """
+        Fetches the details of all reservations in the webhook concurrently, at most
+        hotel.max_concurrent_fetches at a time, then the details of their guests that are not
+        in the guest cache, and saves them in a single write phase.
+        Reservations that could not be fetched before the deadline are deferred. Fetching the reservations
+        may take RESERVATIONS_DEADLINE_SHARE of the time that is left, so there is time to fetch their guests.
+        """
+        reservation_ids = self._reservation_ids(webhook_data)
+        if not reservation_ids:
+            return WebhookResult()
+
+        reservations_deadline = deadline.share(RESERVATIONS_DEADLINE_SHARE) if deadline else None
+        max_workers = min(self.hotel.max_concurrent_fetches, len(reservation_ids))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            outcomes = list(
+                executor.map(self._fetch_outcome, reservation_ids, [reservations_deadline] * len(reservation_ids))
+            )
+
+        fetched = [outcome for outcome in outcomes if isinstance(outcome, StayDetails)]
+        guests = self.fetch_guests([stay.pms_guest_id for stay in fetched if stay.pms_guest_id], deadline)
+        stays, result = self._collect(reservation_ids, outcomes, guests, deadline)
+        result.skipped = self.save_stays(stays).skipped
+        return result
+
+    async def ahandle_webhook(self, webhook_data: dict, deadline: Optional[Deadline] = None) -> WebhookResult:
+        """
+        Async variant of handle_webhook, all API calls are awaited on the event loop.
+        """
+        reservation_ids = self._reservation_ids(webhook_data)
+        if not reservation_ids:
+            return WebhookResult()
+
+        reservations_deadline = deadline.share(RESERVATIONS_DEADLINE_SHARE) if deadline else None
+        outcomes = await gather_bounded(
+            self.hotel.max_concurrent_fetches,
+            lambda reservation_id: self._afetch_outcome(reservation_id, reservations_deadline),
+            reservation_ids,
+        )
+        fetched = [outcome for outcome in outcomes if isinstance(outcome, StayDetails)]
+        guests = await self.afetch_guests([stay.pms_guest_id for stay in fetched if stay.pms_guest_id], deadline)
+        stays, result = self._collect(reservation_ids, outcomes, guests, deadline)
+        result.skipped = (await self.asave_stays(stays)).skipped
+        return result
+
+    def fetch_reservation(self, reservation_id: str, deadline: Optional[Deadline] = None) -> Optional[StayDetails]:
+        """
+        Fetches a reservation from the Apaleo API, with retries, without its guest.
+        Returns None if the reservation could not be fetched or does not belong to this hotel.
+        Raises DeadlineExceeded if the deadline passed before it was fetched.
+        """
+        return self._reservation_or_none(self._fetch_outcome(reservation_id, deadline))
+
+    async def afetch_reservation(
+        self, reservation_id: str, deadline: Optional[Deadline] = None
+    ) -> Optional[StayDetails]:
+        return self._reservation_or_none(await self._afetch_outcome(reservation_id, deadline))
+
+    def fetch_guest(self, guest_id: str, deadline: Optional[Deadline] = None) -> Optional[GuestDetails]:
+        """
+        Fetches a guest from the Apaleo API, with retries.
+        """
         try:
-            payload_json = json.loads(payload)
-        except json.JSONDecodeError:
-            logger.error("Failed to parse payload as JSON.")
+            return self._convert_guest(guest_id, self.call_api(get_guest_details, guest_id, deadline=deadline))
+        except APIError as e:
+            logger.error(f"Failed to fetch guest {guest_id}: {e}")
             return None
 
-        pms_hotel_id: Optional[str] = payload_json.get("HotelId")
+    async def afetch_guest(self, guest_id: str, deadline: Optional[Deadline] = None) -> Optional[GuestDetails]:
         try:
-            if not pms_hotel_id:
-                raise ValueError("Invalid pms_hotel_id: None")
-            uuid.UUID(pms_hotel_id)  # Validate UUID
-        except (ValueError, TypeError) as e:
-            logger.error(f"Invalid pms_hotel_id: {pms_hotel_id} - {e}")
+            raw = await self.acall_api(aget_guest_details, guest_id, deadline=deadline)
+        except APIError as e:
+            logger.error(f"Failed to fetch guest {guest_id}: {e}")
             return None
+        return self._convert_guest(guest_id, raw)
 
-        events = {}
-        for event in payload_json.get("Events", []):
-            name = event.get("Name")
-            reservation_id = event.get("Value", {}).get("ReservationId")
-            if not reservation_id:  # Ensure ReservationId exists
-                logger.warning(f"Skipping event with missing reservation_id: {event}")
-                continue
-            if name not in events:
-                events[name] = []
-            events[name].append(reservation_id)
+    def fetch_reservations_for_checkin_date(self, checkin_date: datetime.date) -> Dict[str, List[StayDetails]]:
+        """
+        Fetches the reservations that check in on the given date, with retries, by the PMS hotel id they belong to.
+        Reservations that can not be converted are skipped.
+        """
+        reservations = json.loads(
+            self.call_pms_api(get_reservations_for_given_checkin_date, checkin_date.strftime("%Y-%m-%d"))
+        )
+        stays: Dict[str, List[StayDetails]] = {}
+        for reservation in reservations:
+            try:
+                stays.setdefault(reservation["HotelId"], []).append(ApaleoStayDetailsAdapter(reservation).convert())
+            except (ValueError, KeyError, ValidationError) as e:
+                logger.error(f"Skipping invalid reservation {reservation.get('ReservationId')}: {e}")
+        return stays
+
+    def _fetch_outcome(self, reservation_id: str, deadline: Optional[Deadline]) -> FetchOutcome:
+        try:
+            raw = self.call_api(get_reservation_details, reservation_id, deadline=deadline)
+        except APIError as e:
+            return self._fetch_failed(reservation_id, e)
+        return self._convert_reservation(reservation_id, raw)
+
+    async def _afetch_outcome(self, reservation_id: str, deadline: Optional[Deadline]) -> FetchOutcome:
+        try:
+            raw = await self.acall_api(aget_reservation_details, reservation_id, deadline=deadline)
+        except APIError as e:
+            return self._fetch_failed(reservation_id, e)
+        return self._convert_reservation(reservation_id, raw)
+
+    @staticmethod
+    def _fetch_failed(reservation_id: str, error: APIError) -> APIError:
+        if not isinstance(error, DeadlineExceeded):
+            logger.error(f"Failed to fetch reservation {reservation_id}: {error}")
+        return error
+
+    @staticmethod
+    def _reservation_or_none(outcome: FetchOutcome) -> Optional[StayDetails]:
+        if isinstance(outcome, DeadlineExceeded):
+            raise outcome
+        return None if isinstance(outcome, APIError) else outcome
 
+    def _convert_reservation(self, reservation_id: str, raw: str) -> Optional[StayDetails]:
         try:
-            hotel = Hotel.objects.get(pms_hotel_id=pms_hotel_id, pms=Hotel.PMS.APALEO)
-            logger.info(f"Hotel found: {hotel.name} (id={hotel.id})")
-            return CleanedWebhookPayload(hotel_id=hotel.id, data=events)
-        except Hotel.DoesNotExist:
-            logger.error(f"Hotel with pms_hotel_id {pms_hotel_id} not found.")
+            reservation = json.loads(raw)
+            if reservation.get("HotelId") != self.hotel.pms_hotel_id:
+                logger.error(f"Reservation {reservation_id} does not belong to hotel {self.hotel.id}.")
+                return None
+            return ApaleoStayDetailsAdapter(reservation).convert()
+        except (ValueError, KeyError, ValidationError) as e:
+            logger.error(f"Invalid reservation {reservation_id}: {e}")
             return None
 
-    def handle_webhook(self, webhook_data: dict) -> bool:
-        return False
\ No newline at end of file
+    @staticmethod
+    def _convert_guest(guest_id: str, raw: str) -> Optional[GuestDetails]:
+        try:
+            return ApaleoGuestDetailsAdapter(json.loads(raw)).convert()
+        except (ValueError, KeyError, ValidationError) as e:
+            logger.error(f"Invalid guest {guest_id}: {e}")
+            return None
+
+    @staticmethod
+    def _reservation_ids(webhook_data: dict) -> List[str]:
+        # A reservation only needs to be fetched once, whatever events it was mentioned in.
+        return list(dict.fromkeys(
+            reservation_id for reservation_ids in webhook_data["data"].values() for reservation_id in reservation_ids
+        ))
+
+    @staticmethod
+    def _collect(
+        reservation_ids: List[str],
+        outcomes: List[FetchOutcome],
+        guests: Dict[str, GuestDetails],
+        deadline: Optional[Deadline],
+    ) -> Tuple[List[StayDetails], WebhookResult]:
+        """
+        Returns the fetched stays with their guest, and the outcome of every reservation.
+        Stays whose guest is missing are deferred if the deadline has passed, and failed otherwise.
+        Reservations that failed on an API error get an error, so they can be replayed later.
+        """
+        stays, result = [], WebhookResult()
+        for reservation_id, outcome in zip(reservation_ids, outcomes):
+            if isinstance(outcome, DeadlineExceeded):
+                result.deferred.append(reservation_id)
+                continue
+            if isinstance(outcome, APIError):
+                result.failed.append(reservation_id)
+                result.errors[reservation_id] = f"Failed to fetch the reservation: {outcome}"
+                continue
+            if outcome is None:
+                result.failed.append(reservation_id)
+                continue
+            if outcome.pms_guest_id:
+                if outcome.pms_guest_id not in guests:
+                    if deadline and deadline.expired:
+                        result.deferred.append(reservation_id)
+                    else:
+                        result.failed.append(reservation_id)
+                        result.errors[reservation_id] = f"Failed to fetch guest {outcome.pms_guest_id}."
+                    continue
+                outcome.guest = guests[outcome.pms_guest_id]
+            stays.append(outcome)
+            result.processed.append(reservation_id)
+        return stays, result
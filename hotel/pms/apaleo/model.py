@@ -1,4 +1,39 @@
-from hotel.pms.model import UpsellProductAdapter, UpsellProduct
+from hotel.models import Language, Stay
+from hotel.pms.model import (
+    AVAILABILITY_MODES,
+    PRICING_UNITS,
+    GuestDetails,
+    GuestDetailsAdapter,
+    StayDetails,
+    StayDetailsAdapter,
+    UpsellProduct,
+    UpsellProductAdapter,
+    offered_days,
+    product_type,
+)
+from hotel.pms.phone import normalize_phone
+
+APALEO_STAY_STATUSES = {
+    "booked": Stay.Status.BEFORE,
+    "not_confirmed": Stay.Status.BEFORE,
+    "in_house": Stay.Status.INSTAY,
+    "checked_out": Stay.Status.AFTER,
+    "cancelled": Stay.Status.CANCEL,
+    "no_show": Stay.Status.CANCEL,
+}
+
+APALEO_COUNTRY_LANGUAGES = {
+    "DE": Language.GERMAN,
+    "GB": Language.BRITISH_ENGLISH,
+    "GG": Language.BRITISH_ENGLISH,
+    "ES": Language.SPANISH_SPAIN,
+    "FR": Language.FRENCH,
+    "IT": Language.ITALIAN,
+    "NL": Language.DUTCH,
+    "PT": Language.PORTUGUESE_PORTUGAL,
+    "SE": Language.SWEDISH,
+    "DK": Language.DANISH,
+}
 
 
 # --- Apaleo Adapter Implementation ---
@@ -13,20 +48,48 @@ class ApaleoUpsellProductAdapter(UpsellProductAdapter):
         currency = default_price.get("currency")
         price_str = f"{amount} {currency}"
 
-        # Manually build the dictionary
-        product_dict = {}
-        product_dict["id"] = self.raw_data.get("id", "")
-        product_dict["name"] = self.raw_data.get("name", "")
-        product_dict["code"] = self.raw_data.get("code", "")
-        product_dict["description"] = self.raw_data.get("description", "")
-        product_dict["price"] = price_str
-        product_dict["age_category"] = self.raw_data.get("ageCategoryId", "")
-
+        availability = self.raw_data.get("availability", {})
         return UpsellProduct(
             id=self.raw_data.get("id"),
             name=self.raw_data.get("name"),
             code=self.raw_data.get("code"),
             description=self.raw_data.get("description"),
             price=price_str,
-            age_category=self.raw_data.get("ageCategoryId", "")
-        )
\ No newline at end of file
+            age_category=self.raw_data.get("ageCategoryId", ""),
+            type=product_type(self.raw_data.get("name")),
+            per_whom=PRICING_UNITS.get(self.raw_data.get("pricingUnit"), "GUEST"),
+            availability_when=AVAILABILITY_MODES.get(availability.get("mode"), "ENTIRE_STAY"),
+            offered_days=offered_days(availability.get("daysOfWeek")),
+        )
+
+
+# --- Apaleo Reservation Adapters ---
+class ApaleoStayDetailsAdapter(StayDetailsAdapter):
+    """
+    Adapter for converting Apaleo reservation details to the unified StayDetails model.
+    """
+    def convert(self) -> StayDetails:
+        return StayDetails(
+            pms_reservation_id=self.raw_data["ReservationId"],
+            pms_guest_id=self.raw_data.get("GuestId") or None,
+            status=APALEO_STAY_STATUSES.get(self.raw_data.get("Status"), Stay.Status.UNKNOWN),
+            checkin=self.raw_data.get("CheckInDate") or None,
+            checkout=self.raw_data.get("CheckOutDate") or None,
+        )
+
+
+class ApaleoGuestDetailsAdapter(GuestDetailsAdapter):
+    """
+    Adapter for converting Apaleo guest details to the unified GuestDetails model.
+    Phone numbers are normalized to E.164, placeholders like "Not available" or "123" that can not
+    identify a guest are dropped.
+    """
+    def convert(self) -> GuestDetails:
+        country = self.raw_data.get("Country") or None
+        return GuestDetails(
+            pms_guest_id=self.raw_data["GuestId"],
+            name=self.raw_data.get("Name") or "",
+            phone=normalize_phone(self.raw_data.get("Phone"), country),
+            language=APALEO_COUNTRY_LANGUAGES.get(country),
+            country=country,
+        )
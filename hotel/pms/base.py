@@ -1,13 +1,27 @@
+import asyncio
+import datetime
 import importlib
 import inspect
 import logging
 import pkgutil
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
 from abc import ABC, abstractmethod
-from typing import Optional, Type, TypedDict, Dict, Any, List
+from typing import Optional, Type, TypedDict, Dict, Any, List, Callable, TypeVar, Union, Awaitable, Iterable
 
-from django.db import transaction
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from pydantic_core import ValidationError
 
-from hotel.models import Hotel, UpsellProduct
+from hotel.models import Hotel
+from hotel.pms.cache import guest_cache, hotel_cache
+from hotel.pms.catalog import UpsellProductSpec
+from hotel.pms.model import GuestDetails, StayDetails, UpsellProduct
+from hotel.pms.payload import PayloadError, PayloadReader, decode_body
+from hotel.pms.resilience import Deadline, acall_with_resilience, call_with_resilience
+from hotel.pms.schema import WebhookSchema
+from hotel.pms.sync import SyncResult, sync_reservations
+from hotel.pms.upsert import StayUpsertResult, UpsellProductUpsertResult, upsert_stays, upsert_upsell_products
 
 
 class CleanedWebhookPayload(TypedDict):
@@ -15,14 +29,52 @@ class CleanedWebhookPayload(TypedDict):
     data: dict
 
 
+@dataclass
+class WebhookResult:
+    """
+    The reservation ids of a webhook by outcome: saved, deferred because the deadline passed, or failed.
+    Skipped are the reservations that were not written because they did not change, or because the PMS
+    provider does not support fetching them.
+    Errors are the API errors by failed reservation id, for the failures that are worth retrying.
+    It is truthy when every reservation was processed.
+    """
+
+    processed: List[str] = field(default_factory=list)
+    deferred: List[str] = field(default_factory=list)
+    failed: List[str] = field(default_factory=list)
+    skipped: List[str] = field(default_factory=list)
+    errors: Dict[str, str] = field(default_factory=dict)
+
+    def __bool__(self) -> bool:
+        return not self.deferred and not self.failed
+
+
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+
+# PMS classes by lowercased class name, filled by register_pms.
+_registry: Dict[str, Type["PMSProvider"]] = {}
+
 
 class PMSProvider(ABC):
     """
     Abstract class for Property Management Systems.
     """
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if not inspect.isabstract(cls):
+            register_pms(cls)
+
+    # The Hotel.PMS value of the hotels that use this PMS.
+    hotel_pms: Optional[str] = None
+    # Where the hotel id and the reservation events are in the webhook payloads of this PMS.
+    webhook_schema: WebhookSchema = WebhookSchema()
+    # Where the fields of the unified UpsellProduct are in the upsell products of this PMS.
+    upsell_product_spec: UpsellProductSpec = UpsellProductSpec()
+
     def __init__(self, hotel: Hotel):
         assert hotel is not None
 
@@ -32,19 +84,117 @@ class PMSProvider(ABC):
     def name(self):
         return self.__class__.__name__
 
+    def call_api(
+        self,
+        func: Callable[..., T],
+        *args,
+        deadline: Optional[Deadline] = None,
+        rate_limit_timeout: Optional[float] = None,
+    ) -> T:
+        """
+        Calls a PMS API function with the rate limits, retries and the circuit breakers of this PMS and hotel.
+        Raises an APIError if the call did not succeed, DeadlineExceeded if the deadline passed and
+        RateLimitExceeded if there was no rate limit token within rate_limit_timeout (0 to not wait).
+        """
+        return call_with_resilience(
+            func,
+            *args,
+            pms_name=self.name,
+            hotel_id=self.hotel.id,
+            deadline=deadline,
+            rate_limit_timeout=rate_limit_timeout,
+        )
+
+    def call_pms_api(
+        self,
+        func: Callable[..., T],
+        *args,
+        deadline: Optional[Deadline] = None,
+        rate_limit_timeout: Optional[float] = None,
+    ) -> T:
+        """
+        Variant of call_api for calls that are not made for this hotel, such as fetches across all hotels on the PMS.
+        Only the rate limits and the circuit breaker of the PMS apply, so these calls do not use up the rate limit
+        of this hotel or open its circuit breaker.
+        """
+        return call_with_resilience(
+            func,
+            *args,
+            pms_name=self.name,
+            deadline=deadline,
+            rate_limit_timeout=rate_limit_timeout,
+        )
+
+    async def acall_api(
+        self,
+        func: Callable[..., Awaitable[T]],
+        *args,
+        deadline: Optional[Deadline] = None,
+        rate_limit_timeout: Optional[float] = None,
+    ) -> T:
+        """
+        Async variant of call_api for the async PMS API functions.
+        """
+        return await acall_with_resilience(
+            func,
+            *args,
+            pms_name=self.name,
+            hotel_id=self.hotel.id,
+            deadline=deadline,
+            rate_limit_timeout=rate_limit_timeout,
+        )
+
     @classmethod
-    def clean_webhook_payload(cls, payload: str) -> Optional[CleanedWebhookPayload]:
+    def clean_webhook_payload(cls, payload: Union[str, bytes], content_encoding: Optional[str] = None) \
+            -> Optional[CleanedWebhookPayload]:
         """
         This method returns a CleanedWebhookPayload object containing a hotel_id from the payload and the data as a dict in the data field
         It should return None if the payload is invalid or the hotel is not found.
+
+        The default implementation reads the hotel id and resolves it to a hotel of cls.hotel_pms before the
+        rest of the payload is looked at, then validates the payload in a single pass with the compiled
+        cls.webhook_schema. Gzip encoded payloads are accepted.
         """
-        raise NotImplementedError
+        if not payload:  # Check for empty or invalid payload early
+            logger.error("Payload is missing or empty.")
+            return None
+
+        try:
+            text = decode_body(payload, content_encoding)
+            pms_hotel_id = PayloadReader(text).get(cls.webhook_schema.hotel_id_key)
+        except PayloadError as e:
+            logger.error(f"Failed to read payload: {e}")
+            return None
+
+        try:
+            cls.webhook_schema.validate_hotel_id(pms_hotel_id)
+        except ValidationError as e:
+            logger.error(f"Invalid pms_hotel_id: {pms_hotel_id} - {e}")
+            return None
+
+        hotel = hotel_cache.get_by_pms_hotel_id(cls.hotel_pms, pms_hotel_id)
+        if hotel is None:
+            logger.error(f"Hotel with pms_hotel_id {pms_hotel_id} not found.")
+            return None
+
+        try:
+            events, skipped = cls.webhook_schema.validate(text, max_events=settings.WEBHOOK_MAX_EVENTS)
+        except (PayloadError, ValidationError) as e:
+            logger.error(f"Invalid payload for hotel {hotel.id}: {e}")
+            return None
+        if skipped:
+            logger.warning(f"Skipped {skipped} events with missing reservation_id for hotel {hotel.id}.")
+
+        logger.info(f"Hotel found: {hotel.name} (id={hotel.id})")
+        return CleanedWebhookPayload(hotel_id=hotel.id, data=events)
 
     @abstractmethod
-    def handle_webhook(self, webhook_data: dict) -> bool:
+    def handle_webhook(self, webhook_data: dict, deadline: Optional[Deadline] = None) -> WebhookResult:
         """
         This method is called when we receive a webhook from the PMS.
         Handle webhook handles the events and updates relevant models in the database.
+        Every PMS API call gets the deadline, reservations that could not be fetched before it
+        passed are returned as deferred.
         Requirements:
             - Now that the PMS has notified you about an update of a reservation, you need to
                 get more details of this reservation. For this, you can use the mock API
@@ -55,6 +205,92 @@ class PMSProvider(ABC):
         """
         raise NotImplementedError
 
+    async def ahandle_webhook(self, webhook_data: dict, deadline: Optional[Deadline] = None) -> WebhookResult:
+        """
+        Async variant of handle_webhook. PMSes with an async API override it to keep their calls
+        on the event loop, by default handle_webhook runs in a thread.
+        """
+        return await sync_to_async(self.handle_webhook)(webhook_data, deadline)
+
+    def save_stays(self, stays: List[StayDetails]) -> StayUpsertResult:
+        """
+        Writes the fetched reservations of this hotel to the database in one set-based upsert.
+        Guests without a usable phone number are not stored, their stay is saved without a guest.
+        """
+        return upsert_stays(self.hotel, stays)
+
+    async def asave_stays(self, stays: List[StayDetails]) -> StayUpsertResult:
+        # The upsert runs in a transaction, which the async ORM does not support.
+        return await sync_to_async(self.save_stays)(stays)
+
+    def fetch_guest(self, guest_id: str, deadline: Optional[Deadline] = None) -> Optional[GuestDetails]:
+        """
+        Fetches the details of a guest from the PMS API, returns None if they could not be fetched
+        before the deadline. Called from worker threads, so it must not use the database.
+        """
+        raise NotImplementedError(f"{self.name} does not support fetching guests.")
+
+    def fetch_guests(self, guest_ids: List[str], deadline: Optional[Deadline] = None) -> Dict[str, GuestDetails]:
+        """
+        Returns the details of the given guests by PMS guest id, from the shared guest cache where possible.
+        The others are fetched concurrently with fetch_guest and cached, guests that could not be fetched before
+        the deadline are left out.
+        """
+        guest_ids = list(dict.fromkeys(guest_ids))
+        guests = guest_cache.get_many(self.name, guest_ids)
+        missing = [guest_id for guest_id in guest_ids if guest_id not in guests]
+        if not missing:
+            return guests
+
+        max_workers = min(self.hotel.max_concurrent_fetches, len(missing))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(self.fetch_guest, missing, [deadline] * len(missing))
+            fetched = {guest_id: guest for guest_id, guest in zip(missing, results) if guest is not None}
+        # The guest cache is in the database, so it is only used from this thread.
+        guest_cache.set_many(self.name, fetched)
+        guests.update(fetched)
+        return guests
+
+    async def afetch_guest(self, guest_id: str, deadline: Optional[Deadline] = None) -> Optional[GuestDetails]:
+        """
+        Async variant of fetch_guest, by default fetch_guest runs in a thread.
+        """
+        return await sync_to_async(self.fetch_guest, thread_sensitive=False)(guest_id, deadline)
+
+    async def afetch_guests(
+        self, guest_ids: List[str], deadline: Optional[Deadline] = None
+    ) -> Dict[str, GuestDetails]:
+        """
+        Async variant of fetch_guests, at most hotel.max_concurrent_fetches guests are fetched at a time.
+        """
+        guest_ids = list(dict.fromkeys(guest_ids))
+        guests = await guest_cache.aget_many(self.name, guest_ids)
+        missing = [guest_id for guest_id in guest_ids if guest_id not in guests]
+        if not missing:
+            return guests
+
+        results = await gather_bounded(
+            self.hotel.max_concurrent_fetches, lambda guest_id: self.afetch_guest(guest_id, deadline), missing
+        )
+        fetched = {guest_id: guest for guest_id, guest in zip(missing, results) if guest is not None}
+        await guest_cache.aset_many(self.name, fetched)
+        guests.update(fetched)
+        return guests
+
+    def fetch_reservations_for_checkin_date(self, checkin_date: datetime.date) -> Dict[str, List[StayDetails]]:
+        """
+        Fetches the reservations of every hotel on this PMS that check in on the given date, without their guest
+        details, by PMS hotel id, with call_pms_api. Raises an APIError if they could not be fetched.
+        Only PMSes that support reconciliation by check-in date implement this.
+        """
+        raise NotImplementedError(f"{self.name} does not support syncing reservations.")
+
+    def sync_reservations(self, dates: List[datetime.date]) -> SyncResult:
+        """
+        Reconciles the stays of this hotel with the PMS for the given check-in dates, for webhooks that were missed.
+        """
+        return sync_reservations([self], dates)[self.hotel.id]
+
     def get_upsell_products(self):
         """
         Template method for fetching, processing, and saving upsell products.
@@ -62,61 +298,20 @@ class PMSProvider(ABC):
         The workflow is:
             1. Retrieve the raw upsell products from the PMS API.
             2. Parse the JSON response into a list of product models.
-            3. (Optionally) Compare with the existing records and decide whether to update.
-            4. Bulk save the products into the database.
+            3. Compare them with the stored products of the hotel and save only what changed.
+        If the products could not be retrieved, the stored ones are left as they are.
         """
 
         products: List[UpsellProduct] = self.retrieve_products_api()
-        # saved_products = self.bulk_upsert(products)
+        if products is not None:
+            self.bulk_upsert(products)
         return products
 
-    def bulk_upsert(self, products: List[UpsellProduct]) -> bool:
-        """
-        Performs a bulk upsert on PMSRecord objects.
-
-        :param products: A list of dictionaries, where each dictionary contains the fields
-         for a PMSRecord instance. Each dictionary must include a unique key,
-         e.g., 'external_id', used to identify existing records.
-        """
-        if not products:
-            return  # Nothing to do
-
-        # 1. Extract the list of unique identifiers from the incoming data.
-        pms_ids = [product.pms_id for product in products]
-
-        # 2. Retrieve any existing records from the database that have these unique ids.
-        existing_records = UpsellProduct.objects.filter(pms_id__in=pms_ids)
-
-        # 3. Build a lookup dict for fast access.
-        existing_lookup = {record.pms_id: record for record in existing_records}
-
-        # Prepare lists for records that need to be created or updated.
-        records_to_create = []
-        records_to_update = []
-
-        # 4. Process each incoming record.
-        for record_data in products:
-            ext_id = record_data['external_id']
-            if ext_id in existing_lookup:
-                # Found an existing record – update its fields.
-                record = existing_lookup[ext_id]
-                # Loop over the keys to update the record.
-                # (Optionally, skip fields that should not be updated.)
-                for key, value in record_data.items():
-                    setattr(record, key, value)
-                records_to_update.append(record)
-            else:
-                # No record exists – create a new instance.
-                records_to_create.append(UpsellProduct(**record_data))
-
-        with transaction.atomic():
-            if records_to_create:
-                UpsellProduct.objects.bulk_create(records_to_create)
-            if records_to_update:
-                update_fields = [
-                    field for field in products[0].keys() if field != "pms_id"
-                ]
-                UpsellProduct.objects.bulk_update(records_to_update, update_fields)
+    def bulk_upsert(self, products: List[UpsellProduct]) -> UpsellProductUpsertResult:
+        """
+        Saves the upsell catalog of the hotel, see upsert_upsell_products.
+        """
+        return upsert_upsell_products(self.hotel, products)
 
     @abstractmethod
     def retrieve_products_api(self) -> List[UpsellProduct]:
@@ -126,25 +321,60 @@ class PMSProvider(ABC):
         """
         pass
 
-def get_pms(name: str) -> Type[PMSProvider]:
+    async def aretrieve_products_api(self) -> Optional[List[UpsellProduct]]:
+        """
+        Async variant of retrieve_products_api, by default retrieve_products_api runs in a thread.
+        """
+        return await sync_to_async(self.retrieve_products_api, thread_sensitive=False)()
+
+
+async def gather_bounded(limit: int, func: Callable[..., Awaitable[T]], items: Iterable) -> List[T]:
     """
-    This function returns the PMS class for the given name.
-    This does not return an instance of the class, but the class itself.
-    Note, that the name should be the same as the class name without the 'PMS_' prefix.
+    Awaits func(item) for all items concurrently, at most `limit` at a time, and returns the results in order.
     """
-    assert name.isalpha()
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(item):
+        async with semaphore:
+            return await func(item)
+
+    return await asyncio.gather(*(run(item) for item in items))
+
+
+class UnknownPMSError(ValueError):
+    pass
+
+
+def register_pms(pms_cls: Type[PMSProvider]) -> Type[PMSProvider]:
+    """
+    Registers a PMS class under its lowercased class name, so get_pms can find it.
+    Concrete subclasses of PMSProvider are registered automatically when their module is imported.
+    """
+    name = pms_cls.__name__.lower()
+    registered = _registry.get(name)
+    if registered is not None and registered is not pms_cls:
+        raise ValueError(f"Two PMS classes are named {pms_cls.__name__}: {registered} and {pms_cls}")
+    _registry[name] = pms_cls
+    return pms_cls
 
-    fullname = name.lower()
-    # all new task managers should be included here
-    base_module = "hotel.pms"
 
+def autodiscover_pms() -> None:
+    """
+    Imports every module under hotel.pms, which registers all PMS classes.
+    This is called once from HotelConfig.ready.
+    """
+    base_module = "hotel.pms"
     for finder, module_name, is_pkg in pkgutil.walk_packages(importlib.import_module(base_module).__path__, base_module + "."):
-        module = importlib.import_module(module_name)
+        importlib.import_module(module_name)
 
-        for name, obj in inspect.getmembers(module, inspect.isclass):
-            # Check if the class matches the name and inherits from TaskManagerProvider
-            if name.lower() == fullname and issubclass(obj, PMSProvider) and obj is not PMSProvider:
-                return obj
 
-    # Raise an error if no matching class is found
-    raise ValueError(f"No such TaskManagerProvider class: {fullname}")
\ No newline at end of file
+def get_pms(name: str) -> Type[PMSProvider]:
+    """
+    This function returns the PMS class for the given name.
+    This does not return an instance of the class, but the class itself.
+    Note, that the name should be the same as the class name, the lookup is case-insensitive.
+    """
+    try:
+        return _registry[name.lower()]
+    except KeyError:
+        raise UnknownPMSError(f"No such PMS: {name}. Available PMSes: {', '.join(sorted(_registry))}") from None
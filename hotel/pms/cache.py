@@ -0,0 +1,360 @@
+import copy
+import datetime
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.db import connections
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from hotel.models import CachedGuestDetails, Hotel, UpsellProduct
+from hotel.pms.model import GuestDetails, UpsellProduct as UpsellProductDetails
+
+"""
+Caches in front of the database and the PMS APIs.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class HotelCache:
+    """
+    Bounded LRU cache of hotels, by id and by (pms, pms_hotel_id), used to route webhooks.
+    Entries are invalidated when a hotel is saved or deleted in this process, and expire after
+    `ttl` seconds so that changes made by other processes are picked up as well.
+    Callers get a copy of the cached hotel, so they can not change the cached instance.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, hotel_id: int) -> Hotel:
+        """
+        Returns the hotel with the given id, raises Hotel.DoesNotExist if there is none.
+        """
+        return self._get(("id", hotel_id), lambda: Hotel.objects.get(id=hotel_id))
+
+    def get_by_pms_hotel_id(self, pms: str, pms_hotel_id: str) -> Optional[Hotel]:
+        """
+        Returns the hotel with the given PMS and PMS hotel id, or None if there is none.
+        """
+        try:
+            return self._get(
+                ("pms", pms, pms_hotel_id), lambda: Hotel.objects.get(pms=pms, pms_hotel_id=pms_hotel_id)
+            )
+        except Hotel.DoesNotExist:
+            return None
+
+    def invalidate(self, hotel: Hotel) -> None:
+        with self._lock:
+            for key in [key for key, (cached, _) in self._entries.items() if cached.id == hotel.id]:
+                del self._entries[key]
+            self._entries.pop(("pms", hotel.pms, hotel.pms_hotel_id), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def _get(self, key: Hashable, load) -> Hotel:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.copy(entry[0])
+            self.misses += 1
+
+        hotel = load()
+        with self._lock:
+            self._entries[key] = (hotel, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return copy.copy(hotel)
+
+
+class GuestDetailsCache:
+    """
+    Guest details by PMS and PMS guest id, stored in the database so all worker processes share them.
+    Entries expire after `ttl` seconds, and the entries that expire first are evicted once there are
+    more than `max_entries`. Evicting takes a count of the whole table, so every process does it at most
+    once per `cull_interval` seconds when entries are set. The hit and miss counters are kept per process.
+    """
+
+    # bulk_create arguments that update the entries that are cached already.
+    _UPSERT = {
+        "update_conflicts": True,
+        "unique_fields": ["pms_name", "pms_guest_id"],
+        "update_fields": ["details", "expires_at"],
+    }
+
+    def __init__(self, ttl: float, max_entries: int, cull_interval: float = 0.0) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cull_interval = cull_interval
+        self.hits = 0
+        self.misses = 0
+        self._culled_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def get_many(self, pms_name: str, guest_ids: Iterable[str]) -> Dict[str, GuestDetails]:
+        """
+        Returns the cached guest details of the given guests that did not expire, in one query.
+        """
+        guest_ids = set(guest_ids)
+        if not guest_ids:
+            return {}
+        return self._hit(guest_ids, list(self._lookup(pms_name, guest_ids)))
+
+    async def aget_many(self, pms_name: str, guest_ids: Iterable[str]) -> Dict[str, GuestDetails]:
+        guest_ids = set(guest_ids)
+        if not guest_ids:
+            return {}
+        return self._hit(guest_ids, [row async for row in self._lookup(pms_name, guest_ids)])
+
+    def set_many(self, pms_name: str, guests: Dict[str, GuestDetails]) -> None:
+        """
+        Caches the given guest details in one upsert, then evicts expired and surplus entries.
+        """
+        if guests:
+            CachedGuestDetails.objects.bulk_create(self._entries(pms_name, guests), **self._UPSERT)
+            if self._cull_due():
+                self.cull()
+
+    async def aset_many(self, pms_name: str, guests: Dict[str, GuestDetails]) -> None:
+        if guests:
+            await CachedGuestDetails.objects.abulk_create(self._entries(pms_name, guests), **self._UPSERT)
+            if self._cull_due():
+                await self.acull()
+
+    def cull(self) -> None:
+        CachedGuestDetails.objects.filter(expires_at__lte=timezone.now()).delete()
+        surplus = CachedGuestDetails.objects.count() - self.max_entries
+        if surplus > 0:
+            CachedGuestDetails.objects.filter(id__in=list(self._oldest(surplus))).delete()
+
+    async def acull(self) -> None:
+        await CachedGuestDetails.objects.filter(expires_at__lte=timezone.now()).adelete()
+        surplus = await CachedGuestDetails.objects.acount() - self.max_entries
+        if surplus > 0:
+            oldest = [entry_id async for entry_id in self._oldest(surplus)]
+            await CachedGuestDetails.objects.filter(id__in=oldest).adelete()
+
+    def clear(self) -> None:
+        CachedGuestDetails.objects.all().delete()
+        with self._lock:
+            self.hits = self.misses = 0
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    def _cull_due(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if self._culled_at is not None and now - self._culled_at < self.cull_interval:
+                return False
+            self._culled_at = now
+            return True
+
+    @staticmethod
+    def _lookup(pms_name: str, guest_ids: Set[str]):
+        return CachedGuestDetails.objects.filter(
+            pms_name=pms_name, pms_guest_id__in=guest_ids, expires_at__gt=timezone.now()
+        ).values_list("pms_guest_id", "details")
+
+    def _hit(self, guest_ids: Set[str], rows: List[Tuple[str, dict]]) -> Dict[str, GuestDetails]:
+        guests = {guest_id: GuestDetails.model_validate(details) for guest_id, details in rows}
+        with self._lock:
+            self.hits += len(guests)
+            self.misses += len(guest_ids) - len(guests)
+        return guests
+
+    def _entries(self, pms_name: str, guests: Dict[str, GuestDetails]) -> List[CachedGuestDetails]:
+        expires_at = timezone.now() + datetime.timedelta(seconds=self.ttl)
+        return [
+            CachedGuestDetails(
+                pms_name=pms_name, pms_guest_id=guest_id, details=guest.model_dump(mode="json"), expires_at=expires_at
+            )
+            for guest_id, guest in guests.items()
+        ]
+
+    @staticmethod
+    def _oldest(count: int):
+        return CachedGuestDetails.objects.order_by("expires_at", "id").values_list("id", flat=True)[:count]
+
+
+@dataclass(frozen=True)
+class UpsellCatalog:
+    products: Tuple[UpsellProductDetails, ...]
+    # A strong ETag of the products, which is the same for the same catalog in every process.
+    etag: str
+
+    @classmethod
+    def from_products(cls, products: Iterable[UpsellProductDetails]) -> "UpsellCatalog":
+        products = tuple(products)
+        digest = hashlib.blake2b(digest_size=16)
+        for product in products:
+            digest.update(product.model_dump_json().encode())
+        return cls(products, digest.hexdigest())
+
+
+class UpsellCatalogCache:
+    """
+    Bounded LRU cache of the upsell catalogs of hotels, as returned by PMSProvider.get_upsell_products.
+    A catalog is served for `ttl` seconds. For `max_stale` seconds after that it is still served right away,
+    while a single background refresh fetches it again. Concurrent misses for a hotel wait for one fetch.
+    If a catalog can not be fetched, the products that were last saved for the hotel are served instead.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, max_stale: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        # The catalog and the time it expires at, by hotel id.
+        self._entries: "OrderedDict[int, Tuple[UpsellCatalog, float]]" = OrderedDict()
+        # The running fetches by hotel id, which resolve to the fetched catalog or None.
+        self._fetches: Dict[int, Future] = {}
+        self._lock = threading.Lock()
+
+    def get(self, hotel: Hotel) -> List[UpsellProductDetails]:
+        return list(self.get_catalog(hotel).products)
+
+    def get_catalog(self, hotel: Hotel) -> UpsellCatalog:
+        refresh = None
+        with self._lock:
+            entry = self._entries.get(hotel.id)
+            now = time.monotonic()
+            if entry is not None and now < entry[1] + self.max_stale:
+                self._entries.move_to_end(hotel.id)
+                if now < entry[1]:
+                    self.hits += 1
+                else:
+                    self.stale_hits += 1
+                    if hotel.id not in self._fetches:
+                        refresh = self._fetches[hotel.id] = Future()
+                if refresh is None:
+                    return entry[0]
+            else:
+                self.misses += 1
+                fetch = self._fetches.get(hotel.id)
+                leader = fetch is None
+                if leader:
+                    fetch = self._fetches[hotel.id] = Future()
+
+        if refresh is not None:
+            _spawn_refresh(self._fetch, hotel, refresh)
+            return entry[0]
+        if leader:
+            self._fetch(hotel, fetch)
+        catalog = fetch.result()
+        return UpsellCatalog.from_products(self.persisted(hotel)) if catalog is None else catalog
+
+    @staticmethod
+    def persisted(hotel: Hotel) -> List[UpsellProductDetails]:
+        """
+        Returns the bookable upsell products that were last saved for the hotel.
+        """
+        return [
+            UpsellProductDetails(
+                id=product.pms_id,
+                name=product.name,
+                code="",
+                description="",
+                price=f"{product.price} {product.currency}",
+                age_category="",
+                type=product.type,
+                per_whom=product.per_whom,
+                availability_when=product.availability_when,
+                offered_days=product.offered_days,
+            )
+            for product in UpsellProduct.objects.filter(hotel=hotel, is_bookable=True, pms_id__isnull=False)
+        ]
+
+    def invalidate(self, hotel_id: int) -> None:
+        with self._lock:
+            self._entries.pop(hotel_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.stale_hits = self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "stale_hits": self.stale_hits, "misses": self.misses, "size": len(self._entries)}
+
+    def _fetch(self, hotel: Hotel, fetch: Future) -> None:
+        catalog = None
+        try:
+            products = hotel.get_pms().get_upsell_products()
+            if products is not None:
+                catalog = UpsellCatalog.from_products(products)
+        except Exception:
+            logger.exception(f"Error fetching the upsell catalog of hotel {hotel.id}")
+        finally:
+            with self._lock:
+                # A stale catalog that could not be fetched again is kept, and served until it is too stale.
+                if catalog is not None:
+                    self._entries[hotel.id] = (catalog, time.monotonic() + self.ttl)
+                    self._entries.move_to_end(hotel.id)
+                    while len(self._entries) > self.maxsize:
+                        self._entries.popitem(last=False)
+                del self._fetches[hotel.id]
+            fetch.set_result(catalog)
+
+
+def _spawn_refresh(refresh: Callable[..., None], *args) -> None:
+    """
+    Runs refresh(*args) in a daemon thread, which closes its database connections when it is done.
+    """
+
+    def run() -> None:
+        try:
+            refresh(*args)
+        finally:
+            connections.close_all()
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+hotel_cache = HotelCache(maxsize=settings.HOTEL_CACHE_SIZE, ttl=settings.HOTEL_CACHE_TTL)
+guest_cache = GuestDetailsCache(
+    ttl=settings.PMS_GUEST_CACHE_TTL,
+    max_entries=settings.PMS_GUEST_CACHE_MAX_ENTRIES,
+    cull_interval=settings.PMS_GUEST_CACHE_CULL_INTERVAL,
+)
+upsell_catalog_cache = UpsellCatalogCache(
+    maxsize=settings.UPSELL_CATALOG_CACHE_SIZE,
+    ttl=settings.UPSELL_CATALOG_CACHE_TTL,
+    max_stale=settings.UPSELL_CATALOG_CACHE_MAX_STALE,
+)
+
+
+@receiver(post_save, sender=Hotel)
+@receiver(post_delete, sender=Hotel)
+def invalidate_hotel_cache(sender, instance: Hotel, **kwargs) -> None:
+    hotel_cache.invalidate(instance)
+    upsell_catalog_cache.invalidate(instance.id)
@@ -0,0 +1,82 @@
+import functools
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from pydantic import AliasPath, Field, TypeAdapter, create_model, field_validator
+
+from hotel.pms.model import AVAILABILITY_MODES, PRICING_UNITS, UpsellProduct, offered_days, product_type
+
+"""
+Declarative upsell product mappings.
+Every PMS describes where the fields of the unified UpsellProduct are in its upsell products. The mapping
+is compiled once into a pydantic model with validation aliases, and a whole catalog is validated in one pass.
+"""
+
+Path = Tuple[str, ...]
+
+
+@dataclass(frozen=True)
+class UpsellProductSpec:
+    id_path: Path = ("id",)
+    name_path: Path = ("name",)
+    code_path: Path = ("code",)
+    description_path: Path = ("description",)
+    # An object with the amount and the currency of the price.
+    price_path: Path = ("defaultGrossPrice",)
+    # The amount of a price without one.
+    default_amount: Optional[float] = None
+    age_category_path: Path = ("ageCategoryId",)
+    pricing_unit_path: Path = ("pricingUnit",)
+    # An object with the availability mode and the days of the week the product is offered on.
+    availability_path: Path = ("availability",)
+
+    def validate(self, products: list) -> List[UpsellProduct]:
+        """
+        Converts the upsell products of a PMS to unified UpsellProducts.
+        Raises a pydantic.ValidationError if any of them is invalid.
+        """
+        return _compile(self).validate_python(products)
+
+
+def _field(annotation, path: Path, **kwargs):
+    return annotation, Field(validation_alias=AliasPath(*path), **kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def _compile(spec: UpsellProductSpec) -> TypeAdapter:
+    """
+    Returns a validator of lists of upsell products, which are validated into a subclass of UpsellProduct.
+    """
+
+    def price(cls, value):
+        value = value or {}
+        return f"{value.get('amount', spec.default_amount)} {value.get('currency')}"
+
+    validators = {
+        "format_price": field_validator("price", mode="plain")(price),
+        "map_type": field_validator("type", mode="plain")(lambda cls, value: product_type(value)),
+        "map_per_whom": field_validator("per_whom", mode="plain")(
+            lambda cls, value: PRICING_UNITS.get(value, "GUEST")
+        ),
+        "map_availability_when": field_validator("availability_when", mode="plain")(
+            lambda cls, value: AVAILABILITY_MODES.get(value, "ENTIRE_STAY")
+        ),
+        "map_offered_days": field_validator("offered_days", mode="plain")(lambda cls, value: offered_days(value)),
+    }
+    model = create_model(
+        "CompiledUpsellProduct",
+        __base__=UpsellProduct,
+        __validators__=validators,
+        id=_field(str, spec.id_path),
+        name=_field(str, spec.name_path),
+        code=_field(str, spec.code_path),
+        description=_field(str, spec.description_path),
+        # Validated when it is missing as well, like a price of {}.
+        price=_field(str, spec.price_path, default=None, validate_default=True),
+        age_category=_field(str, spec.age_category_path, default=""),
+        type=_field(str, spec.name_path, default="OTHER"),
+        per_whom=_field(str, spec.pricing_unit_path, default="GUEST"),
+        availability_when=_field(str, (*spec.availability_path, "mode"), default="ENTIRE_STAY"),
+        offered_days=_field(List[str], (*spec.availability_path, "daysOfWeek"), default=[]),
+    )
+    return TypeAdapter(List[model])
@@ -1,68 +1,58 @@
-import json
 import logging
-import uuid
 from typing import Optional, List
 
-from hotel.external_api import get_guest_line_upsell_product
+from hotel.external_api import aget_guest_line_upsell_product, get_guest_line_upsell_product
 from hotel.models import Hotel, UpsellProduct
-from hotel.pms.base import CleanedWebhookPayload, PMSProvider
-from hotel.pms.guestline.model import GuestLineUpsellProductAdapter
+from hotel.pms.base import PMSProvider, WebhookResult
+from hotel.pms.catalog import UpsellProductSpec
+from hotel.pms.resilience import Deadline
+from hotel.pms.schema import WebhookSchema
 
 logger = logging.getLogger(__name__)
 
 
 class GuestLine(PMSProvider):
 
+    webhook_schema = WebhookSchema(
+        hotel_id_key="HotelId",
+        events_key="Events",
+        event_name_key="Name",
+        reservation_id_path=("Value", "ReservationId"),
+    )
+    upsell_product_spec = UpsellProductSpec(
+        price_path=("grossPrice",),
+        default_amount=0,
+        age_category_path=("ageCategory",),
+        pricing_unit_path=("unit",),
+    )
+    hotel_pms = Hotel.PMS.GUESTLINE
+
     def retrieve_products_api(self) -> Optional[List[UpsellProduct]]:
         try:
             data = get_guest_line_upsell_product()
             services = data.get("products", [])
-            products = [GuestLineUpsellProductAdapter(service).convert() for service in services]
+            products = self.upsell_product_spec.validate(services)
             return products
         except Exception as e:
             logger.error(f"Failed to retrieve upsell products: {e}")
             return None
 
-    @classmethod
-    def clean_webhook_payload(cls, payload: str) \
-            -> Optional[CleanedWebhookPayload]:
-        if not payload:  # Check for empty or invalid payload early
-            logger.error("Payload is missing or empty.")
-            return None
-
-        try:
-            payload_json = json.loads(payload)
-        except json.JSONDecodeError:
-            logger.error("Failed to parse payload as JSON.")
-            return None
-
-        pms_hotel_id: Optional[str] = payload_json.get("HotelId")
+    async def aretrieve_products_api(self) -> Optional[List[UpsellProduct]]:
         try:
-            if not pms_hotel_id:
-                raise ValueError("Invalid pms_hotel_id: None")
-            uuid.UUID(pms_hotel_id)  # Validate UUID
-        except (ValueError, TypeError) as e:
-            logger.error(f"Invalid pms_hotel_id: {pms_hotel_id} - {e}")
-            return None
-
-        events = {}
-        for event in payload_json.get("Events", []):
-            name = event.get("Name")
-            reservation_id = event.get("Value", {}).get("ReservationId")
-            if not reservation_id:  # Ensure ReservationId exists
-                logger.warning(f"Skipping event with missing reservation_id: {event}")
-                continue
-            if name not in events:
-                events[name] = []
-            events[name].append(reservation_id)
-
-        try:
-            hotel = Hotel.objects.get(pms_hotel_id=pms_hotel_id, pms=Hotel.PMS.APALEO)
-            logger.info(f"Hotel found: {hotel.name} (id={hotel.id})")
-            return CleanedWebhookPayload(hotel_id=hotel.id, data=events)
-        except Hotel.DoesNotExist:
-            logger.error(f"Hotel with pms_hotel_id {pms_hotel_id} not found.")
+            data = await aget_guest_line_upsell_product()
+            return self.upsell_product_spec.validate(data.get("products", []))
+        except Exception as e:
+            logger.error(f"Failed to retrieve upsell products: {e}")
             return None
 
-    def handle_webhook(self, webhook_data: dict) -> bool:
-        return False
\ No newline at end of file
+    def handle_webhook(self, webhook_data: dict, deadline: Optional[Deadline] = None) -> WebhookResult:
+        # Fetching reservations from Guestline is not supported yet. Retrying would not change that, so the
+        # reservations are skipped rather than failed.
+        reservation_ids = [
+            reservation_id for reservation_ids in webhook_data["data"].values() for reservation_id in reservation_ids
+        ]
+        logger.warning(
+            f"Skipped {len(reservation_ids)} reservations of hotel {self.hotel.id}, "
+            "fetching reservations from Guestline is not supported."
+        )
+        return WebhookResult(skipped=reservation_ids)
\ No newline at end of file
@@ -1,4 +1,11 @@
-from hotel.pms.model import UpsellProductAdapter, UpsellProduct
+from hotel.pms.model import (
+    AVAILABILITY_MODES,
+    PRICING_UNITS,
+    UpsellProductAdapter,
+    UpsellProduct,
+    offered_days,
+    product_type,
+)
 
 
 # --- Guestline Adapter Implementation ---
@@ -11,11 +18,16 @@ class GuestLineUpsellProductAdapter(UpsellProductAdapter):
         amount = default_price.get("amount", 0)
         currency = default_price.get("currency")
         price_str = f"{amount} {currency}"
+        availability = self.raw_data.get("availability", {})
         return UpsellProduct(
             id=self.raw_data.get("id"),
             name=self.raw_data.get("name"),
             code=self.raw_data.get("code"),
             description=self.raw_data.get("description"),
             price=price_str,
-            age_category=self.raw_data.get("ageCategory", "")
+            age_category=self.raw_data.get("ageCategory", ""),
+            type=product_type(self.raw_data.get("name")),
+            per_whom=PRICING_UNITS.get(self.raw_data.get("unit"), "GUEST"),
+            availability_when=AVAILABILITY_MODES.get(availability.get("mode"), "ENTIRE_STAY"),
+            offered_days=offered_days(availability.get("daysOfWeek")),
         )
\ No newline at end of file
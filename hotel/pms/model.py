@@ -1,4 +1,6 @@
+import datetime
 import logging
+from typing import List, Optional
 
 from pydantic import BaseModel
 
@@ -13,6 +15,11 @@ class UpsellProduct(BaseModel):
     description: str
     price: str
     age_category: str
+    # The fields below use the choices of hotel.models.UpsellProduct.
+    type: str = "OTHER"
+    per_whom: str = "GUEST"
+    availability_when: str = "ENTIRE_STAY"
+    offered_days: List[str] = []
 
     # @field_validator('name', mode='before')
     # @classmethod
@@ -22,6 +29,35 @@ class UpsellProduct(BaseModel):
     #     return v
 
 
+PRICING_UNITS = {"Person": "GUEST", "Room": "ROOM"}
+AVAILABILITY_MODES = {"Daily": "ENTIRE_STAY", "Arrival": "ON_ARRIVAL", "Departure": "ON_DEPARTURE"}
+WEEKDAYS = {
+    "Monday": "MON",
+    "Tuesday": "TUE",
+    "Wednesday": "WED",
+    "Thursday": "THU",
+    "Friday": "FRI",
+    "Saturday": "SAT",
+    "Sunday": "SUN",
+}
+PRODUCT_TYPES = {"breakfast": "BREAKFAST", "parking": "PARKING"}
+
+
+def product_type(name: str) -> str:
+    name = (name or "").lower()
+    return next((product_type for word, product_type in PRODUCT_TYPES.items() if word in name), "OTHER")
+
+
+def offered_days(days_of_week: List[str]) -> List[str]:
+    """
+    Returns the day codes of the given weekdays in weekday order, or ["EVERYDAY"] for all of them.
+    """
+    days_of_week = set(days_of_week or ())
+    if days_of_week >= WEEKDAYS.keys():
+        return ["EVERYDAY"]
+    return [code for day, code in WEEKDAYS.items() if day in days_of_week]
+
+
 # --- Adapter Base Class ---
 class UpsellProductAdapter:
     """
@@ -31,4 +67,46 @@ class UpsellProductAdapter:
         self.raw_data = raw_data
 
     def convert(self) -> UpsellProduct:
-        raise NotImplementedError("Subclasses must implement this method")
\ No newline at end of file
+        raise NotImplementedError("Subclasses must implement this method")
+
+
+# --- Unified reservation models ---
+class GuestDetails(BaseModel):
+    pms_guest_id: str
+    name: str = ""
+    phone: Optional[str] = None
+    language: Optional[str] = None
+    # ISO 3166 country code, used to normalize national phone numbers.
+    country: Optional[str] = None
+
+
+class StayDetails(BaseModel):
+    pms_reservation_id: str
+    pms_guest_id: Optional[str] = None
+    status: str
+    checkin: Optional[datetime.date] = None
+    checkout: Optional[datetime.date] = None
+    guest: Optional[GuestDetails] = None
+
+
+# --- Reservation adapter base classes ---
+class StayDetailsAdapter:
+    """
+    Base adapter interface for converting PMS reservation data into the unified StayDetails model.
+    """
+    def __init__(self, raw_data: dict) -> None:
+        self.raw_data = raw_data
+
+    def convert(self) -> StayDetails:
+        raise NotImplementedError("Subclasses must implement this method")
+
+
+class GuestDetailsAdapter:
+    """
+    Base adapter interface for converting PMS guest data into the unified GuestDetails model.
+    """
+    def __init__(self, raw_data: dict) -> None:
+        self.raw_data = raw_data
+
+    def convert(self) -> GuestDetails:
+        raise NotImplementedError("Subclasses must implement this method")
@@ -0,0 +1,148 @@
+import json
+import re
+import zlib
+from typing import Any, Dict, Iterator, Optional, Tuple, Union
+
+from django.conf import settings
+
+"""
+Incremental reading of webhook payloads.
+The top-level members of the payload are located without decoding their values, so a single
+member (e.g. HotelId) can be decoded before the rest of the body is looked at.
+"""
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_SCALAR = re.compile(r"[^,:{}\[\]\s]+")
+# Strings are matched as a whole, so brackets inside strings are not counted.
+_NESTING = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\]]', re.DOTALL)
+
+SUPPORTED_CONTENT_ENCODINGS = ("", "identity", "gzip")
+
+_decoder = json.JSONDecoder()
+
+
+class PayloadError(ValueError):
+    pass
+
+
+def decode_body(body: Union[str, bytes], content_encoding: Optional[str] = None) -> str:
+    """
+    Decompresses and decodes a webhook body.
+    Raises PayloadError if the encoding is not supported, a gzip body is invalid or truncated, or the
+    (decompressed) body is larger than WEBHOOK_MAX_BODY_BYTES. Decompression stops as soon as the limit is exceeded.
+    """
+    limit = settings.WEBHOOK_MAX_BODY_BYTES
+    if isinstance(body, str):
+        body = body.encode()
+
+    content_encoding = (content_encoding or "").strip().lower()
+    if content_encoding not in SUPPORTED_CONTENT_ENCODINGS:
+        raise PayloadError(f"Unsupported Content-Encoding: {content_encoding}")
+    if content_encoding == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            body = decompressor.decompress(body, limit + 1)
+        except zlib.error as e:
+            raise PayloadError(f"Invalid gzip body: {e}") from e
+        if len(body) <= limit and not decompressor.eof:
+            raise PayloadError("Invalid gzip body: the body is truncated.")
+    if len(body) > limit:
+        raise PayloadError(f"The payload is larger than {limit} bytes.")
+
+    try:
+        return body.decode("utf-8")
+    except UnicodeDecodeError as e:
+        raise PayloadError(f"The payload is not valid UTF-8: {e}") from e
+
+
+class PayloadReader:
+    """
+    Reads the top-level members of a JSON object lazily.
+    """
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self._members = self._iter_members()
+        self._spans: Dict[str, Tuple[int, int]] = {}
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """
+        Decodes the value of a top-level member, only scanning the body up to that member.
+        """
+        span = self._find(key)
+        if span is None:
+            return default
+        return self._decode(span[0])[0]
+
+    def _find(self, key: str) -> Optional[Tuple[int, int]]:
+        if key in self._spans:
+            return self._spans[key]
+        for member, span in self._members:
+            self._spans.setdefault(member, span)
+            if member == key:
+                return span
+        return None
+
+    def _iter_members(self) -> Iterator[Tuple[str, Tuple[int, int]]]:
+        pos = self._skip_whitespace(0)
+        if self.text[pos:pos + 1] != "{":
+            raise PayloadError("The payload is not a JSON object.")
+        pos = self._skip_whitespace(pos + 1)
+        if self.text[pos:pos + 1] == "}":
+            return
+        while True:
+            match = _STRING.match(self.text, pos)
+            if not match:
+                raise PayloadError(f"Expected a member name at position {pos}.")
+            key = match.group()
+            # Member names rarely contain escapes, so only those are decoded.
+            key = json.loads(key) if "\\" in key else key[1:-1]
+            pos = self._skip_whitespace(match.end())
+            if self.text[pos:pos + 1] != ":":
+                raise PayloadError(f"Expected ':' at position {pos}.")
+            start = self._skip_whitespace(pos + 1)
+            end = self._skip_value(start)
+            yield key, (start, end)
+            pos = self._skip_whitespace(end)
+            if self.text[pos:pos + 1] == "}":
+                return
+            if self.text[pos:pos + 1] != ",":
+                raise PayloadError(f"Expected ',' or '}}' at position {pos}.")
+            pos = self._skip_whitespace(pos + 1)
+
+    def _skip_value(self, pos: int) -> int:
+        """
+        Returns the end of the value that starts at pos, without decoding it.
+        """
+        char = self.text[pos:pos + 1]
+        if char == '"':
+            match = _STRING.match(self.text, pos)
+        elif char in ("{", "["):
+            depth = 0
+            for match in _NESTING.finditer(self.text, pos):
+                token = match.group()
+                if token in ("{", "["):
+                    depth += 1
+                elif token in ("}", "]"):
+                    depth -= 1
+                    if depth == 0:
+                        return match.end()
+            match = None
+        else:
+            match = _SCALAR.match(self.text, pos)
+        if not match:
+            raise PayloadError(f"Invalid value at position {pos}.")
+        return match.end()
+
+    def _skip_whitespace(self, pos: int) -> int:
+        pos = _WHITESPACE.match(self.text, pos).end()
+        if pos >= len(self.text):
+            raise PayloadError("Unexpected end of the payload.")
+        return pos
+
+    def _decode(self, pos: int) -> Tuple[Any, int]:
+        try:
+            return _decoder.raw_decode(self.text, pos)
+        except json.JSONDecodeError as e:
+            raise PayloadError(f"Invalid JSON: {e}") from e
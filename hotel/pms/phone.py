@@ -0,0 +1,78 @@
+from typing import Dict, FrozenSet, Optional
+
+from hotel.models import Language
+
+"""
+Normalization of phone numbers to E.164 ("+" and 8 to 15 digits), the key that guests are identified by.
+PMSes return numbers in international format, in national format with a trunk prefix, or placeholders
+like "123" and "Not available". National numbers are only normalized when the country of the guest is known.
+"""
+
+# Calling codes by ISO 3166 country code, for the countries our hotels and their guests are in.
+COUNTRY_CALLING_CODES: Dict[str, str] = {
+    "AE": "971", "AR": "54", "AT": "43", "AU": "61", "BE": "32", "BG": "359", "BR": "55", "CA": "1",
+    "CH": "41", "CL": "56", "CN": "86", "CO": "57", "CY": "357", "CZ": "420", "DE": "49", "DK": "45",
+    "EE": "372", "EG": "20", "ES": "34", "FI": "358", "FR": "33", "GB": "44", "GG": "44", "GR": "30",
+    "HK": "852", "HR": "385", "HU": "36", "IE": "353", "IL": "972", "IM": "44", "IN": "91", "IS": "354",
+    "IT": "39", "JE": "44", "JP": "81", "KR": "82", "LT": "370", "LU": "352", "LV": "371", "MA": "212",
+    "MC": "377", "MT": "356", "MX": "52", "MY": "60", "NL": "31", "NO": "47", "NZ": "64", "PH": "63",
+    "PL": "48", "PT": "351", "QA": "974", "RO": "40", "RS": "381", "RU": "7", "SA": "966", "SE": "46",
+    "SG": "65", "SI": "386", "SK": "421", "TH": "66", "TR": "90", "UA": "380", "US": "1", "ZA": "27",
+}
+
+# Countries to normalize the national numbers of stored guests with, when only their language is known.
+LANGUAGE_COUNTRIES: Dict[str, str] = {
+    Language.GERMAN: "DE",
+    Language.BRITISH_ENGLISH: "GB",
+    Language.SPANISH_SPAIN: "ES",
+    Language.FRENCH: "FR",
+    Language.ITALIAN: "IT",
+    Language.DUTCH: "NL",
+    Language.PORTUGUESE_PORTUGAL: "PT",
+    Language.SWEDISH: "SE",
+    Language.DANISH: "DK",
+}
+
+# Countries without a trunk prefix: the leading 0 of their national numbers is part of the number, and is kept
+# after the calling code (e.g. 06 1234 5678 in Italy is +39 06 1234 5678). Their mobile numbers have no leading 0.
+NO_TRUNK_PREFIX_COUNTRIES: FrozenSet[str] = frozenset({"IT"})
+
+# Every calling code by its length, calling codes are prefix-free so at most one of them matches a number.
+_CALLING_CODES: Dict[int, FrozenSet[str]] = {
+    length: frozenset(code for code in COUNTRY_CALLING_CODES.values() if len(code) == length) for length in (1, 2, 3)
+}
+# Separators that are removed before a number is looked at.
+_SEPARATORS = str.maketrans("", "", " -./()\t")
+
+MIN_DIGITS = 8
+MAX_DIGITS = 15
+
+
+def normalize_phone(phone: Optional[str], country: Optional[str] = None) -> Optional[str]:
+    """
+    Returns the phone number in E.164 format, or None if it can not identify a guest.
+    International numbers must start with a known calling code, national numbers (with a trunk prefix 0,
+    except in NO_TRUNK_PREFIX_COUNTRIES) get the calling code of `country`.
+    """
+    if not phone:
+        return None
+    digits = phone.translate(_SEPARATORS)
+    if digits.startswith("+"):
+        digits = digits[1:]
+    elif digits.startswith("00"):
+        digits = digits[2:]
+    elif country and country.upper() in NO_TRUNK_PREFIX_COUNTRIES:
+        digits = COUNTRY_CALLING_CODES[country.upper()] + digits
+    elif digits.startswith("0") and country:
+        code = COUNTRY_CALLING_CODES.get(country.upper())
+        if code is None:
+            return None
+        digits = code + digits[1:]
+    else:
+        return None
+
+    if not (MIN_DIGITS <= len(digits) <= MAX_DIGITS and digits.isdigit() and digits.isascii()):
+        return None
+    if not any(digits[:length] in codes for length, codes in _CALLING_CODES.items()):
+        return None
+    return "+" + digits
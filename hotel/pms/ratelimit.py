@@ -0,0 +1,145 @@
+import asyncio
+import fcntl
+import os
+import struct
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+
+from hotel.external_api import APIError
+
+"""
+Token-bucket rate limiting of the PMS API calls, per PMS and per hotel.
+The buckets are kept in small files under PMS_RATE_LIMIT_DIR and updated under an exclusive file lock,
+so all threads and worker processes on a host share them.
+"""
+
+# Tokens and the wall clock time they were counted at.
+_STATE = struct.Struct("dd")
+
+
+class RateLimitExceeded(APIError):
+    """
+    Raised when no token could be taken from the buckets of a call within the timeout.
+    """
+
+
+@dataclass(frozen=True)
+class Rate:
+    # Tokens added per second.
+    rate: float
+    # Maximum number of tokens, the largest burst of calls.
+    burst: float
+
+
+class FileTokenBuckets:
+    """
+    Token buckets stored in one file per bucket.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def take(self, buckets: List[Tuple[str, Rate]]) -> float:
+        """
+        Takes a token from every bucket if all of them have one and returns 0.
+        Otherwise nothing is taken and the seconds until all buckets have a token are returned.
+        """
+        fds = []
+        try:
+            # Locked in a fixed order, so two callers never wait for each other's locks.
+            for key, _ in sorted(buckets):
+                fd = os.open(self._path(key), os.O_RDWR | os.O_CREAT, 0o600)
+                fds.append((key, fd))
+                fcntl.flock(fd, fcntl.LOCK_EX)
+
+            now = time.time()
+            rates = dict(buckets)
+            states = {}
+            wait = 0.0
+            for key, fd in fds:
+                data = os.pread(fd, _STATE.size, 0)
+                rate = rates[key]
+                tokens, updated_at = _STATE.unpack(data) if len(data) == _STATE.size else (rate.burst, now)
+                tokens = min(rate.burst, tokens + max(0.0, now - updated_at) * rate.rate)
+                states[key] = tokens
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate.rate)
+
+            for key, fd in fds:
+                tokens = states[key] if wait else states[key] - 1
+                os.pwrite(fd, _STATE.pack(tokens, now), 0)
+            return wait
+        finally:
+            for _, fd in fds:
+                os.close(fd)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key.replace("/", "_") + ".bucket")
+
+
+class RateLimiter:
+    """
+    Takes a token from the bucket of the PMS (PMS_RATE_LIMITS) and of the hotel (PMS_HOTEL_RATE_LIMITS)
+    for every PMS API call. PMSes without a configured rate are not limited.
+    """
+
+    def __init__(self, store: Optional[FileTokenBuckets] = None) -> None:
+        self._store = store
+
+    @property
+    def store(self) -> FileTokenBuckets:
+        if self._store is None or self._store.directory != settings.PMS_RATE_LIMIT_DIR:
+            self._store = FileTokenBuckets(settings.PMS_RATE_LIMIT_DIR)
+        return self._store
+
+    def buckets(self, pms_name: str, hotel_id: Optional[int]) -> List[Tuple[str, Rate]]:
+        buckets = []
+        if pms_name in settings.PMS_RATE_LIMITS:
+            buckets.append((pms_name, Rate(**settings.PMS_RATE_LIMITS[pms_name])))
+        if hotel_id is not None and pms_name in settings.PMS_HOTEL_RATE_LIMITS:
+            buckets.append((f"{pms_name}/hotel {hotel_id}", Rate(**settings.PMS_HOTEL_RATE_LIMITS[pms_name])))
+        return buckets
+
+    def acquire(self, pms_name: str, hotel_id: Optional[int], timeout: Optional[float] = None) -> None:
+        """
+        Waits up to `timeout` seconds (PMS_RATE_LIMIT_TIMEOUT by default) for a token, a timeout of 0
+        rejects the call right away. Raises RateLimitExceeded if there was no token in time.
+        """
+        buckets = self.buckets(pms_name, hotel_id)
+        if not buckets:
+            return
+        give_up_at = time.monotonic() + (settings.PMS_RATE_LIMIT_TIMEOUT if timeout is None else timeout)
+        while True:
+            wait = self.store.take(buckets)
+            if not wait:
+                return
+            self._check(pms_name, hotel_id, wait, give_up_at)
+            time.sleep(wait)
+
+    async def aacquire(self, pms_name: str, hotel_id: Optional[int], timeout: Optional[float] = None) -> None:
+        """
+        Async variant of acquire, waiting does not block the event loop.
+        """
+        buckets = self.buckets(pms_name, hotel_id)
+        if not buckets:
+            return
+        give_up_at = time.monotonic() + (settings.PMS_RATE_LIMIT_TIMEOUT if timeout is None else timeout)
+        while True:
+            wait = self.store.take(buckets)
+            if not wait:
+                return
+            self._check(pms_name, hotel_id, wait, give_up_at)
+            await asyncio.sleep(wait)
+
+    @staticmethod
+    def _check(pms_name: str, hotel_id: Optional[int], wait: float, give_up_at: float) -> None:
+        if time.monotonic() + wait > give_up_at:
+            scope = pms_name if hotel_id is None else f"{pms_name} for hotel {hotel_id}"
+            raise RateLimitExceeded(f"Rate limit of {scope} exceeded.")
+
+
+rate_limiter = RateLimiter()
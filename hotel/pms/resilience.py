@@ -0,0 +1,343 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from django.conf import settings
+
+from hotel.external_api import APIError
+from hotel.pms.ratelimit import RateLimitExceeded, rate_limiter
+
+"""
+Resilience layer around the PMS API calls.
+Every attempt takes a token from the rate limits of the PMS and the hotel. Failed calls are retried with
+jittered exponential backoff, and circuit breakers per PMS and per hotel stop calling a PMS that keeps
+failing until a probe call succeeds again.
+"""
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(APIError):
+    """
+    Raised instead of calling the PMS API while a circuit breaker is open.
+    """
+
+
+class DeadlineExceeded(APIError):
+    """
+    Raised instead of calling the PMS API, or waiting for it, once the deadline of the caller has passed.
+    """
+
+
+class Deadline:
+    """
+    A time budget that is passed down to every PMS API call made on behalf of one webhook.
+    """
+
+    def __init__(self, seconds: float) -> None:
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def share(self, fraction: float) -> "Deadline":
+        """
+        Returns a deadline for a first phase of the work that leaves the rest of the remaining time to the next phases.
+        """
+        return Deadline(self.remaining() * fraction)
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def check(self) -> None:
+        if self.expired:
+            stats.increment("deadline_exceeded")
+            raise DeadlineExceeded(f"The deadline of {self.seconds} seconds has passed.")
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures. Once `reset_timeout` seconds have
+    passed a single probe call is let through (half-open): its outcome closes or reopens the breaker.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Raises CircuitOpenError if calls are not allowed right now.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                logger.info(f"Circuit breaker {self.name} is half-open, probing the PMS.")
+                return
+        stats.increment("short_circuited")
+        raise CircuitOpenError(f"Circuit breaker {self.name} is open.")
+
+    def release(self) -> None:
+        """
+        Gives up an acquired probe without a result, so another call can probe.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened_at = 0.0
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"Circuit breaker {self.name} is closed again.")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    stats.increment("circuits_opened")
+                    logger.warning(f"Circuit breaker {self.name} opened after {self.failures} failures.")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class ResilienceStats:
+    """
+    Thread-safe counters for retries, failures and circuit breaker activity.
+    """
+
+    def __init__(self) -> None:
+        self._counter = Counter()
+        self._lock = threading.Lock()
+
+    def increment(self, key: str) -> None:
+        with self._lock:
+            self._counter[key] += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counter)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counter.clear()
+
+
+stats = ResilienceStats()
+
+# The random source of the backoff jitter, benchmarks replace it with a seeded one.
+jitter = random.Random()
+
+_breakers: Dict[Tuple[str, Optional[int]], CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(pms_name: str, hotel_id: Optional[int] = None) -> CircuitBreaker:
+    """
+    Returns the circuit breaker of a PMS, or of a single hotel on that PMS if hotel_id is given.
+    """
+    key = (pms_name, hotel_id)
+    with _breakers_lock:
+        if key not in _breakers:
+            name = pms_name if hotel_id is None else f"{pms_name}/hotel {hotel_id}"
+            _breakers[key] = CircuitBreaker(
+                name,
+                failure_threshold=settings.PMS_CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+                reset_timeout=settings.PMS_CIRCUIT_BREAKER_RESET_TIMEOUT,
+            )
+        return _breakers[key]
+
+
+def reset_breakers() -> None:
+    with _breakers_lock:
+        _breakers.clear()
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    Full jitter: a random delay between zero and the exponential backoff of this attempt.
+    """
+    return jitter.uniform(0, min(settings.PMS_RETRY_MAX_DELAY, settings.PMS_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+def call_with_resilience(
+    func: Callable[..., T],
+    *args,
+    pms_name: str,
+    hotel_id: Optional[int] = None,
+    deadline: Optional[Deadline] = None,
+    rate_limit_timeout: Optional[float] = None,
+) -> T:
+    """
+    Calls func(*args), retrying on APIError, as long as the circuit breakers of the PMS and the hotel allow it.
+    Without a hotel_id the call is not made for a single hotel, and only the breaker and rate limit of the PMS apply.
+    Raises the last APIError if all attempts failed, or CircuitOpenError if a breaker is open.
+    Every attempt waits up to rate_limit_timeout seconds (PMS_RATE_LIMIT_TIMEOUT by default) for the rate limits,
+    0 rejects it right away, and RateLimitExceeded is raised when there was no token in time.
+    With a deadline, no call is started and no backoff is waited for beyond it, DeadlineExceeded is raised instead.
+    A call that is running when the deadline passes is not interrupted.
+    """
+    breakers = _breakers_of(pms_name, hotel_id)
+    attempts = settings.PMS_RETRY_ATTEMPTS
+    for attempt in range(1, attempts + 1):
+        if deadline:
+            deadline.check()
+        timeout, deadline_bound = _rate_limit_timeout(rate_limit_timeout, deadline)
+        # The breakers are checked first, so a call they stop does not use up a rate limit token.
+        _acquire(breakers)
+        try:
+            rate_limiter.acquire(pms_name, hotel_id, timeout)
+        except BaseException as e:
+            # The PMS was not called, so a probe that was let through is given up.
+            _release(breakers)
+            if isinstance(e, RateLimitExceeded):
+                _rate_limited(e, deadline_bound)
+            raise
+        stats.increment("calls")
+        try:
+            result = func(*args)
+        except APIError as e:
+            _record_failure(breakers)
+            if attempt == attempts:
+                raise
+            time.sleep(_retry_delay(attempt, deadline, e))
+        except BaseException:
+            # Not an outcome of the PMS, but a probe that was let through has to be given back.
+            _release(breakers)
+            raise
+        else:
+            _record_success(breakers)
+            return result
+
+
+async def acall_with_resilience(
+    func: Callable[..., Awaitable[T]],
+    *args,
+    pms_name: str,
+    hotel_id: Optional[int] = None,
+    deadline: Optional[Deadline] = None,
+    rate_limit_timeout: Optional[float] = None,
+) -> T:
+    """
+    Async variant of call_with_resilience for coroutine functions, the backoff and waiting for the rate limits
+    do not block the event loop. With a deadline, a call that is still running when it passes is cancelled.
+    """
+    breakers = _breakers_of(pms_name, hotel_id)
+    attempts = settings.PMS_RETRY_ATTEMPTS
+    for attempt in range(1, attempts + 1):
+        if deadline:
+            deadline.check()
+        timeout, deadline_bound = _rate_limit_timeout(rate_limit_timeout, deadline)
+        _acquire(breakers)
+        try:
+            await rate_limiter.aacquire(pms_name, hotel_id, timeout)
+        except BaseException as e:
+            _release(breakers)
+            if isinstance(e, RateLimitExceeded):
+                _rate_limited(e, deadline_bound)
+            raise
+        stats.increment("calls")
+        try:
+            if deadline:
+                result = await asyncio.wait_for(func(*args), deadline.remaining())
+            else:
+                result = await func(*args)
+        except asyncio.TimeoutError:
+            # The PMS did not fail, so the call does not count against the breakers.
+            _release(breakers)
+            stats.increment("deadline_exceeded")
+            raise DeadlineExceeded(f"The call did not finish within the deadline of {deadline.seconds} seconds.")
+        except APIError as e:
+            _record_failure(breakers)
+            if attempt == attempts:
+                raise
+            await asyncio.sleep(_retry_delay(attempt, deadline, e))
+        except BaseException:
+            # Also when the call is cancelled.
+            _release(breakers)
+            raise
+        else:
+            _record_success(breakers)
+            return result
+
+
+def _rate_limit_timeout(timeout: Optional[float], deadline: Optional[Deadline]) -> Tuple[float, bool]:
+    """
+    Returns how long to wait for the rate limits, and whether the deadline shortened that wait.
+    """
+    timeout = settings.PMS_RATE_LIMIT_TIMEOUT if timeout is None else timeout
+    if deadline and deadline.remaining() < timeout:
+        return deadline.remaining(), True
+    return timeout, False
+
+
+def _rate_limited(error: RateLimitExceeded, deadline_bound: bool) -> None:
+    stats.increment("rate_limited")
+    if deadline_bound:
+        stats.increment("deadline_exceeded")
+        raise DeadlineExceeded(f"No rate limit token before the deadline: {error}") from error
+    raise error
+
+
+def _retry_delay(attempt: int, deadline: Optional[Deadline], error: APIError) -> float:
+    delay = backoff_delay(attempt)
+    if deadline and delay >= deadline.remaining():
+        stats.increment("deadline_exceeded")
+        raise DeadlineExceeded(f"No time left to retry before the deadline: {error}") from error
+    stats.increment("retries")
+    return delay
+
+
+def _breakers_of(pms_name: str, hotel_id: Optional[int]) -> List[CircuitBreaker]:
+    if hotel_id is None:
+        return [get_breaker(pms_name)]
+    return [get_breaker(pms_name), get_breaker(pms_name, hotel_id)]
+
+
+def _acquire(breakers: List[CircuitBreaker]) -> None:
+    acquired = []
+    try:
+        for breaker in breakers:
+            breaker.acquire()
+            acquired.append(breaker)
+    except CircuitOpenError:
+        _release(acquired)
+        raise
+
+
+def _release(breakers: List[CircuitBreaker]) -> None:
+    for breaker in breakers:
+        breaker.release()
+
+
+def _record_failure(breakers: List[CircuitBreaker]) -> None:
+    stats.increment("failures")
+    for breaker in breakers:
+        breaker.record_failure()
+
+
+def _record_success(breakers: List[CircuitBreaker]) -> None:
+    for breaker in breakers:
+        breaker.record_success()
@@ -0,0 +1,123 @@
+import functools
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from pydantic_core import SchemaValidator, ValidationError, core_schema
+
+from hotel.pms.payload import PayloadError
+
+"""
+Declarative webhook payload schemas.
+Every PMS describes where the hotel id and the reservation events are in its payloads. The schema
+is compiled once into pydantic-core validators that validate a whole payload in a single pass.
+"""
+
+
+@dataclass(frozen=True)
+class WebhookSchema:
+    hotel_id_key: str = "HotelId"
+    events_key: str = "Events"
+    event_name_key: str = "Name"
+    reservation_id_path: Tuple[str, ...] = ("Value", "ReservationId")
+
+    def validate_hotel_id(self, value) -> str:
+        """
+        Returns the hotel id if it is a valid UUID, raises a pydantic_core.ValidationError otherwise.
+        """
+        _hotel_id_validator.validate_python(value)
+        return value
+
+    def validate(self, payload: str, max_events: int) -> Tuple[Dict[str, List[str]], int]:
+        """
+        Validates a JSON payload and returns the reservation ids by event name, without repeated
+        reservation ids, and the number of skipped events without a reservation id.
+        Raises a pydantic_core.ValidationError if the payload has no valid hotel id or the events
+        are not an array, and PayloadError if there are more than max_events.
+        """
+        # Counted before the events are validated: a max_length in the schema is only checked after validating
+        # every event. A payload with n events has at least n - 1 commas, so most payloads are not counted at all.
+        if payload.count(",") >= max_events and _count_events(self, payload) > max_events:
+            raise PayloadError(f"The payload has more than {max_events} events.")
+
+        strict, lenient = _compile(self)
+        try:
+            validated = strict.validate_json(payload)
+        except ValidationError:
+            # Only payloads with invalid events pay for validating every event on its own.
+            validated = lenient.validate_json(payload)
+
+        skipped = 0
+        events: Dict[Optional[str], Dict[str, None]] = {}
+        for event in validated.get("events", ()):
+            if event is None:
+                skipped += 1
+                continue
+            # A dict keeps the order of the events and drops repeated reservation ids.
+            events.setdefault(event["name"], {})[event["reservation_id"]] = None
+        return {name: list(reservation_ids) for name, reservation_ids in events.items()}, skipped
+
+
+_hotel_id_validator = SchemaValidator(core_schema.uuid_schema())
+
+
+def _count_events(schema: WebhookSchema, payload: str) -> int:
+    """
+    Returns the number of events in a JSON payload, valid or not, without validating them.
+    """
+    return len(_compile_counter(schema).validate_json(payload).get("events", ()))
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_counter(schema: WebhookSchema) -> SchemaValidator:
+    # Every event is accepted as an empty dict, or None if it is not an object.
+    event = core_schema.with_default_schema(
+        core_schema.typed_dict_schema({}, extra_behavior="ignore"), default=None, on_error="default"
+    )
+    return SchemaValidator(
+        core_schema.typed_dict_schema(
+            {
+                "events": core_schema.typed_dict_field(
+                    core_schema.list_schema(event), required=False, validation_alias=schema.events_key
+                ),
+            }
+        )
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _compile(schema: WebhookSchema) -> Tuple[SchemaValidator, SchemaValidator]:
+    """
+    Returns a strict validator that rejects payloads with any invalid event, and a lenient
+    validator that turns invalid events into None.
+    """
+    event = core_schema.typed_dict_schema(
+        {
+            "name": core_schema.typed_dict_field(
+                core_schema.with_default_schema(core_schema.nullable_schema(core_schema.str_schema()), default=None),
+                validation_alias=schema.event_name_key,
+            ),
+            "reservation_id": core_schema.typed_dict_field(
+                core_schema.str_schema(min_length=1),
+                validation_alias=list(schema.reservation_id_path),
+            ),
+        }
+    )
+
+    def payload(event_schema):
+        return SchemaValidator(
+            core_schema.typed_dict_schema(
+                {
+                    "hotel_id": core_schema.typed_dict_field(
+                        core_schema.uuid_schema(), validation_alias=schema.hotel_id_key
+                    ),
+                    # Optional rather than defaulting to [], which would copy the default on every payload.
+                    "events": core_schema.typed_dict_field(
+                        core_schema.list_schema(event_schema),
+                        required=False,
+                        validation_alias=schema.events_key,
+                    ),
+                }
+            )
+        )
+
+    return payload(event), payload(core_schema.with_default_schema(event, default=None, on_error="default"))
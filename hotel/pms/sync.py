@@ -0,0 +1,108 @@
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, List, Set
+
+from django.conf import settings
+
+from hotel.external_api import APIError
+from hotel.pms.model import StayDetails
+from hotel.pms.upsert import UpsertResult
+
+if TYPE_CHECKING:
+    from hotel.pms.base import PMSProvider
+
+"""
+Reconciliation of the stays of hotels with the reservations in their PMS, by check-in date.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SyncResult:
+    dates: int = 0
+    failed_dates: List[datetime.date] = field(default_factory=list)
+    reservations: int = 0
+    # created: missing locally, updated: stale locally, unchanged: in sync.
+    stays: UpsertResult = field(default_factory=UpsertResult)
+
+    @property
+    def drift(self) -> float:
+        """
+        The fraction of the fetched reservations that were missing or stale.
+        """
+        if not self.reservations:
+            return 0.0
+        return (self.stays.created + self.stays.updated) / self.reservations
+
+
+def sync_reservations(pmses: List["PMSProvider"], dates: List[datetime.date]) -> Dict[int, SyncResult]:
+    """
+    Reconciles the stays of several hotels on the same PMS. The reservations of every check-in date are fetched
+    once for all hotels, concurrently, at most max_concurrent_fetches (the lowest of the hotels) dates at a time,
+    routed to their hotel by PMS hotel id, and upserted in batches of PMS_SYNC_BATCH_SIZE stays per hotel as the
+    dates come in. Reservations of other hotels are left out.
+    Dates that still fail after the retries of call_pms_api, or whose reservations could not be saved, are reported
+    in the failed_dates of the hotels they concern, and the other dates and hotels are synced nevertheless.
+    Returns the results by hotel id. Raises NotImplementedError if the PMS does not support syncing.
+    """
+    results = {pms.hotel.id: SyncResult(dates=len(dates)) for pms in pmses}
+    if not pmses or not dates:
+        return results
+
+    by_pms_hotel_id = {pms.hotel.pms_hotel_id: pms for pms in pmses}
+    batches: Dict[int, List[StayDetails]] = {pms.hotel.id: [] for pms in pmses}
+    batch_dates: Dict[int, Set[datetime.date]] = {pms.hotel.id: set() for pms in pmses}
+
+    def flush(pms: "PMSProvider") -> None:
+        hotel_id = pms.hotel.id
+        result = results[hotel_id]
+        try:
+            upserted = pms.save_stays(batches[hotel_id]).stays
+        except Exception:
+            logger.exception(f"Failed to save the reservations of hotel {hotel_id}")
+            result.failed_dates.extend(batch_dates[hotel_id])
+        else:
+            result.stays.created += upserted.created
+            result.stays.updated += upserted.updated
+            result.stays.unchanged += upserted.unchanged
+        batches[hotel_id].clear()
+        batch_dates[hotel_id].clear()
+
+    # The fetches are not made for a single hotel, so any of them can make the PMS-level calls.
+    fetcher = pmses[0]
+    max_workers = min(min(pms.hotel.max_concurrent_fetches for pms in pmses), len(dates))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetcher.fetch_reservations_for_checkin_date, date): date for date in dates}
+        # The database is only written from this thread, while the remaining dates are still being fetched.
+        for future in as_completed(futures):
+            date = futures[future]
+            try:
+                stays_by_hotel = future.result()
+            except NotImplementedError:
+                raise
+            except Exception as e:
+                log = logger.error if isinstance(e, APIError) else logger.exception
+                log(f"Failed to fetch reservations of {fetcher.name} for {date}: {e}")
+                for result in results.values():
+                    result.failed_dates.append(date)
+                continue
+            for pms_hotel_id, stays in stays_by_hotel.items():
+                pms = by_pms_hotel_id.get(pms_hotel_id)
+                if pms is None:
+                    continue
+                results[pms.hotel.id].reservations += len(stays)
+                batches[pms.hotel.id].extend(stays)
+                batch_dates[pms.hotel.id].add(date)
+                if len(batches[pms.hotel.id]) >= settings.PMS_SYNC_BATCH_SIZE:
+                    flush(pms)
+    for pms in pmses:
+        if batches[pms.hotel.id]:
+            flush(pms)
+
+    for hotel_id, result in results.items():
+        result.failed_dates = sorted(set(result.failed_dates))
+        logger.info(f"Synced reservations of hotel {hotel_id}: {result}")
+    return results
@@ -0,0 +1,316 @@
+import hashlib
+import logging
+import uuid
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+from typing import Dict, List, Optional, Tuple
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from hotel.models import Guest, Hotel, Stay, UpsellProduct
+from hotel.pms.model import GuestDetails, StayDetails, UpsellProduct as UpsellProductDetails
+from hotel.pms.phone import normalize_phone
+
+"""
+Set-based writes of PMS reservations and upsell catalogs.
+Existing rows are read with one query per model, compared in Python, and everything that is new or
+changed is written with one bulk_create(update_conflicts=True) per model.
+Every stay stores a fingerprint of the details it was written with, so a reservation that the PMS sends
+again unchanged is skipped before its guest or fields are looked at. The fingerprint has a reservation part
+and a guest part, so a reservation without guest details (e.g. from sync_reservations) only has to match
+the reservation part, and keeps the guest part that a webhook stored.
+Upsell products are written with bulk_update instead, of only the fields that changed.
+"""
+
+logger = logging.getLogger(__name__)
+
+GUEST_FIELDS = ["name", "language"]
+STAY_FIELDS = ["guest_id", "pms_guest_id", "status", "checkin", "checkout", "fingerprint"]
+UPSELL_PRODUCT_FIELDS = [
+    "name", "type", "is_bookable", "price", "currency", "per_whom", "availability_when", "offered_days"
+]
+
+
+@dataclass
+class UpsertResult:
+    created: int = 0
+    updated: int = 0
+    unchanged: int = 0
+
+
+@dataclass
+class StayUpsertResult:
+    stays: UpsertResult = field(default_factory=UpsertResult)
+    guests: UpsertResult = field(default_factory=UpsertResult)
+    # The reservation ids of the stays that were skipped because their fingerprint did not change.
+    skipped: List[str] = field(default_factory=list)
+
+
+@dataclass
+class UpsellProductUpsertResult(UpsertResult):
+    # Products that the PMS no longer returns, and that were marked as not bookable.
+    retired: int = 0
+    # The PMS ids of the products that were left out because their price could not be parsed.
+    invalid: List[str] = field(default_factory=list)
+
+
+# The length of each part of a fingerprint, and the guest part of a stay that was written without guest details.
+FINGERPRINT_PART_LENGTH = 16
+NO_GUEST_FINGERPRINT = "-" * FINGERPRINT_PART_LENGTH
+
+
+def _hash(data: str) -> str:
+    return hashlib.blake2b(data.encode(), digest_size=FINGERPRINT_PART_LENGTH // 2).hexdigest()
+
+
+def stay_fingerprint(stay: StayDetails) -> str:
+    """
+    Returns a hash of the reservation details of a stay followed by a hash of its guest details.
+    """
+    guest = _hash(stay.guest.model_dump_json()) if stay.guest else NO_GUEST_FINGERPRINT
+    return _hash(stay.model_dump_json(exclude={"guest"})) + guest
+
+
+def _unchanged(stay: StayDetails, fingerprint: str, current: Optional[dict]) -> bool:
+    if current is None:
+        return False
+    if stay.guest is None:
+        # The stored guest is kept, as the PMS guest id is part of the reservation details.
+        return current["fingerprint"][:FINGERPRINT_PART_LENGTH] == fingerprint[:FINGERPRINT_PART_LENGTH]
+    return current["fingerprint"] == fingerprint
+
+
+def guest_phone_key(guest: GuestDetails) -> Optional[str]:
+    return normalize_phone(guest.phone, guest.country)
+
+
+def upsert_guests(guests: List[GuestDetails]) -> Tuple[Dict[str, int], UpsertResult]:
+    """
+    Creates or updates guests by their normalized phone number, guests without a valid one are left out.
+    Returns the guest ids by phone key and the upsert counts.
+    """
+    result = UpsertResult()
+    incoming = {}
+    for guest in guests:
+        key = guest_phone_key(guest)
+        if key:
+            incoming[key] = guest
+    if not incoming:
+        return {}, result
+
+    # Guests stored before their phone_key was backfilled are matched by phone, and get their key here.
+    guests_found = list(
+        Guest.objects.filter(Q(phone_key__in=incoming) | Q(phone__in=incoming))
+        .order_by("id")
+        .values("id", "phone", "phone_key", *GUEST_FIELDS)
+    )
+    existing = {guest["phone_key"]: guest for guest in guests_found if guest["phone_key"] in incoming}
+    # Guest.phone is unique, so a key matches at most one guest by phone. That guest gets the key unless another
+    # guest has it, and then keeps an empty key until they are merged, like in backfill_phone_keys.
+    # A guest with the phone number and another key is used as it is: a new guest with its phone would not fit.
+    backfill = []
+    keyed_elsewhere = {}
+    for guest in guests_found:
+        if guest["phone"] not in incoming or guest["phone"] in existing:
+            continue
+        if guest["phone_key"] is None:
+            guest["phone_key"] = guest["phone"]
+            existing[guest["phone_key"]] = guest
+            backfill.append(Guest(id=guest["id"], phone_key=guest["phone_key"]))
+        else:
+            keyed_elsewhere[guest["phone"]] = guest["id"]
+    if backfill:
+        Guest.objects.bulk_update(backfill, ["phone_key"])
+    guest_ids = {key: guest["id"] for key, guest in existing.items()}
+    guest_ids.update(keyed_elsewhere)
+
+    to_write = []
+    for key, guest in incoming.items():
+        if key in keyed_elsewhere:
+            result.unchanged += 1
+            continue
+        values = {"name": guest.name, "language": guest.language}
+        current = existing.get(key)
+        if current is None:
+            result.created += 1
+        elif any(current[field_name] != value for field_name, value in values.items()):
+            result.updated += 1
+        else:
+            result.unchanged += 1
+            continue
+        to_write.append(Guest(phone=key, phone_key=key, **values))
+
+    if to_write:
+        Guest.objects.bulk_create(
+            to_write,
+            update_conflicts=True,
+            unique_fields=["phone_key"],
+            update_fields=GUEST_FIELDS + ["updated_at"],
+        )
+        # bulk_create does not return the primary keys of upserted rows.
+        created_keys = [guest.phone_key for guest in to_write if guest.phone_key not in guest_ids]
+        if created_keys:
+            guest_ids.update(Guest.objects.filter(phone_key__in=created_keys).values_list("phone_key", "id"))
+    return guest_ids, result
+
+
+def upsert_stays(hotel: Hotel, stays: List[StayDetails]) -> StayUpsertResult:
+    """
+    Creates or updates the stays of a hotel, and their guests, in a single transaction.
+    Stays are matched by hotel and pms_reservation_id, guests by normalized phone number.
+    Stays with the same fingerprint as the stored one are skipped without a write, and counted as unchanged.
+    Stays without guest details keep their current guest, as long as the PMS guest id did not change.
+    """
+    result = StayUpsertResult()
+    incoming = {stay.pms_reservation_id: stay for stay in stays}
+    if not incoming:
+        return result
+
+    with transaction.atomic():
+        existing = {
+            stay["pms_reservation_id"]: stay
+            for stay in Stay.objects.filter(hotel=hotel, pms_reservation_id__in=incoming).values(
+                "pms_reservation_id", *STAY_FIELDS
+            )
+        }
+
+        fingerprints = {}
+        for reservation_id, stay in incoming.items():
+            fingerprint = stay_fingerprint(stay)
+            current = existing.get(reservation_id)
+            if _unchanged(stay, fingerprint, current):
+                result.skipped.append(reservation_id)
+            else:
+                fingerprints[reservation_id] = fingerprint
+        result.stays.unchanged = len(result.skipped)
+
+        guest_ids, result.guests = upsert_guests(
+            [incoming[reservation_id].guest for reservation_id in fingerprints if incoming[reservation_id].guest]
+        )
+
+        to_write = []
+        for reservation_id, fingerprint in fingerprints.items():
+            stay = incoming[reservation_id]
+            current = existing.get(reservation_id)
+            if stay.guest:
+                guest_id = guest_ids.get(guest_phone_key(stay.guest))
+            elif current and current["pms_guest_id"] == stay.pms_guest_id:
+                guest_id = current["guest_id"]
+                if len(current["fingerprint"]) == 2 * FINGERPRINT_PART_LENGTH:
+                    guest_fingerprint = current["fingerprint"][FINGERPRINT_PART_LENGTH:]
+                    fingerprint = fingerprint[:FINGERPRINT_PART_LENGTH] + guest_fingerprint
+            else:
+                guest_id = None
+            values = {
+                "guest_id": guest_id,
+                "pms_guest_id": stay.pms_guest_id,
+                "status": stay.status,
+                "checkin": stay.checkin,
+                "checkout": stay.checkout,
+                "fingerprint": fingerprint,
+            }
+            if current is None:
+                result.stays.created += 1
+            elif any(current[key] != value for key, value in values.items() if key != "fingerprint"):
+                result.stays.updated += 1
+            else:
+                # Only the details of the guest or the fingerprint changed, the stay is written to store it.
+                result.stays.unchanged += 1
+            to_write.append(Stay(hotel=hotel, pms_reservation_id=reservation_id, **values))
+
+        if to_write:
+            Stay.objects.bulk_create(
+                to_write,
+                update_conflicts=True,
+                unique_fields=["hotel", "pms_reservation_id"],
+                update_fields=["guest", "pms_guest_id", "status", "checkin", "checkout", "fingerprint", "updated_at"],
+            )
+
+    logger.info(f"Upserted stays for hotel {hotel.id}: {result}")
+    return result
+
+
+def upsell_product_values(product: UpsellProductDetails) -> Optional[dict]:
+    """
+    Returns the UpsellProduct field values of a product from the PMS, or None if its price is not "<amount> <currency>".
+    """
+    try:
+        amount, currency = product.price.split()
+        price = Decimal(amount).quantize(Decimal("0.01"))
+    except (ValueError, InvalidOperation):
+        return None
+    if not price.is_finite() or len(currency) != 3:
+        return None
+    return {
+        "name": product.name.strip(),
+        "type": product.type,
+        "is_bookable": True,
+        "price": price,
+        "currency": currency,
+        "per_whom": product.per_whom,
+        "availability_when": product.availability_when,
+        "offered_days": product.offered_days,
+    }
+
+
+def upsert_upsell_products(hotel: Hotel, products: List[UpsellProductDetails]) -> UpsellProductUpsertResult:
+    """
+    Syncs the upsell catalog of a hotel with the products its PMS returned, in a single transaction.
+    Products are matched by hotel and pms_id. Only the products that changed are written, with one
+    bulk_update per set of changed fields, and the stored products that the PMS did not return
+    are marked as not bookable. Products without a pms_id are not managed by the PMS and left alone.
+    """
+    result = UpsellProductUpsertResult()
+    incoming = {}
+    for product in products:
+        values = upsell_product_values(product)
+        if values is None:
+            result.invalid.append(product.id)
+        else:
+            incoming[product.id] = values
+    if result.invalid:
+        logger.warning(f"Upsell products of hotel {hotel.id} with an invalid price: {result.invalid}")
+
+    now = timezone.now()
+    with transaction.atomic():
+        existing = {
+            product["pms_id"]: product
+            for product in UpsellProduct.objects.filter(hotel=hotel, pms_id__isnull=False).values(
+                "id", "pms_id", *UPSELL_PRODUCT_FIELDS
+            )
+        }
+
+        to_create = []
+        to_update: Dict[Tuple[str, ...], List[UpsellProduct]] = {}
+        for pms_id, values in incoming.items():
+            current = existing.get(pms_id)
+            if current is None:
+                to_create.append(UpsellProduct(hotel=hotel, pms_id=pms_id, upsell_id=uuid.uuid4(), **values))
+                continue
+            changed = tuple(key for key, value in values.items() if current[key] != value)
+            if not changed:
+                result.unchanged += 1
+                continue
+            product = UpsellProduct(id=current["id"], updated_at=now, **{key: values[key] for key in changed})
+            to_update.setdefault(changed, []).append(product)
+            result.updated += 1
+        result.created = len(to_create)
+
+        # A product whose price could not be parsed was still returned, so it is not retired.
+        retired = [
+            product["id"]
+            for pms_id, product in existing.items()
+            if product["is_bookable"] and pms_id not in incoming and pms_id not in result.invalid
+        ]
+
+        if to_create:
+            UpsellProduct.objects.bulk_create(to_create)
+        for changed, changed_products in to_update.items():
+            UpsellProduct.objects.bulk_update(changed_products, [*changed, "updated_at"])
+        if retired:
+            result.retired = UpsellProduct.objects.filter(id__in=retired).update(is_bookable=False, updated_at=now)
+
+    logger.info(f"Upserted upsell products for hotel {hotel.id}: {result}")
+    return result
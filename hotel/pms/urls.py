@@ -1,7 +1,8 @@
 from django.urls import path
 
-from hotel.pms.view import UpsellProductsView
+from hotel.pms.view import HotelsUpsellProductsView, UpsellProductsView
 
 urlpatterns = [
+    path('hotels/upsell-products/', HotelsUpsellProductsView.as_view(), name='retrieve_hotels_upsell_products'),
     path('hotels/<int:hotel_id>/upsell-products/', UpsellProductsView.as_view(), name='retrieve_upsell_products'),
 ]
\ No newline at end of file
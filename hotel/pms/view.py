@@ -1,12 +1,44 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
+from django.conf import settings
+from django.db import connections
 from django.http import JsonResponse
+from django.utils.decorators import method_decorator
 from django.views import View
+from django.views.decorators.gzip import gzip_page
+from hotel.http import conditional_gzip_page
 from hotel.models import Hotel
+from hotel.pms.cache import UpsellCatalog, hotel_cache, upsell_catalog_cache
 
 logger = logging.getLogger(__name__)
 
 
+def request_catalog(request, hotel: Hotel) -> UpsellCatalog:
+    """
+    Returns the catalog of the hotel, which is resolved once per request for both the ETag and the response.
+    """
+    if not hasattr(request, "upsell_catalog"):
+        request.upsell_catalog = upsell_catalog_cache.get_catalog(hotel)
+    return request.upsell_catalog
+
+
+def upsell_products_etag(request, hotel_id) -> Optional[str]:
+    """
+    The ETag of the cached catalog of the hotel, so a client that has it gets a 304 before anything is serialized.
+    """
+    try:
+        hotel = hotel_cache.get(hotel_id)
+        if hotel.get_pms() is None:
+            return None
+        return request_catalog(request, hotel).etag
+    except Exception:
+        # The view answers with the error.
+        return None
+
+
+@method_decorator(conditional_gzip_page(upsell_products_etag), name="get")
 class UpsellProductsView(View):
 
     def get(self, request, hotel_id):
@@ -16,13 +48,14 @@ class UpsellProductsView(View):
             return JsonResponse({'error': 'Hotel not found'}, status=404)
 
         try:
-            pms_provider = hotel.get_pms()
+            hotel.get_pms()
         except Exception as e:
             logger.error(f"Error retrieving PMS provider for hotel {hotel_id}: {e}")
             return JsonResponse({'error': 'PMS provider error'}, status=500)
 
+        # Served from the catalog cache, which falls back to the saved products if the PMS can not be reached.
         try:
-            upsell_products = pms_provider.get_upsell_products()
+            upsell_products = request_catalog(request, hotel).products
         except Exception as e:
             logger.error(f"Error retrieving upsell products for hotel {hotel_id}: {e}")
             return JsonResponse({'error': 'Error retrieving upsell products'}, status=500)
@@ -30,3 +63,62 @@ class UpsellProductsView(View):
         # Serialize each product; we assume each is a Pydantic model with a .dict() method.
         products_data = [product.dict() for product in upsell_products] if upsell_products else []
         return JsonResponse({'upsell_products': products_data}, status=200)
+
+
+def _get_catalog(hotel: Hotel) -> UpsellCatalog:
+    """
+    Returns the catalog of a hotel from a worker thread, which closes its database connections when it is done.
+    """
+    try:
+        return upsell_catalog_cache.get_catalog(hotel)
+    finally:
+        connections.close_all()
+
+
+@method_decorator(gzip_page, name="dispatch")
+class HotelsUpsellProductsView(View):
+    """
+    The upsell products of several hotels, e.g. /api/hotels/upsell-products/?ids=1,2,3.
+    The catalogs are fetched concurrently, at most UPSELL_CATALOG_CONCURRENCY at a time, and every hotel
+    gets its products or an error, so a hotel whose PMS fails does not fail the others.
+    """
+
+    def get(self, request):
+        try:
+            hotel_ids = list(dict.fromkeys(int(hotel_id) for hotel_id in request.GET.get('ids', '').split(',')))
+        except ValueError:
+            return JsonResponse({'error': 'ids must be a comma-separated list of hotel ids'}, status=400)
+        if len(hotel_ids) > settings.UPSELL_CATALOG_MAX_HOTELS:
+            return JsonResponse(
+                {'error': f'At most {settings.UPSELL_CATALOG_MAX_HOTELS} hotels can be requested at once'}, status=400
+            )
+
+        results = {}
+        hotels = []
+        found = Hotel.objects.in_bulk(hotel_ids)
+        for hotel_id in hotel_ids:
+            hotel = found.get(hotel_id)
+            if hotel is None:
+                results[hotel_id] = {'error': 'Hotel not found'}
+                continue
+            try:
+                hotel.get_pms()
+            except Exception as e:
+                logger.error(f"Error retrieving PMS provider for hotel {hotel_id}: {e}")
+                results[hotel_id] = {'error': 'PMS provider error'}
+                continue
+            hotels.append(hotel)
+
+        if hotels:
+            with ThreadPoolExecutor(max_workers=min(settings.UPSELL_CATALOG_CONCURRENCY, len(hotels))) as executor:
+                futures = [(hotel, executor.submit(_get_catalog, hotel)) for hotel in hotels]
+            for hotel, future in futures:
+                try:
+                    catalog = future.result()
+                except Exception as e:
+                    logger.error(f"Error retrieving upsell products for hotel {hotel.id}: {e}")
+                    results[hotel.id] = {'error': 'Error retrieving upsell products'}
+                else:
+                    results[hotel.id] = {'upsell_products': [product.dict() for product in catalog.products]}
+
+        return JsonResponse({'hotels': {str(hotel_id): results[hotel_id] for hotel_id in hotel_ids}}, status=200)
@@ -0,0 +1,39 @@
+import datetime
+import logging
+from typing import Dict, Optional
+
+from django.db.models import Q
+from django.utils import timezone
+
+from hotel.models import Hotel, Stay
+
+"""
+Date-driven status changes of stays.
+The status of a stay follows from its check-in and check-out dates and the local date of the hotel,
+so it is advanced in the database without calling the PMS.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def advance_stay_statuses(hotel: Hotel, today: Optional[datetime.date] = None) -> Dict[str, int]:
+    """
+    Moves the stays of a hotel that checked out before today (the hotel's local date by default) to AFTER,
+    and the stays that checked in by today to INSTAY, with one UPDATE per status.
+    Cancelled stays and stays with an unknown status are left alone. Running it again changes nothing.
+    Returns the number of stays moved to each status.
+    """
+    today = today or hotel.local_date()
+    now = timezone.now()
+    stays = Stay.objects.filter(hotel=hotel)
+    # Stays whose check-out has passed go straight to AFTER, so the INSTAY update does not see them.
+    advanced = {
+        Stay.Status.AFTER: stays.filter(
+            status__in=[Stay.Status.BEFORE, Stay.Status.INSTAY], checkout__lt=today
+        ).update(status=Stay.Status.AFTER, updated_at=now),
+        Stay.Status.INSTAY: stays.filter(
+            Q(checkout__gte=today) | Q(checkout__isnull=True), status=Stay.Status.BEFORE, checkin__lte=today
+        ).update(status=Stay.Status.INSTAY, updated_at=now),
+    }
+    logger.info(f"Advanced stay statuses of hotel {hotel.id} for {today}: {advanced}")
+    return advanced
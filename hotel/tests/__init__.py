@@ -1,8 +1,71 @@
+import datetime
 import json
 import os
+import uuid
 
 
 def load_api_fixture(filename: str) -> str:
     base_dir = os.path.realpath(os.path.dirname(__file__))
     with open(f"{base_dir}/api_fixtures/{filename}") as f:
         return f.read()
+
+
+def fake_reservation_details(reservation_id: str) -> str:
+    """
+    Deterministic stand-in for external_api.get_reservation_details.
+    """
+    return json.dumps(
+        {
+            "HotelId": "851df8c8-90f2-4c4a-8e01-a4fc46b25178",
+            "ReservationId": reservation_id,
+            "GuestId": str(uuid.uuid5(uuid.NAMESPACE_OID, reservation_id)),
+            "Status": "in_house",
+            "CheckInDate": (datetime.date.today() - datetime.timedelta(days=1)).strftime("%Y-%m-%d"),
+            "CheckOutDate": (datetime.date.today() + datetime.timedelta(days=2)).strftime("%Y-%m-%d"),
+            "BreakfastIncluded": True,
+            "RoomNumber": 42,
+        }
+    )
+
+
+def fake_guest_details(guest_id: str) -> str:
+    """
+    Deterministic stand-in for external_api.get_guest_details, every guest ID gets its own phone number.
+    """
+    return json.dumps(
+        {
+            "GuestId": guest_id,
+            "Name": "John Doe",
+            "Phone": f"+3161{uuid.UUID(guest_id).int % 10 ** 7:07d}",
+            "Country": "NL",
+        }
+    )
+
+
+def fake_reservations_for_checkin_date(checkin_date: str) -> str:
+    """
+    Deterministic stand-in for external_api.get_reservations_for_given_checkin_date,
+    two reservations of the test hotel and one of another hotel per date.
+    """
+    checkin = datetime.datetime.strptime(checkin_date, "%Y-%m-%d").date()
+    return json.dumps(
+        [
+            {
+                "HotelId": hotel_id,
+                "ReservationId": str(uuid.uuid5(uuid.NAMESPACE_OID, f"{checkin_date}-{i}")),
+                "GuestId": str(uuid.uuid5(uuid.NAMESPACE_OID, f"guest-{checkin_date}-{i}")),
+                "Status": "booked",
+                "CheckInDate": checkin_date,
+                "CheckOutDate": (checkin + datetime.timedelta(days=2)).strftime("%Y-%m-%d"),
+                "BreakfastIncluded": False,
+                "RoomNumber": i,
+            }
+            for i, hotel_id in enumerate(
+                [
+                    "851df8c8-90f2-4c4a-8e01-a4fc46b25178",
+                    "851df8c8-90f2-4c4a-8e01-a4fc46b25178",
+                    "0b4f5a1c-3f8a-4a86-9d0e-64f1d2c3b4a5",
+                ]
+            )
+        ]
+    )
@@ -1,15 +1,83 @@
+import asyncio
+import datetime
+import gzip
+import json
+import multiprocessing
+import random
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
 import django.test
+import pydantic
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
 
-from hotel.models import Stay, Hotel, Guest
+from hotel.benchmarks import FixtureArchive, RecordingExternalAPI, StubExternalAPI, parse_latency
+from hotel.deadletters import claim_dead_letters, record_dead_letters
+from hotel.inbox import aprocess_batch, claim_batch, claim_deferred, process_batch
+from hotel.management.commands.bench_upsell_adapters import PMS_CATALOGS
+from hotel.models import DeadLetter, DeferredReservation, Stay, Hotel, Guest, UpsellProduct, WebhookInboxItem
+from hotel.pms import resilience
+from hotel.pms.apaleo.apaleo import Apaleo
+from hotel.pms.base import UnknownPMSError, WebhookResult, get_pms
+from hotel.pms.cache import GuestDetailsCache, HotelCache, UpsellCatalogCache, guest_cache, hotel_cache, upsell_catalog_cache
+from hotel.pms.guestline.guestline import GuestLine
+from hotel.pms.model import GuestDetails, StayDetails
+from hotel.pms.phone import normalize_phone
+from hotel.pms.ratelimit import FileTokenBuckets, Rate, RateLimitExceeded, RateLimiter
+from hotel.pms.resilience import Deadline
+from hotel.pms.upsert import UpsellProductUpsertResult, UpsertResult, upsert_stays, upsert_upsell_products
+from hotel.stays import advance_stay_statuses
 
-from hotel.tests import load_api_fixture
+from hotel.external_api import APIError, aget_guest_details, get_apaleo_upsell_products
+from hotel.tests import (
+    fake_guest_details,
+    fake_reservation_details,
+    fake_reservations_for_checkin_date,
+    load_api_fixture,
+)
 from hotel.tests.factories import HotelFactory
 
 
+def patch_external_api(test_case: django.test.TestCase, module: str = "hotel.pms.apaleo.apaleo") -> None:
+    """
+    Replaces the random external API calls with deterministic ones for the duration of the test.
+    """
+    for name, fake in (
+        ("get_reservation_details", fake_reservation_details),
+        ("get_guest_details", fake_guest_details),
+    ):
+        patcher = mock.patch(f"{module}.{name}", side_effect=fake)
+        setattr(test_case, name, patcher.start())
+        test_case.addCleanup(patcher.stop)
+        async_patcher = mock.patch(f"{module}.a{name}", new_callable=mock.AsyncMock, side_effect=fake)
+        setattr(test_case, f"a{name}", async_patcher.start())
+        test_case.addCleanup(async_patcher.stop)
+
+
+# The rate limit buckets are shared with every other test run on this host.
+NO_RATE_LIMITS = {"PMS_RATE_LIMITS": {}, "PMS_HOTEL_RATE_LIMITS": {}}
+
+
+@override_settings(PMS_RETRY_BASE_DELAY=0, **NO_RATE_LIMITS)
 class PMS_Apaleotest(django.test.TestCase):
     def setUp(self) -> None:
         self.hotel = HotelFactory(pms=Hotel.PMS.APALEO)
         self.pms = self.hotel.get_pms()
+        patch_external_api(self)
+        resilience.reset_breakers()
+        guest_cache.clear()
 
     def test_clean_webhook_payload_faulty(self):
         cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload_faulty.json"))
@@ -24,6 +92,60 @@ class PMS_Apaleotest(django.test.TestCase):
             self.assertEqual(cleaned_payload["hotel_id"], self.hotel.id)
             self.assertIsInstance(cleaned_payload["data"], dict)
 
+    def test_clean_webhook_payload_drops_repeated_reservations(self):
+        payload = json.loads(load_api_fixture("webhook_payload.json"))
+        payload["Events"] += payload["Events"]
+        cleaned_payload = self.pms.clean_webhook_payload(json.dumps(payload))
+        self.assertEqual(len(cleaned_payload["data"]["ReservationUpdated"]), 3)
+
+    def test_clean_webhook_payload_gzip(self):
+        payload = gzip.compress(load_api_fixture("webhook_payload.json").encode())
+        cleaned_payload = self.pms.clean_webhook_payload(payload, "gzip")
+        self.assertEqual(cleaned_payload["hotel_id"], self.hotel.id)
+        self.assertEqual(len(cleaned_payload["data"]["ReservationUpdated"]), 3)
+
+    def test_clean_webhook_payload_unknown_hotel_skips_events(self):
+        payload = json.loads(load_api_fixture("webhook_payload.json"))
+        payload["HotelId"] = "0b4f5a1c-3f8a-4a86-9d0e-64f1d2c3b4a5"
+        with mock.patch("hotel.pms.schema.WebhookSchema.validate") as validate:
+            self.assertIsNone(self.pms.clean_webhook_payload(json.dumps(payload)))
+        validate.assert_not_called()
+
+    @override_settings(WEBHOOK_MAX_EVENTS=2)
+    def test_clean_webhook_payload_too_many_events(self):
+        self.assertIsNone(self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json")))
+
+    @override_settings(WEBHOOK_MAX_EVENTS=3)
+    def test_clean_webhook_payload_counts_events_first(self):
+        payload = json.loads(load_api_fixture("webhook_payload.json"))
+        self.assertIsNotNone(self.pms.clean_webhook_payload(json.dumps(payload)))
+        # Invalid events count as well, and the events are not validated.
+        payload["Events"].append("invalid")
+        with mock.patch("hotel.pms.schema._compile") as compile_schema:
+            self.assertIsNone(self.pms.clean_webhook_payload(json.dumps(payload)))
+        compile_schema.assert_not_called()
+
+    @override_settings(WEBHOOK_MAX_BODY_BYTES=100)
+    def test_clean_webhook_payload_too_large(self):
+        payload = gzip.compress(load_api_fixture("webhook_payload.json").encode())
+        self.assertLess(len(payload), 1000)
+        self.assertIsNone(self.pms.clean_webhook_payload(payload, "gzip"))
+
+    def test_clean_webhook_payload_truncated_gzip(self):
+        payload = gzip.compress(load_api_fixture("webhook_payload.json").encode())
+        # Without the CRC and size trailer the whole JSON is still there, but the body is not complete.
+        self.assertIsNone(self.pms.clean_webhook_payload(payload[:-8], "gzip"))
+        self.assertIsNotNone(self.pms.clean_webhook_payload(payload, "gzip"))
+
+    def test_clean_webhook_payload_skips_invalid_events(self):
+        payload = json.loads(load_api_fixture("webhook_payload.json"))
+        payload["Events"] += [{"Name": "ReservationUpdated", "Value": {}}, "not an event", None]
+        cleaned_payload = self.pms.clean_webhook_payload(json.dumps(payload))
+        self.assertEqual(len(cleaned_payload["data"]["ReservationUpdated"]), 3)
+
+        payload["Events"] = {"Name": "ReservationUpdated"}
+        self.assertIsNone(self.pms.clean_webhook_payload(json.dumps(payload)))
+
     def test_handle_webhook(self):
         cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
         success = self.pms.handle_webhook(cleaned_payload)
@@ -32,3 +154,1267 @@ class PMS_Apaleotest(django.test.TestCase):
         self.assertEqual(stays.count(), 3)
         guests = Guest.objects.all()
         self.assertEqual(guests.count(), 3)
+
+    def test_handle_webhook_updates_existing_stays(self):
+        cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+        self.pms.handle_webhook(cleaned_payload)
+        self.pms.handle_webhook(cleaned_payload)
+        self.assertEqual(Stay.objects.filter(hotel=self.hotel).count(), 3)
+        stay = Stay.objects.get(pms_reservation_id="5a9469b7-f13f-4a8d-b092-afe400fd7721")
+        self.assertEqual(stay.status, Stay.Status.INSTAY)
+        self.assertEqual(stay.guest.language, "nl")
+
+    def test_handle_webhook_skips_unchanged_reservations(self):
+        cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+        self.assertEqual(self.pms.handle_webhook(cleaned_payload).skipped, [])
+        result = self.pms.handle_webhook(cleaned_payload)
+        self.assertEqual(len(result.processed), 3)
+        self.assertEqual(result.skipped, result.processed)
+
+    def test_handle_webhook_caches_guests(self):
+        cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+        self.assertTrue(self.pms.handle_webhook(cleaned_payload))
+        self.assertTrue(self.pms.handle_webhook(cleaned_payload))
+        self.assertEqual(self.get_guest_details.call_count, 3)
+        self.assertEqual(guest_cache.stats(), {"hits": 3, "misses": 3, "hit_rate": 0.5})
+
+    def test_ahandle_webhook(self):
+        cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+        self.assertTrue(async_to_sync(self.pms.ahandle_webhook)(cleaned_payload))
+        self.assertEqual(Stay.objects.filter(hotel=self.hotel).count(), 3)
+        self.assertEqual(Guest.objects.count(), 3)
+        self.assertEqual(self.aget_reservation_details.await_count, 3)
+        self.assertEqual(self.aget_guest_details.await_count, 3)
+        self.get_reservation_details.assert_not_called()
+
+        # The guests are cached now.
+        self.assertTrue(async_to_sync(self.pms.ahandle_webhook)(cleaned_payload))
+        self.assertEqual(self.aget_guest_details.await_count, 3)
+
+    def test_handle_webhook_deadline_passed(self):
+        cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+        result = self.pms.handle_webhook(cleaned_payload, Deadline(0))
+        self.assertEqual(len(result.deferred), 3)
+        self.assertFalse(result)
+        self.get_reservation_details.assert_not_called()
+        self.assertFalse(Stay.objects.exists())
+
+    def test_handle_webhook_no_time_to_retry(self):
+        failing_id = "7c22cb23-c517-48f9-a5d4-da811043bd67"
+
+        def flaky_reservation_details(reservation_id):
+            if reservation_id == failing_id:
+                raise APIError("The API is temporarily not available. Please try again.")
+            return fake_reservation_details(reservation_id)
+
+        self.get_reservation_details.side_effect = flaky_reservation_details
+        cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+        with mock.patch("hotel.pms.resilience.backoff_delay", return_value=60):
+            result = self.pms.handle_webhook(cleaned_payload, Deadline(30))
+        self.assertEqual(result.deferred, [failing_id])
+        self.assertEqual(len(result.processed), 2)
+        self.assertEqual(result.failed, [])
+
+    def test_ahandle_webhook_cancels_slow_calls(self):
+        slow_id = "7c22cb23-c517-48f9-a5d4-da811043bd67"
+
+        async def slow_reservation_details(reservation_id):
+            if reservation_id == slow_id:
+                await asyncio.sleep(10)
+            return fake_reservation_details(reservation_id)
+
+        self.aget_reservation_details.side_effect = slow_reservation_details
+        cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+        result = async_to_sync(self.pms.ahandle_webhook)(cleaned_payload, Deadline(0.3))
+        self.assertEqual(result.deferred, [slow_id])
+        self.assertEqual(len(result.processed), 2)
+        self.assertEqual(Stay.objects.count(), 2)
+
+    def test_handle_webhook_partial_failure(self):
+        failing_id = "7c22cb23-c517-48f9-a5d4-da811043bd67"
+
+        def flaky_reservation_details(reservation_id):
+            if reservation_id == failing_id:
+                raise APIError("The API is temporarily not available. Please try again.")
+            return fake_reservation_details(reservation_id)
+
+        self.get_reservation_details.side_effect = flaky_reservation_details
+        cleaned_payload = self.pms.clean_webhook_payload(load_api_fixture("webhook_payload.json"))
+        self.assertFalse(self.pms.handle_webhook(cleaned_payload))
+        self.assertEqual(
+            set(Stay.objects.values_list("pms_reservation_id", flat=True)),
+            {"5a9469b7-f13f-4a8d-b092-afe400fd7721", "7c22cb23-c517-48f9-a5d4-da811023bd67"},
+        )
+
+
+@override_settings(WEBHOOK_COALESCE_WINDOW=0)
+class WebhookInboxTest(django.test.TestCase):
+    def setUp(self) -> None:
+        self.hotel = HotelFactory(pms=Hotel.PMS.APALEO)
+
+    def test_webhook_is_stored_and_acknowledged(self):
+        response = self.client.post(
+            reverse("webhook", args=["apaleo"]),
+            data=load_api_fixture("webhook_payload.json"),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 202)
+        item = WebhookInboxItem.objects.get()
+        self.assertEqual(item.status, WebhookInboxItem.Status.PENDING)
+        self.assertEqual(bytes(item.body), load_api_fixture("webhook_payload.json").encode())
+
+    @override_settings(WEBHOOK_MAX_BODY_BYTES=100)
+    def test_webhook_too_large(self):
+        response = self.client.post(
+            reverse("webhook", args=["apaleo"]),
+            data=load_api_fixture("webhook_payload.json"),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 413)
+
+    def test_webhook_invalid_content_length(self):
+        for content_length in ("abc", "-1"):
+            with self.subTest(content_length=content_length):
+                response = self.client.post(
+                    reverse("webhook", args=["apaleo"]),
+                    data=load_api_fixture("webhook_payload.json"),
+                    content_type="application/json",
+                    CONTENT_LENGTH=content_length,
+                )
+                self.assertEqual(response.status_code, 400)
+        self.assertFalse(WebhookInboxItem.objects.exists())
+
+    def test_webhook_gzip(self):
+        response = self.client.post(
+            reverse("webhook", args=["apaleo"]),
+            data=gzip.compress(load_api_fixture("webhook_payload.json").encode()),
+            content_type="application/json",
+            headers={"Content-Encoding": "gzip"},
+        )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(WebhookInboxItem.objects.get().content_encoding, "gzip")
+
+    def test_webhook_only_accepts_post(self):
+        self.assertEqual(self.client.get(reverse("webhook", args=["apaleo"])).status_code, 405)
+
+    def test_webhook_unknown_pms(self):
+        response = self.client.post(reverse("webhook", args=["unknown"]), data="{}", content_type="application/json")
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(WebhookInboxItem.objects.exists())
+
+    def test_process_batch(self):
+        valid = WebhookInboxItem.objects.create(pms_name="apaleo", body=load_api_fixture("webhook_payload.json").encode())
+        faulty = WebhookInboxItem.objects.create(
+            pms_name="apaleo", body=load_api_fixture("webhook_payload_faulty.json").encode()
+        )
+        with mock.patch(
+            "hotel.pms.apaleo.apaleo.Apaleo.handle_webhook", return_value=WebhookResult()
+        ) as handle_webhook:
+            result = process_batch()
+
+        self.assertEqual(result, {"claimed": 2, "succeeded": 1, "failed": 1, "deferred": 0, "skipped": 0})
+        self.assertEqual(handle_webhook.call_args.args[0]["hotel_id"], self.hotel.id)
+        valid.refresh_from_db()
+        faulty.refresh_from_db()
+        self.assertEqual(valid.status, WebhookInboxItem.Status.DONE)
+        self.assertEqual(faulty.status, WebhookInboxItem.Status.FAILED)
+
+    def test_aprocess_batch(self):
+        WebhookInboxItem.objects.create(pms_name="apaleo", body=load_api_fixture("webhook_payload.json").encode())
+        with mock.patch(
+            "hotel.pms.apaleo.apaleo.Apaleo.ahandle_webhook", new_callable=mock.AsyncMock, return_value=WebhookResult()
+        ) as ahandle_webhook:
+            result = async_to_sync(aprocess_batch)()
+
+        self.assertEqual(result, {"claimed": 1, "succeeded": 1, "failed": 0, "deferred": 0, "skipped": 0})
+        self.assertEqual(ahandle_webhook.await_args.args[0]["hotel_id"], self.hotel.id)
+        self.assertEqual(WebhookInboxItem.objects.get().status, WebhookInboxItem.Status.DONE)
+
+    def test_process_batch_retries_later(self):
+        item = WebhookInboxItem.objects.create(pms_name="apaleo", body=load_api_fixture("webhook_payload.json").encode())
+        with mock.patch("hotel.pms.apaleo.apaleo.Apaleo.handle_webhook", side_effect=RuntimeError("down")):
+            process_batch()
+            # The failed item is not claimed again before its retry delay has passed.
+            self.assertEqual(process_batch()["claimed"], 0)
+
+        item.refresh_from_db()
+        self.assertEqual(item.status, WebhookInboxItem.Status.PENDING)
+        self.assertEqual(item.attempts, 1)
+        self.assertIsNotNone(item.next_attempt_at)
+
+    def test_failed_reservations_are_dead_lettered_not_retried(self):
+        for _ in range(3):
+            WebhookInboxItem.objects.create(pms_name="apaleo", body=load_api_fixture("webhook_payload.json").encode())
+        failed_id = "5a9469b7-f13f-4a8d-b092-afe400fd7721"
+        result = WebhookResult(
+            processed=["7c22cb23-c517-48f9-a5d4-da811043bd67"],
+            failed=[failed_id, "7c22cb23-c517-48f9-a5d4-da811023bd67"],
+            errors={failed_id: "Down"},
+        )
+        with mock.patch("hotel.pms.apaleo.apaleo.Apaleo.handle_webhook", return_value=result) as handle_webhook:
+            self.assertEqual(process_batch(), {"claimed": 3, "succeeded": 3, "failed": 0, "deferred": 0, "skipped": 0})
+            WebhookInboxItem.objects.update(next_attempt_at=None)
+            self.assertEqual(process_batch()["claimed"], 0)
+        self.assertEqual(handle_webhook.call_count, 1)
+        self.assertEqual(set(WebhookInboxItem.objects.values_list("status", "attempts")), {("done", 1)})
+        self.assertEqual(
+            dict(DeadLetter.objects.values_list("pms_reservation_id", "attempts")),
+            {failed_id: 1, "7c22cb23-c517-48f9-a5d4-da811023bd67": 1},
+        )
+
+    @override_settings(WEBHOOK_INBOX_MAX_ATTEMPTS=2)
+    def test_claim_counts_attempts(self):
+        item = WebhookInboxItem.objects.create(pms_name="apaleo", body=load_api_fixture("webhook_payload.json").encode())
+        # Claims of a worker that crashes before it finishes the item.
+        for attempts in (1, 2):
+            self.assertEqual(claim_batch(10), [item])
+            item.refresh_from_db()
+            self.assertEqual(item.attempts, attempts)
+            WebhookInboxItem.objects.update(claimed_at=timezone.now() - datetime.timedelta(days=1))
+
+        with mock.patch("hotel.pms.apaleo.apaleo.Apaleo.handle_webhook") as handle_webhook:
+            self.assertEqual(process_batch()["failed"], 1)
+        handle_webhook.assert_not_called()
+        item.refresh_from_db()
+        self.assertEqual(item.status, WebhookInboxItem.Status.FAILED)
+        self.assertEqual(item.attempts, 3)
+
+    def test_process_batch_coalesces_webhooks(self):
+        payload = load_api_fixture("webhook_payload.json")
+        for _ in range(3):
+            WebhookInboxItem.objects.create(pms_name="apaleo", body=payload.encode())
+        with mock.patch(
+            "hotel.pms.apaleo.apaleo.Apaleo.handle_webhook", return_value=WebhookResult()
+        ) as handle_webhook:
+            result = process_batch()
+
+        self.assertEqual(result, {"claimed": 3, "succeeded": 3, "failed": 0, "deferred": 0, "skipped": 0})
+        handle_webhook.assert_called_once()
+        self.assertEqual(
+            handle_webhook.call_args.args[0]["data"],
+            {
+                "ReservationUpdated": [
+                    "5a9469b7-f13f-4a8d-b092-afe400fd7721",
+                    "7c22cb23-c517-48f9-a5d4-da811043bd67",
+                    "7c22cb23-c517-48f9-a5d4-da811023bd67",
+                ]
+            },
+        )
+
+    def test_process_batch_defers_reservations(self):
+        item = WebhookInboxItem.objects.create(pms_name="apaleo", body=load_api_fixture("webhook_payload.json").encode())
+        deferred_id = "7c22cb23-c517-48f9-a5d4-da811043bd67"
+        result = WebhookResult(processed=["5a9469b7-f13f-4a8d-b092-afe400fd7721"], deferred=[deferred_id])
+        with mock.patch("hotel.pms.apaleo.apaleo.Apaleo.handle_webhook", return_value=result) as handle_webhook:
+            self.assertEqual(process_batch(), {"claimed": 1, "succeeded": 1, "failed": 0, "deferred": 1, "skipped": 0})
+            item.refresh_from_db()
+            self.assertEqual(item.status, WebhookInboxItem.Status.DONE)
+            deferred = DeferredReservation.objects.get()
+            self.assertEqual((deferred.hotel, deferred.pms_reservation_id), (self.hotel, deferred_id))
+
+            # A deferred reservation is handled again once it is due, and deferred again if needed.
+            self.assertEqual(process_batch()["deferred"], 0)
+            DeferredReservation.objects.update(retry_at=deferred.deferred_at)
+            handle_webhook.return_value = WebhookResult(deferred=[deferred_id])
+            self.assertEqual(process_batch(), {"claimed": 0, "succeeded": 0, "failed": 0, "deferred": 1, "skipped": 0})
+
+        self.assertEqual(
+            handle_webhook.call_args.args[0], {"hotel_id": self.hotel.id, "data": {"Deferred": [deferred_id]}}
+        )
+        self.assertIsInstance(handle_webhook.call_args.args[1], Deadline)
+        self.assertEqual(DeferredReservation.objects.get().attempts, 2)
+
+    def test_claimed_deferred_reservations_are_kept_until_handled(self):
+        reservation_id = "7c22cb23-c517-48f9-a5d4-da811043bd67"
+        DeferredReservation.objects.create(
+            hotel=self.hotel, pms_reservation_id=reservation_id, attempts=1, retry_at=timezone.now()
+        )
+        # A worker that claims it and crashes does not lose it, it is due again after the claim timeout.
+        self.assertEqual(claim_deferred(10)[0], {self.hotel.id: {reservation_id: 1}})
+        self.assertEqual(claim_deferred(10)[0], {})
+        DeferredReservation.objects.update(retry_at=timezone.now())
+
+        result = WebhookResult(processed=[reservation_id])
+        with mock.patch("hotel.pms.apaleo.apaleo.Apaleo.handle_webhook", return_value=result) as handle_webhook:
+            process_batch()
+        self.assertEqual(handle_webhook.call_args.args[0]["data"], {"Deferred": [reservation_id]})
+        self.assertFalse(DeferredReservation.objects.exists())
+
+    @override_settings(WEBHOOK_INBOX_MAX_ATTEMPTS=2)
+    def test_failed_deferred_reservation_becomes_dead_letter(self):
+        reservation_id = "7c22cb23-c517-48f9-a5d4-da811043bd67"
+        DeferredReservation.objects.create(
+            hotel=self.hotel, pms_reservation_id=reservation_id, attempts=1, retry_at=timezone.now()
+        )
+        result = WebhookResult(failed=[reservation_id], errors={reservation_id: "Down"})
+        with mock.patch("hotel.pms.apaleo.apaleo.Apaleo.handle_webhook", return_value=result):
+            # Deferred again while it has attempts left, without a dead letter.
+            self.assertEqual(process_batch()["deferred"], 1)
+            self.assertEqual(DeferredReservation.objects.get().attempts, 2)
+            self.assertFalse(DeadLetter.objects.exists())
+
+            # A dead letter once they are spent, and no longer deferred.
+            DeferredReservation.objects.update(retry_at=timezone.now())
+            self.assertEqual(process_batch()["deferred"], 0)
+        self.assertFalse(DeferredReservation.objects.exists())
+        dead_letter = DeadLetter.objects.get()
+        self.assertEqual((dead_letter.pms_reservation_id, dead_letter.error), (reservation_id, "Down"))
+
+    def test_guestline_webhooks_are_skipped(self):
+        hotel = HotelFactory(pms=Hotel.PMS.GUESTLINE)
+        payload = json.loads(load_api_fixture("webhook_payload.json"))
+        payload["HotelId"] = hotel.pms_hotel_id
+        WebhookInboxItem.objects.create(pms_name="guestline", body=json.dumps(payload).encode())
+        self.assertEqual(process_batch(), {"claimed": 1, "succeeded": 1, "failed": 0, "deferred": 0, "skipped": 3})
+        self.assertEqual(WebhookInboxItem.objects.get().status, WebhookInboxItem.Status.DONE)
+        self.assertFalse(DeadLetter.objects.exists())
+
+    @override_settings(WEBHOOK_COALESCE_WINDOW=60)
+    def test_process_batch_waits_for_coalesce_window(self):
+        WebhookInboxItem.objects.create(pms_name="apaleo", body=load_api_fixture("webhook_payload.json").encode())
+        self.assertEqual(process_batch()["claimed"], 0)
+
+
+class UpsertStaysTest(django.test.TestCase):
+    def setUp(self) -> None:
+        self.hotel = HotelFactory(pms=Hotel.PMS.APALEO)
+
+    def stay(self, reservation_id, status=Stay.Status.BEFORE, phone="+31612345678"):
+        return StayDetails(
+            pms_reservation_id=reservation_id,
+            pms_guest_id=f"guest-{reservation_id}",
+            status=status,
+            guest=GuestDetails(pms_guest_id=f"guest-{reservation_id}", name="Jane Doe", phone=phone, country="NL"),
+        )
+
+    def test_upsert_counts(self):
+        result = upsert_stays(self.hotel, [self.stay("1"), self.stay("2", phone="+31687654321")])
+        self.assertEqual(result.stays, UpsertResult(created=2))
+        self.assertEqual(result.guests, UpsertResult(created=2))
+
+        # Savepoint, one select per model, one upsert for the changed stays and the savepoint release.
+        with self.assertNumQueries(5):
+            result = upsert_stays(
+                self.hotel,
+                [self.stay("1"), self.stay("2", Stay.Status.INSTAY, phone="+31687654321"), self.stay("3")],
+            )
+        self.assertEqual(result.stays, UpsertResult(created=1, updated=1, unchanged=1))
+        self.assertEqual(result.guests, UpsertResult(unchanged=2))
+
+        self.assertEqual(Stay.objects.get(pms_reservation_id="2").status, Stay.Status.INSTAY)
+        self.assertEqual(Stay.objects.get(pms_reservation_id="3").guest.phone, "+31612345678")
+
+    def test_upsert_skips_unchanged_stays(self):
+        upsert_stays(self.hotel, [self.stay("1"), self.stay("2", phone="+31687654321")])
+        updated_at = Stay.objects.get(pms_reservation_id="1").updated_at
+
+        # Savepoint, the select of the stays and the savepoint release, no guest lookup or write.
+        with self.assertNumQueries(3):
+            result = upsert_stays(self.hotel, [self.stay("1"), self.stay("2", phone="+31687654321")])
+        self.assertEqual(result.skipped, ["1", "2"])
+        self.assertEqual(result.stays, UpsertResult(unchanged=2))
+        self.assertEqual(Stay.objects.get(pms_reservation_id="1").updated_at, updated_at)
+
+        # A changed guest is written, without counting its stay as updated.
+        stay = self.stay("1")
+        stay.guest.name = "Jane Smith"
+        result = upsert_stays(self.hotel, [stay])
+        self.assertEqual(result.skipped, [])
+        self.assertEqual(result.stays, UpsertResult(unchanged=1))
+        self.assertEqual(result.guests, UpsertResult(updated=1))
+        self.assertEqual(Stay.objects.get(pms_reservation_id="1").guest.name, "Jane Smith")
+
+    def test_upsert_without_guest_phone(self):
+        result = upsert_stays(self.hotel, [self.stay("1", phone=None)])
+        self.assertEqual(result.stays.created, 1)
+        self.assertEqual(result.guests, UpsertResult())
+        self.assertIsNone(Stay.objects.get().guest)
+
+    def test_upsert_keeps_guest_without_guest_details(self):
+        upsert_stays(self.hotel, [self.stay("1")])
+        stay = self.stay("1", Stay.Status.INSTAY)
+        stay.guest = None
+        result = upsert_stays(self.hotel, [stay])
+        self.assertEqual(result.stays, UpsertResult(updated=1))
+        self.assertEqual(Stay.objects.get().guest.phone, "+31612345678")
+
+        stay.pms_guest_id = "another-guest"
+        upsert_stays(self.hotel, [stay])
+        self.assertIsNone(Stay.objects.get().guest)
+
+    def test_upsert_matches_normalized_phone(self):
+        legacy = Guest.objects.create(name="Jane Doe", phone="+31612345678")
+        keyed = Guest.objects.create(name="John Doe", phone="0687654321", phone_key="+31687654321")
+        stay = self.stay("1", phone="0031 6 12345678")
+        result = upsert_stays(self.hotel, [stay, self.stay("2", phone="06-87654321")])
+        self.assertEqual(result.guests, UpsertResult(updated=1, unchanged=1))
+        self.assertEqual(Stay.objects.get(pms_reservation_id="1").guest, legacy)
+        self.assertEqual(Stay.objects.get(pms_reservation_id="2").guest, keyed)
+        self.assertEqual(Guest.objects.get(id=legacy.id).phone_key, "+31612345678")
+
+    def test_upsert_keys_one_guest_per_phone_number(self):
+        # Guest.phone is unique, so the guests that share a phone key have different raw phone numbers.
+        legacy = Guest.objects.create(name="Jane Doe", phone="+31612345678")
+        keyed = Guest.objects.create(name="Jane Doe", phone="0612345678", phone_key="+31612345678")
+        result = upsert_stays(self.hotel, [self.stay("1"), self.stay("2")])
+        self.assertEqual(result.guests, UpsertResult(unchanged=1))
+        self.assertEqual(set(Stay.objects.values_list("guest", flat=True)), {keyed.id})
+        self.assertIsNone(Guest.objects.get(id=legacy.id).phone_key)
+
+    def test_upsert_uses_guest_with_phone_number_and_another_key(self):
+        guest = Guest.objects.create(name="Jane Doe", phone="+31612345678", phone_key="+31687654321")
+        result = upsert_stays(self.hotel, [self.stay("1"), self.stay("2", phone="+31687654321")])
+        self.assertEqual(result.guests, UpsertResult(unchanged=2))
+        self.assertEqual(set(Stay.objects.values_list("guest", flat=True)), {guest.id})
+        self.assertEqual(Guest.objects.count(), 1)
+
+
+class UpsertUpsellProductsTest(django.test.TestCase):
+    def setUp(self) -> None:
+        self.hotel = HotelFactory(pms=Hotel.PMS.APALEO)
+        self.pms = self.hotel.get_pms()
+
+    def test_get_upsell_products_saves_catalog(self):
+        products = self.pms.get_upsell_products()
+        self.assertEqual(self.hotel.upsell_products.count(), len(products))
+        breakfast = self.hotel.upsell_products.get(pms_id="BER-BRKF")
+        self.assertEqual(
+            (breakfast.type, breakfast.price, breakfast.currency, breakfast.per_whom, breakfast.offered_days),
+            ("BREAKFAST", Decimal("15.00"), "EUR", "GUEST", ["EVERYDAY"]),
+        )
+        self.assertEqual(self.hotel.upsell_products.get(pms_id="BER-WLAN").per_whom, "ROOM")
+        self.assertEqual(self.hotel.upsell_products.get(pms_id="BER-CLEANING").availability_when, "ON_DEPARTURE")
+
+        result = self.pms.bulk_upsert(products)
+        self.assertEqual(result, UpsellProductUpsertResult(unchanged=len(products)))
+
+    def test_upsert_writes_only_changes(self):
+        products = self.pms.retrieve_products_api()
+        upsert_upsell_products(self.hotel, products)
+        manual = UpsellProduct.objects.create(
+            hotel=self.hotel, upsell_id=uuid.uuid4(), name="Flowers", type="OTHER", price=20, currency="EUR",
+            per_whom="ROOM", availability_when="ON_ARRIVAL",
+        )
+        updated_at = dict(self.hotel.upsell_products.values_list("pms_id", "updated_at"))
+
+        changed = products[0].model_copy(update={"price": "17.5 EUR"})
+        result = upsert_upsell_products(self.hotel, [changed, *products[1:-1]])
+        self.assertEqual(result, UpsellProductUpsertResult(updated=1, unchanged=len(products) - 2, retired=1))
+        self.assertEqual(self.hotel.upsell_products.get(pms_id=changed.id).price, Decimal("17.50"))
+        self.assertFalse(self.hotel.upsell_products.get(pms_id=products[-1].id).is_bookable)
+        self.assertTrue(UpsellProduct.objects.get(id=manual.id).is_bookable)
+        self.assertEqual(self.hotel.upsell_products.get(pms_id=products[1].id).updated_at, updated_at[products[1].id])
+
+        # A product that the PMS returns again becomes bookable again.
+        result = upsert_upsell_products(self.hotel, products)
+        self.assertEqual(result, UpsellProductUpsertResult(updated=2, unchanged=len(products) - 2))
+        self.assertTrue(self.hotel.upsell_products.get(pms_id=products[-1].id).is_bookable)
+
+    def test_invalid_or_failed_catalog_keeps_products(self):
+        products = self.pms.get_upsell_products()
+        invalid = products[0].model_copy(update={"price": "None None"})
+        result = upsert_upsell_products(self.hotel, [invalid, *products[1:]])
+        self.assertEqual(result, UpsellProductUpsertResult(unchanged=len(products) - 1, invalid=[invalid.id]))
+
+        with mock.patch("hotel.pms.apaleo.apaleo.get_apaleo_upsell_products", side_effect=APIError("Down")):
+            self.assertIsNone(self.pms.get_upsell_products())
+        self.assertEqual(self.hotel.upsell_products.filter(is_bookable=True).count(), len(products))
+
+
+@override_settings(WEBHOOK_COALESCE_WINDOW=0, PMS_RETRY_BASE_DELAY=0, **NO_RATE_LIMITS)
+class DeadLetterTest(django.test.TestCase):
+    failing_reservation_id = "7c22cb23-c517-48f9-a5d4-da811023bd67"
+
+    def setUp(self) -> None:
+        self.hotel = HotelFactory(pms=Hotel.PMS.APALEO)
+        patch_external_api(self)
+        self.get_reservation_details.side_effect = self.fail_one
+        self.aget_reservation_details.side_effect = self.fail_one
+        guest_cache.clear()
+
+    def fail_one(self, reservation_id):
+        if reservation_id == self.failing_reservation_id:
+            raise APIError("The API is temporarily not available.")
+        return fake_reservation_details(reservation_id)
+
+    def test_failed_reservation_is_replayed(self):
+        WebhookInboxItem.objects.create(pms_name="apaleo", body=load_api_fixture("webhook_payload.json").encode())
+        process_batch()
+        dead_letter = DeadLetter.objects.get()
+        self.assertEqual(dead_letter.pms_reservation_id, self.failing_reservation_id)
+        self.assertEqual(dead_letter.attempts, 1)
+        self.assertIn("temporarily not available", dead_letter.error)
+
+        # Not due yet, then due but still failing: backed off for twice as long.
+        out = StringIO()
+        call_command("replay_dead_letters", stdout=out)
+        self.assertIn("Dead letters replayed: 0 reservations", out.getvalue())
+        DeadLetter.objects.update(retry_at=timezone.now())
+        call_command("replay_dead_letters", stdout=out)
+        dead_letter = DeadLetter.objects.get()
+        self.assertEqual(dead_letter.attempts, 2)
+        self.assertGreater(dead_letter.retry_at, timezone.now() + datetime.timedelta(seconds=100))
+
+        DeadLetter.objects.update(retry_at=timezone.now())
+        self.aget_reservation_details.side_effect = fake_reservation_details
+        out = StringIO()
+        call_command("replay_dead_letters", stdout=out)
+        self.assertIn("1 reservations, 1 recovered, 0 failed", out.getvalue())
+        self.assertFalse(DeadLetter.objects.exists())
+        self.assertTrue(Stay.objects.filter(pms_reservation_id=self.failing_reservation_id).exists())
+
+    @override_settings(DEAD_LETTER_REPLAY_BATCH_SIZE=2, DEAD_LETTER_MAX_ATTEMPTS=3)
+    def test_claim_dead_letters(self):
+        record_dead_letters(self.hotel.id, {f"reservation-{i}": "down" for i in range(5)})
+        DeadLetter.objects.update(retry_at=timezone.now())
+        DeadLetter.objects.filter(pms_reservation_id="reservation-4").update(attempts=3)
+        batches = claim_dead_letters(10)
+        self.assertEqual([len(attempts) for _, attempts in batches], [2, 2])
+        # Claimed dead letters are not claimed again until the claim times out.
+        self.assertEqual(claim_dead_letters(10), [])
+
+    def test_admin_shows_counts(self):
+        record_dead_letters(self.hotel.id, {"1": "down", "2": "down"})
+        user = User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.force_login(user)
+        response = self.client.get(reverse("admin:hotel_deadletter_changelist"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["dead_letter_totals"], {"total": 2, "due": 0, "exhausted": 0})
+        self.assertContains(response, "Dead letters per hotel")
+
+
+class AdvanceStayStatusTest(django.test.TestCase):
+    def setUp(self) -> None:
+        # 2024-05-01 11:00 UTC is already May 2nd in Kiribati (UTC+14).
+        patcher = mock.patch(
+            "django.utils.timezone.now",
+            return_value=datetime.datetime(2024, 5, 1, 11, tzinfo=datetime.timezone.utc),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.hotel = HotelFactory(timezone="Pacific/Kiritimati")
+
+    def stay(self, reservation_id, status, checkin, checkout):
+        return Stay.objects.create(
+            hotel=self.hotel,
+            pms_reservation_id=reservation_id,
+            status=status,
+            checkin=datetime.date(2024, 5, checkin),
+            checkout=datetime.date(2024, 5, checkout),
+        )
+
+    def test_advance_stay_status(self):
+        self.assertEqual(self.hotel.local_date(), datetime.date(2024, 5, 2))
+        expected = {
+            self.stay("arriving", Stay.Status.BEFORE, 2, 4): Stay.Status.INSTAY,
+            self.stay("departing", Stay.Status.INSTAY, 1, 2): Stay.Status.INSTAY,
+            self.stay("departed", Stay.Status.INSTAY, 1, 1): Stay.Status.AFTER,
+            self.stay("missed", Stay.Status.BEFORE, 1, 1): Stay.Status.AFTER,
+            self.stay("future", Stay.Status.BEFORE, 3, 4): Stay.Status.BEFORE,
+            self.stay("cancelled", Stay.Status.CANCEL, 1, 2): Stay.Status.CANCEL,
+        }
+        out = StringIO()
+        call_command("advance_stay_status", stdout=out)
+        self.assertIn("Advanced stays: 1 checked in, 2 checked out.", out.getvalue())
+        for stay, status in expected.items():
+            self.assertEqual(Stay.objects.get(id=stay.id).status, status, stay.pms_reservation_id)
+
+        # One update per status, and nothing left to change on the next run.
+        with self.assertNumQueries(2):
+            self.assertEqual(advance_stay_statuses(self.hotel), {Stay.Status.AFTER: 0, Stay.Status.INSTAY: 0})
+
+
+class PhoneKeyTest(django.test.TestCase):
+    def test_normalize_phone(self):
+        for phone, country, expected in [
+            ("+31 6 1234 5678", None, "+31612345678"),
+            ("0031612345678", None, "+31612345678"),
+            ("06-12345678", "NL", "+31612345678"),
+            ("(020) 123 4567", "nl", "+31201234567"),
+            # Italian numbers keep their leading 0, and mobile numbers have none.
+            ("06 1234 5678", "IT", "+390612345678"),
+            ("+39 06 1234 5678", None, "+390612345678"),
+            ("347 123 4567", "it", "+393471234567"),
+            ("0612345678", None, None),
+            ("0612345678", "XX", None),
+            ("+99912345678", None, None),
+            ("+4912", None, None),
+            ("123", "DE", None),
+            ("Not available", "DE", None),
+            ("", None, None),
+            (None, None, None),
+        ]:
+            with self.subTest(phone=phone, country=country):
+                self.assertEqual(normalize_phone(phone, country), expected)
+
+    def test_backfill_phone_keys(self):
+        Guest.objects.create(name="A", phone="+31 612345678")
+        Guest.objects.create(name="B", phone="0612345678", language="nl")
+        Guest.objects.create(name="C", phone="0201234567", language="de")
+        Guest.objects.create(name="D", phone="Not available")
+        Guest.objects.create(name="E", phone="+4915112345678", phone_key="+4930123456")
+        Guest.objects.create(name="F", phone="+4930123456")
+        out = StringIO()
+        call_command("backfill_phone_keys", batch_size=2, stdout=out)
+        self.assertIn("Backfilled 2 phone keys, 1 guests without a valid phone number, 2 duplicate", out.getvalue())
+        self.assertEqual(
+            dict(Guest.objects.values_list("name", "phone_key")),
+            {"A": "+31612345678", "B": None, "C": "+49201234567", "D": None, "E": "+4930123456", "F": None},
+        )
+
+
+@override_settings(PMS_RETRY_BASE_DELAY=0, PMS_SYNC_BATCH_SIZE=3, **NO_RATE_LIMITS)
+class SyncReservationsTest(django.test.TestCase):
+    def setUp(self) -> None:
+        self.hotel = HotelFactory(pms=Hotel.PMS.APALEO)
+        self.checkin = datetime.date(2024, 5, 1)
+        patcher = mock.patch(
+            "hotel.pms.apaleo.apaleo.get_reservations_for_given_checkin_date",
+            side_effect=fake_reservations_for_checkin_date,
+        )
+        self.get_reservations = patcher.start()
+        self.addCleanup(patcher.stop)
+        resilience.reset_breakers()
+
+    def sync(self, *args):
+        out = StringIO()
+        call_command(
+            "sync_reservations", "--from", "2024-05-01", "--to", "2024-05-03", "--hotel", str(self.hotel.id), *args,
+            stdout=out,
+        )
+        return out.getvalue()
+
+    def test_sync_reservations(self):
+        reservation = json.loads(fake_reservations_for_checkin_date("2024-05-01"))[0]
+        guest = Guest.objects.create(name="Jane Doe", phone="+31612345678")
+        Stay.objects.create(
+            hotel=self.hotel,
+            guest=guest,
+            pms_reservation_id=reservation["ReservationId"],
+            pms_guest_id=reservation["GuestId"],
+            status=Stay.Status.INSTAY,
+        )
+
+        output = self.sync()
+        self.assertIn("6 reservations over 3 dates, 5 missing, 1 stale, 0 in sync (drift 100.0%)", output)
+        self.assertEqual(self.get_reservations.call_count, 3)
+        self.assertEqual(Stay.objects.filter(hotel=self.hotel).count(), 6)
+        stay = Stay.objects.get(pms_reservation_id=reservation["ReservationId"])
+        self.assertEqual(stay.status, Stay.Status.BEFORE)
+        self.assertEqual(stay.guest, guest)
+
+        self.assertIn("6 reservations over 3 dates, 0 missing, 0 stale, 6 in sync (drift 0.0%)", self.sync())
+
+    @override_settings(**NO_RATE_LIMITS)
+    def test_sync_keeps_fingerprints_of_webhooks(self):
+        reservation = json.loads(fake_reservations_for_checkin_date("2024-05-01"))[0]
+        reservation_id = reservation["ReservationId"]
+        patch_external_api(self)
+        self.get_reservation_details.side_effect = lambda _: json.dumps(reservation)
+        pms = self.hotel.get_pms()
+        payload = {"hotel_id": self.hotel.id, "data": {"ReservationUpdated": [reservation_id]}}
+        self.assertEqual(pms.handle_webhook(payload).processed, [reservation_id])
+        written = Stay.objects.get(pms_reservation_id=reservation_id)
+
+        # A sync without guest details and the next webhook with them write nothing.
+        self.assertIn("6 reservations over 3 dates, 5 missing, 0 stale, 1 in sync", self.sync())
+        self.assertEqual(pms.handle_webhook(payload).skipped, [reservation_id])
+        stay = Stay.objects.get(pms_reservation_id=reservation_id)
+        self.assertEqual((stay.updated_at, stay.fingerprint), (written.updated_at, written.fingerprint))
+
+    def test_sync_reservations_failed_dates(self):
+        def get_reservations(checkin_date):
+            if checkin_date == "2024-05-02":
+                raise APIError("The API is temporarily not available. Please try again.")
+            return fake_reservations_for_checkin_date(checkin_date)
+
+        self.get_reservations.side_effect = get_reservations
+        with self.assertRaises(CommandError):
+            self.sync()
+        self.assertEqual(Stay.objects.count(), 4)
+
+    def test_sync_fetches_each_date_once(self):
+        other = HotelFactory(pms=Hotel.PMS.APALEO, pms_hotel_id="0b4f5a1c-3f8a-4a86-9d0e-64f1d2c3b4a5")
+        output = self.sync("--hotel", str(other.id))
+        self.assertEqual(self.get_reservations.call_count, 3)
+        self.assertIn(f"{self.hotel}: 6 reservations over 3 dates", output)
+        self.assertIn(f"{other}: 3 reservations over 3 dates", output)
+        self.assertEqual(Stay.objects.filter(hotel=other).count(), 3)
+
+    @override_settings(PMS_RETRY_ATTEMPTS=1, PMS_CIRCUIT_BREAKER_FAILURE_THRESHOLD=1)
+    def test_sync_makes_pms_level_calls(self):
+        # The fetches neither use up the rate limit of the first hotel nor open its circuit breaker.
+        self.get_reservations.side_effect = APIError("The API is temporarily not available. Please try again.")
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+            PMS_HOTEL_RATE_LIMITS={"Apaleo": {"rate": 0.001, "burst": 1}}, PMS_RATE_LIMIT_DIR=directory
+        ):
+            with self.assertRaises(CommandError):
+                self.sync()
+            resilience.rate_limiter.acquire("Apaleo", self.hotel.id, timeout=0)
+        self.assertEqual(resilience.get_breaker("Apaleo").state, resilience.CircuitBreaker.OPEN)
+        self.assertEqual(resilience.get_breaker("Apaleo", self.hotel.id).state, resilience.CircuitBreaker.CLOSED)
+
+    def test_sync_reservations_continues_after_errors(self):
+        def get_reservations(checkin_date):
+            if checkin_date == "2024-05-02":
+                return "not json"
+            return fake_reservations_for_checkin_date(checkin_date)
+
+        save_stays = Apaleo.save_stays
+
+        def save_once(pms, stays):
+            if not Stay.objects.exists():
+                return save_stays(pms, stays)
+            raise RuntimeError("The database is locked.")
+
+        self.get_reservations.side_effect = get_reservations
+        with override_settings(PMS_SYNC_BATCH_SIZE=1), self.assertRaises(CommandError):
+            with mock.patch.object(Apaleo, "save_stays", autospec=True, side_effect=save_once):
+                self.sync()
+        # One date could not be fetched and one could not be saved, the third one was synced.
+        self.assertEqual(Stay.objects.count(), 2)
+
+    def test_sync_reservations_unsupported_pms(self):
+        self.hotel.pms = Hotel.PMS.GUESTLINE
+        self.hotel.save()
+        self.assertIn("GuestLine does not support syncing reservations.", self.sync())
+
+
+@override_settings(
+    PMS_RETRY_ATTEMPTS=3,
+    PMS_RETRY_BASE_DELAY=0,
+    PMS_CIRCUIT_BREAKER_FAILURE_THRESHOLD=3,
+    PMS_CIRCUIT_BREAKER_RESET_TIMEOUT=60,
+    **NO_RATE_LIMITS,
+)
+class ResilienceTest(django.test.SimpleTestCase):
+    def setUp(self) -> None:
+        resilience.reset_breakers()
+        resilience.stats.reset()
+
+    def call(self, func, hotel_id=1):
+        return resilience.call_with_resilience(func, pms_name="Apaleo", hotel_id=hotel_id)
+
+    def test_retries_until_success(self):
+        func = mock.Mock(side_effect=[APIError("down"), APIError("down"), "ok"])
+        self.assertEqual(self.call(func), "ok")
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(resilience.stats.snapshot()["retries"], 2)
+
+    def test_async_retries_until_success(self):
+        func = mock.AsyncMock(side_effect=[APIError("down"), "ok"])
+        result = async_to_sync(resilience.acall_with_resilience)(func, pms_name="Apaleo", hotel_id=1)
+        self.assertEqual(result, "ok")
+        self.assertEqual(func.await_count, 2)
+
+    def test_circuit_opens_and_probes(self):
+        func = mock.Mock(side_effect=APIError("down"))
+        with self.assertRaises(APIError):
+            self.call(func)
+        # The open circuit stops the calls without reaching the PMS, for every hotel on the PMS.
+        with self.assertRaises(resilience.CircuitOpenError):
+            self.call(func, hotel_id=2)
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(resilience.stats.snapshot()["circuits_opened"], 2)
+
+        # After the reset timeout a single probe call closes the circuit again.
+        for key in (("Apaleo", None), ("Apaleo", 1)):
+            resilience.get_breaker(*key).opened_at -= 60
+        func.side_effect = None
+        func.return_value = "ok"
+        self.assertEqual(self.call(func), "ok")
+        self.assertEqual(resilience.get_breaker("Apaleo").state, resilience.CircuitBreaker.CLOSED)
+
+    def test_probe_that_raises_is_given_back(self):
+        def open_breakers():
+            for key in (("Apaleo", None), ("Apaleo", 1)):
+                breaker = resilience.get_breaker(*key)
+                breaker.state, breaker.opened_at = resilience.CircuitBreaker.OPEN, 0.0
+
+        open_breakers()
+        with self.assertRaises(ValueError):
+            self.call(mock.Mock(side_effect=ValueError("bug")))
+        self.assertEqual(self.call(mock.Mock(return_value="ok")), "ok")
+
+        open_breakers()
+
+        async def cancelled():
+            raise asyncio.CancelledError()
+
+        with self.assertRaises(asyncio.CancelledError):
+            async_to_sync(resilience.acall_with_resilience)(cancelled, pms_name="Apaleo", hotel_id=1)
+        self.assertEqual(self.call(mock.Mock(return_value="ok")), "ok")
+        self.assertEqual(resilience.get_breaker("Apaleo", 1).state, resilience.CircuitBreaker.CLOSED)
+
+
+def _take_tokens(directory: str) -> int:
+    buckets = FileTokenBuckets(directory)
+    return sum(not buckets.take([("Apaleo", Rate(rate=0.001, burst=10))]) for _ in range(10))
+
+
+class RateLimiterTest(django.test.SimpleTestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings = override_settings(
+            PMS_RATE_LIMITS={"Apaleo": {"rate": 0.001, "burst": 3}},
+            PMS_HOTEL_RATE_LIMITS={"Apaleo": {"rate": 0.001, "burst": 2}},
+            PMS_RATE_LIMIT_DIR=self.directory,
+            PMS_RATE_LIMIT_TIMEOUT=0,
+            PMS_RETRY_BASE_DELAY=0,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.limiter = RateLimiter()
+        resilience.reset_breakers()
+        resilience.stats.reset()
+
+    def test_hotel_and_pms_buckets(self):
+        self.limiter.acquire("Apaleo", 1)
+        self.limiter.acquire("Apaleo", 1)
+        with self.assertRaises(RateLimitExceeded):
+            self.limiter.acquire("Apaleo", 1)
+        # Another hotel has its own bucket, but shares the one of the PMS.
+        self.limiter.acquire("Apaleo", 2)
+        with self.assertRaises(RateLimitExceeded):
+            self.limiter.acquire("Apaleo", 2)
+        # A PMS without rate limits is not limited.
+        self.limiter.acquire("GuestLine", 1)
+
+    def test_waits_for_tokens(self):
+        with override_settings(PMS_RATE_LIMITS={"Apaleo": {"rate": 50, "burst": 1}}, PMS_HOTEL_RATE_LIMITS={}):
+            started = time.monotonic()
+            for _ in range(3):
+                self.limiter.acquire("Apaleo", 1, timeout=1)
+            async_to_sync(self.limiter.aacquire)("Apaleo", 1, timeout=1)
+            self.assertGreaterEqual(time.monotonic() - started, 0.05)
+
+    def test_shared_by_processes(self):
+        with multiprocessing.get_context("fork").Pool(4) as pool:
+            taken = pool.map(_take_tokens, [self.directory] * 4)
+        self.assertEqual(sum(taken), 10)
+
+    def test_call_with_resilience(self):
+        func = mock.Mock(return_value="ok")
+        for _ in range(2):
+            resilience.call_with_resilience(func, pms_name="Apaleo", hotel_id=1)
+        with self.assertRaises(RateLimitExceeded):
+            resilience.call_with_resilience(func, pms_name="Apaleo", hotel_id=1)
+        # Waiting for a token is cut short by the deadline.
+        with self.assertRaises(resilience.DeadlineExceeded):
+            resilience.call_with_resilience(
+                func, pms_name="Apaleo", hotel_id=1, deadline=Deadline(0.01), rate_limit_timeout=5
+            )
+        self.assertEqual(func.call_count, 2)
+        self.assertEqual(resilience.stats.snapshot()["rate_limited"], 2)
+
+    def test_open_circuit_takes_no_token(self):
+        breaker = resilience.get_breaker("Apaleo")
+        breaker.state, breaker.opened_at = resilience.CircuitBreaker.OPEN, time.monotonic()
+        func = mock.Mock(return_value="ok")
+        for _ in range(3):
+            with self.assertRaises(resilience.CircuitOpenError):
+                resilience.call_with_resilience(func, pms_name="Apaleo", hotel_id=1)
+
+        # A probe that gets no token is given up, so the next call can probe.
+        breaker.opened_at -= 60
+        self.limiter.acquire("Apaleo", 1)
+        self.limiter.acquire("Apaleo", 1)
+        with self.assertRaises(RateLimitExceeded):
+            resilience.call_with_resilience(func, pms_name="Apaleo", hotel_id=1)
+        self.assertEqual(breaker.state, resilience.CircuitBreaker.OPEN)
+        func.assert_not_called()
+
+    def test_directory_created_once(self):
+        directory = f"{self.directory}/buckets"
+        buckets = FileTokenBuckets(directory)
+        with mock.patch("os.makedirs") as makedirs:
+            self.assertEqual(buckets.take([("Apaleo", Rate(rate=1, burst=1))]), 0)
+        makedirs.assert_not_called()
+
+
+class UpsellProductSpecTest(django.test.SimpleTestCase):
+    def test_compiled_spec_matches_adapters(self):
+        for pms, adapter, samples in PMS_CATALOGS:
+            catalog = samples()
+            with self.subTest(pms=pms.__name__):
+                self.assertEqual(
+                    [product.model_dump() for product in pms.upsell_product_spec.validate(catalog)],
+                    [adapter(product).convert().model_dump() for product in catalog],
+                )
+
+    def test_invalid_product(self):
+        catalog = get_apaleo_upsell_products()["services"]
+        del catalog[1]["name"]
+        with self.assertRaises(pydantic.ValidationError):
+            Apaleo.upsell_product_spec.validate(catalog)
+
+    def test_bench_upsell_adapters(self):
+        out = StringIO()
+        call_command("bench_upsell_adapters", "--products", "3", "--repeat", "1", stdout=out)
+        self.assertIn("Apaleo      3 products", out.getvalue())
+
+
+class PMSRegistryTest(django.test.SimpleTestCase):
+    def test_get_pms(self):
+        with mock.patch("hotel.pms.base.pkgutil.walk_packages") as walk_packages:
+            self.assertIs(get_pms("Apaleo"), Apaleo)
+            self.assertIs(get_pms(Hotel.PMS.GUESTLINE), GuestLine)
+        walk_packages.assert_not_called()
+
+    def test_get_pms_unknown(self):
+        with self.assertRaisesMessage(UnknownPMSError, "No such PMS: Mews"):
+            get_pms("Mews")
+
+
+class HotelCacheTest(django.test.TestCase):
+    def setUp(self) -> None:
+        self.hotel = HotelFactory(pms=Hotel.PMS.APALEO)
+        hotel_cache.clear()
+
+    def test_cached_lookups(self):
+        with self.assertNumQueries(2):
+            for _ in range(3):
+                by_pms = hotel_cache.get_by_pms_hotel_id(Hotel.PMS.APALEO, self.hotel.pms_hotel_id)
+                by_id = hotel_cache.get(self.hotel.id)
+        self.assertEqual(by_pms, self.hotel)
+        self.assertEqual(by_id, self.hotel)
+        self.assertEqual(hotel_cache.stats(), {"hits": 4, "misses": 2, "size": 2})
+        self.assertIsNone(hotel_cache.get_by_pms_hotel_id(Hotel.PMS.GUESTLINE, self.hotel.pms_hotel_id))
+
+    def test_invalidated_on_save_and_delete(self):
+        hotel_cache.get(self.hotel.id)
+        self.hotel.name = "Renamed"
+        self.hotel.save()
+        self.assertEqual(hotel_cache.get(self.hotel.id).name, "Renamed")
+
+        self.hotel.delete()
+        self.assertIsNone(hotel_cache.get_by_pms_hotel_id(Hotel.PMS.APALEO, "851df8c8-90f2-4c4a-8e01-a4fc46b25178"))
+
+    def test_bounded(self):
+        cache = HotelCache(maxsize=1, ttl=60)
+        other = HotelFactory(pms=Hotel.PMS.GUESTLINE)
+        cache.get(self.hotel.id)
+        cache.get(other.id)
+        self.assertEqual(cache.stats()["size"], 1)
+
+
+class GuestDetailsCacheTest(django.test.TestCase):
+    def guests(self, *guest_ids):
+        return {guest_id: GuestDetails(pms_guest_id=guest_id, name="Jane Doe") for guest_id in guest_ids}
+
+    def test_get_and_set_many(self):
+        cache = GuestDetailsCache(ttl=60, max_entries=10)
+        cache.set_many("Apaleo", self.guests("1", "2"))
+        with self.assertNumQueries(1):
+            self.assertEqual(cache.get_many("Apaleo", ["1", "2", "3"]), self.guests("1", "2"))
+        self.assertEqual(cache.get_many("GuestLine", ["1"]), {})
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 2, "hit_rate": 0.5})
+
+    def test_expired(self):
+        cache = GuestDetailsCache(ttl=0, max_entries=10)
+        cache.set_many("Apaleo", self.guests("1"))
+        self.assertEqual(cache.get_many("Apaleo", ["1"]), {})
+
+    def test_bounded(self):
+        cache = GuestDetailsCache(ttl=60, max_entries=2)
+        cache.set_many("Apaleo", self.guests("1"))
+        cache.set_many("Apaleo", self.guests("2", "3"))
+        self.assertEqual(set(cache.get_many("Apaleo", ["1", "2", "3"])), {"2", "3"})
+
+    def test_culled_periodically(self):
+        cache = GuestDetailsCache(ttl=60, max_entries=1, cull_interval=60)
+        cache.set_many("Apaleo", self.guests("1"))
+        # Only the upsert, the cull is not due yet.
+        with self.assertNumQueries(1):
+            cache.set_many("Apaleo", self.guests("2"))
+        self.assertEqual(len(cache.get_many("Apaleo", ["1", "2"])), 2)
+
+
+class UpsellCatalogCacheTest(django.test.TestCase):
+    def setUp(self) -> None:
+        self.hotel = HotelFactory(pms=Hotel.PMS.APALEO)
+        patcher = mock.patch("hotel.pms.apaleo.apaleo.get_apaleo_upsell_products", wraps=get_apaleo_upsell_products)
+        self.get_apaleo_upsell_products = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_fresh_and_stale(self):
+        cache = UpsellCatalogCache(maxsize=10, ttl=60, max_stale=60)
+        products = cache.get(self.hotel)
+        self.assertEqual(cache.get(self.hotel), products)
+        self.assertEqual(self.get_apaleo_upsell_products.call_count, 1)
+
+        cache.ttl = 0
+        cache.invalidate(self.hotel.id)
+        cache.get(self.hotel)
+        # A stale catalog is served right away, and refreshed once in the background.
+        with mock.patch("hotel.pms.cache._spawn_refresh") as spawn_refresh:
+            self.assertEqual(cache.get(self.hotel), products)
+            self.assertEqual(cache.get(self.hotel), products)
+        spawn_refresh.assert_called_once()
+        refresh, *args = spawn_refresh.call_args.args
+        refresh(*args)
+        self.assertEqual(self.get_apaleo_upsell_products.call_count, 3)
+        self.assertEqual(cache.stats(), {"hits": 1, "stale_hits": 2, "misses": 2, "size": 1})
+
+    def test_concurrent_misses_fetch_once(self):
+        cache = UpsellCatalogCache(maxsize=10, ttl=60, max_stale=60)
+        release = threading.Event()
+
+        def slow_products(pms):
+            release.wait(5)
+            return []
+
+        with mock.patch.object(Apaleo, "get_upsell_products", autospec=True, side_effect=slow_products) as fetch:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                results = [executor.submit(cache.get, self.hotel) for _ in range(4)]
+                while cache.stats()["misses"] < 4:
+                    time.sleep(0.01)
+                release.set()
+            self.assertEqual([result.result() for result in results], [[]] * 4)
+        fetch.assert_called_once()
+
+    def test_falls_back_to_saved_products(self):
+        cache = UpsellCatalogCache(maxsize=10, ttl=60, max_stale=60)
+        saved = {product.id for product in self.hotel.get_pms().get_upsell_products()}
+        self.get_apaleo_upsell_products.side_effect = APIError("Down")
+        self.assertEqual({product.id for product in cache.get(self.hotel)}, saved)
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_view_serves_cached_catalog(self):
+        upsell_catalog_cache.clear()
+        url = reverse("retrieve_upsell_products", args=[self.hotel.id])
+        first = self.client.get(url).json()["upsell_products"]
+        self.assertEqual(self.client.get(url).json()["upsell_products"], first)
+        self.assertEqual(self.get_apaleo_upsell_products.call_count, 1)
+        self.assertEqual(self.client.get(reverse("retrieve_upsell_products", args=[0])).status_code, 404)
+
+
+class ConditionalGetTest(django.test.TestCase):
+    def setUp(self) -> None:
+        self.hotels = HotelFactory.create_batch(5, pms=Hotel.PMS.APALEO)
+        hotel_cache.clear()
+        upsell_catalog_cache.clear()
+
+    def assertNotModified(self, url, etag, **headers):
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, **headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+    def test_hotels(self):
+        url = reverse("list_hotels")
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(len(json.loads(gzip.decompress(response.content))["hotels"]), 5)
+        # Compressed responses have a strong ETag of their own.
+        self.assertFalse(response["ETag"].startswith('W/'))
+        self.assertIn("Accept-Encoding", response["Vary"])
+        self.assertNotModified(url, response["ETag"], HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(self.client.get(url, HTTP_ACCEPT_ENCODING="gzip").content, response.content)
+
+        etag = self.client.get(url)["ETag"]
+        self.assertNotEqual(etag, response["ETag"])
+        self.assertNotModified(url, etag)
+        self.hotels[0].name = "Renamed"
+        self.hotels[0].save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_upsell_products(self):
+        url = reverse("retrieve_upsell_products", args=[self.hotels[0].id])
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertFalse(response["ETag"].startswith('W/'))
+        with self.assertNumQueries(0):
+            not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"], HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertIn("Accept-Encoding", not_modified["Vary"])
+        # The uncompressed response has another ETag.
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 200)
+        # The same catalog has the same ETag for every hotel and process.
+        other = reverse("retrieve_upsell_products", args=[self.hotels[1].id])
+        self.assertEqual(self.client.get(other)["ETag"], self.client.get(url)["ETag"])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"outdated"').status_code, 200)
+        self.assertEqual(self.client.get(reverse("retrieve_upsell_products", args=[0])).status_code, 404)
+
+    def test_upsell_products_resolved_once(self):
+        url = reverse("retrieve_upsell_products", args=[self.hotels[0].id])
+        saved = self.client.get(url).json()["upsell_products"]
+        upsell_catalog_cache.clear()
+        with mock.patch("hotel.pms.apaleo.apaleo.get_apaleo_upsell_products", side_effect=APIError("Down")), \
+                mock.patch.object(UpsellCatalogCache, "persisted", wraps=UpsellCatalogCache.persisted) as persisted:
+            response = self.client.get(url)
+        ids = [product["id"] for product in response.json()["upsell_products"]]
+        self.assertEqual(ids, [product["id"] for product in saved])
+        self.assertEqual(persisted.call_count, 1)
+
+
+# The catalogs are fetched and saved by worker threads, which only see committed data.
+class HotelsUpsellProductsTest(django.test.TransactionTestCase):
+    def setUp(self) -> None:
+        self.apaleo = HotelFactory(pms=Hotel.PMS.APALEO)
+        self.guestline = HotelFactory(pms=Hotel.PMS.GUESTLINE)
+        upsell_catalog_cache.clear()
+
+    def get(self, ids):
+        return self.client.get(reverse("retrieve_hotels_upsell_products"), {"ids": ids})
+
+    def test_per_hotel_results(self):
+        get_catalog = upsell_catalog_cache.get_catalog
+
+        def failing_guestline(hotel):
+            if hotel.pms == Hotel.PMS.GUESTLINE:
+                raise RuntimeError("Down")
+            return get_catalog(hotel)
+
+        with mock.patch.object(upsell_catalog_cache, "get_catalog", side_effect=failing_guestline):
+            response = self.get(f"{self.apaleo.id},{self.guestline.id},0,{self.apaleo.id}")
+        hotels = response.json()["hotels"]
+        self.assertEqual(list(hotels), [str(self.apaleo.id), str(self.guestline.id), "0"])
+        self.assertEqual(len(hotels[str(self.apaleo.id)]["upsell_products"]), self.apaleo.upsell_products.count())
+        self.assertTrue(hotels[str(self.apaleo.id)]["upsell_products"])
+        self.assertEqual(hotels[str(self.guestline.id)], {"error": "Error retrieving upsell products"})
+        self.assertEqual(hotels["0"], {"error": "Hotel not found"})
+
+    def test_fetches_concurrently(self):
+        started = threading.Barrier(2, timeout=5)
+
+        def products(pms):
+            started.wait()
+            return []
+
+        with mock.patch("hotel.pms.base.PMSProvider.get_upsell_products", autospec=True, side_effect=products):
+            hotels = self.get(f"{self.apaleo.id},{self.guestline.id}").json()["hotels"]
+        self.assertEqual(list(hotels.values()), [{"upsell_products": []}] * 2)
+
+    @override_settings(UPSELL_CATALOG_MAX_HOTELS=2)
+    def test_invalid_ids(self):
+        self.assertEqual(self.get("1,a").status_code, 400)
+        self.assertEqual(self.get("").status_code, 400)
+        self.assertEqual(self.get("1,2,3").status_code, 400)
+
+
+@override_settings(**NO_RATE_LIMITS)
+class BenchWebhookTest(django.test.TestCase):
+    def test_bench_webhook(self):
+        out = StringIO()
+        call_command(
+            "bench_webhook", hotels=2, events=3, latency_ms=0, jitter_ms=0, error_rate=0, seed=1, stdout=out
+        )
+        self.assertIn("2 webhooks with 6 events for 2 hotels", out.getvalue())
+        self.assertIn("(0 incomplete)", out.getvalue())
+        self.assertIn("p99", out.getvalue())
+        self.assertFalse(Hotel.objects.exists())
+        self.assertFalse(Stay.objects.exists())
+
+
+@override_settings(**NO_RATE_LIMITS)
+class BenchUpsellCatalogsTest(django.test.TestCase):
+    def test_bench_upsell_catalogs(self):
+        out = StringIO()
+        call_command(
+            "bench_upsell_catalogs", hotels=2, products=5, latency=parse_latency("fixed:0"), seed=1, stdout=out
+        )
+        self.assertIn("Round 1: 2 catalogs", out.getvalue())
+        self.assertIn("Products: 10 created, 0 updated, 0 unchanged, PMS API calls: 2", out.getvalue())
+        self.assertIn("Products: 0 created, 0 updated, 10 unchanged", out.getvalue())
+        self.assertFalse(Hotel.objects.exists())
+        self.assertFalse(UpsellProduct.objects.exists())
+
+
+class AsyncExternalAPITest(django.test.SimpleTestCase):
+    def test_calls_run_off_the_event_loop(self):
+        threads = []
+
+        def get_guest_details(guest_id):
+            threads.append(threading.get_ident())
+            return guest_id
+
+        async def call():
+            self.assertEqual(await aget_guest_details("1"), "1")
+            return threading.get_ident()
+
+        with mock.patch("hotel.external_api.get_guest_details", side_effect=get_guest_details):
+            loop_thread = async_to_sync(call)()
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], loop_thread)
+
+
+class ExternalAPIStandInTest(django.test.SimpleTestCase):
+    def test_parse_latency(self):
+        self.assertEqual(parse_latency("fixed:20").sample(random.Random()), 0.02)
+        self.assertTrue(0.01 <= parse_latency("uniform:10,30").sample(random.Random()) <= 0.03)
+        lognormal = [parse_latency("lognormal:20,0.5").sample(random.Random(i)) for i in range(1000)]
+        self.assertAlmostEqual(statistics.median(lognormal), 0.02, delta=0.002)
+        for spec in ("fixed", "fixed:a", "uniform:1", "normal:1", "histogram:/does/not/exist"):
+            with self.subTest(spec=spec), self.assertRaises(ValueError):
+                parse_latency(spec)
+
+    def test_seeded_errors(self):
+        def outcomes(api):
+            results = []
+            for i in range(50):
+                try:
+                    api.get_guest_details(str(uuid.UUID(int=i)))
+                    results.append(True)
+                except APIError:
+                    results.append(False)
+            return results
+
+        first = outcomes(StubExternalAPI(error_rate=0.3, seed=1))
+        self.assertEqual(first, outcomes(StubExternalAPI(error_rate=0.3, seed=1)))
+        self.assertNotEqual(first, outcomes(StubExternalAPI(error_rate=0.3, seed=2)))
+        self.assertIn(False, first)
+
+    def test_seeded_async_errors(self):
+        async def outcomes(api):
+            results = await asyncio.gather(
+                *(api.aget_guest_details(str(uuid.UUID(int=i))) for i in range(50)), return_exceptions=True
+            )
+            return [not isinstance(result, APIError) for result in results]
+
+        sync_outcomes = []
+        api = StubExternalAPI(error_rate=0.3, seed=1)
+        for i in range(50):
+            try:
+                api.get_guest_details(str(uuid.UUID(int=i)))
+                sync_outcomes.append(True)
+            except APIError:
+                sync_outcomes.append(False)
+        self.assertEqual(async_to_sync(outcomes)(StubExternalAPI(error_rate=0.3, seed=1)), sync_outcomes)
+
+    def test_patch_replaces_async_calls_and_jitter(self):
+        api = StubExternalAPI(seed=1, catalog_size=3)
+        apaleo, guestline = Apaleo(Hotel(pms=Hotel.PMS.APALEO)), GuestLine(Hotel(pms=Hotel.PMS.GUESTLINE))
+        with api.patch("hotel.pms.apaleo.apaleo", "hotel.pms.guestline.guestline"):
+            self.assertEqual(len(async_to_sync(apaleo.aretrieve_products_api)()), 3)
+            self.assertEqual(len(async_to_sync(guestline.aretrieve_products_api)()), 3)
+            self.assertEqual(len(guestline.retrieve_products_api()), 3)
+            delays = [resilience.backoff_delay(attempt) for attempt in range(5)]
+        self.assertEqual(api.calls, 3)
+        with api.patch():
+            self.assertEqual([resilience.backoff_delay(attempt) for attempt in range(5)], delays)
+
+    def test_record_and_replay(self):
+        api = mock.Mock()
+        api.get_reservation_details.side_effect = [APIError("down"), fake_reservation_details("1")]
+        api.get_guest_details.side_effect = APIError("down")
+        archive = FixtureArchive()
+        recording = RecordingExternalAPI(archive, api)
+        with self.assertRaises(APIError):
+            recording.get_reservation_details("1")
+        self.assertEqual(recording.get_reservation_details("1"), fake_reservation_details("1"))
+        with self.assertRaises(APIError):
+            recording.get_guest_details("2")
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = f"{directory}/fixtures.json"
+            archive.save(path)
+            replay = StubExternalAPI(archive=FixtureArchive.load(path), latency=parse_latency(f"histogram:{path}"))
+        self.assertEqual(replay.get_reservation_details("1"), fake_reservation_details("1"))
+        with self.assertRaisesMessage(APIError, "down"):
+            replay.get_guest_details("2")
+        with self.assertRaises(KeyError):
+            replay.get_guest_details("3")
+        self.assertEqual(len(replay.latency.samples), 3)
+        self.assertEqual([reservation["ReservationId"] for reservation in archive.reservations()], ["1"])
@@ -1,42 +1,70 @@
+import hashlib
+from django.conf import settings
+from django.db.models import Count, Max
 from django.shortcuts import render
+from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 import logging
 
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotAllowed
 from django.http import JsonResponse
 from django.views import View
-from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
 
+from hotel.http import conditional_gzip_page
+from hotel.inbox import aenqueue_webhook
 from hotel.models import Hotel  # Adjust as needed
-from hotel.pms.base import get_pms
+from hotel.pms.base import UnknownPMSError, get_pms
+from hotel.pms.payload import SUPPORTED_CONTENT_ENCODINGS
 
 logger = logging.getLogger(__name__)
 
 
-@csrf_exempt
-@require_POST
-def webhook(request, pms_name):
+async def webhook(request, pms_name):
     """
     Assume a webhook call from the PMS with a status update for a reservation.
     The webhook call is a POST request to the url: /webhook/<pms_name>/
     The body of the request should always be a valid JSON string and contain the needed information to perform an update.
+    The body is stored in the webhook inbox and processed by the `process_webhooks` management command,
+    so the PMS gets its answer without waiting for the update to be performed.
     """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    try:
+        get_pms(pms_name)
+    except UnknownPMSError:
+        return HttpResponse(status=404)
+
+    # Reject bodies that are too large before reading them.
+    try:
+        content_length = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        content_length = -1
+    if content_length < 0:
+        return HttpResponse("Invalid Content-Length.", status=400)
+    if content_length > settings.WEBHOOK_MAX_BODY_BYTES:
+        return HttpResponse(status=413)
+    content_encoding = request.headers.get("Content-Encoding", "").strip().lower()
+    if content_encoding not in SUPPORTED_CONTENT_ENCODINGS:
+        return HttpResponse(status=415)
+
+    await aenqueue_webhook(pms_name, request.body, content_encoding)
+    return HttpResponse("Thanks for the update.", status=202)
 
-    pms_cls = get_pms(pms_name)
 
-    cleaned_webhook_payload = pms_cls.clean_webhook_payload(request.body)
-    if not cleaned_webhook_payload:
-        return HttpResponse(status=400)
-    hotel = Hotel.objects.get(id=cleaned_webhook_payload["hotel_id"])
-    pms = hotel.get_pms()
-    success = pms.handle_webhook(cleaned_webhook_payload)
-    if not success:
-        return HttpResponse(status=400)
-    else:
-        return HttpResponse("Thanks for the update.")
+# csrf_exempt and require_POST wrap views in sync functions in Django 4.2, which breaks async views.
+webhook.csrf_exempt = True
+
+
+def hotels_etag(request) -> str:
+    """
+    An ETag of the version of all hotels: their number and the last time any of them changed.
+    """
+    version = Hotel.objects.aggregate(count=Count("id"), updated_at=Max("updated_at"))
+    return hashlib.blake2b(f"{version['count']}:{version['updated_at']}".encode(), digest_size=16).hexdigest()
 
 
+@method_decorator(conditional_gzip_page(hotels_etag), name="get")
 class HotelsListView(View):
     def get(self, request):
         try:
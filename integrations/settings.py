@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -126,3 +127,115 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'hotel/static')
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+# Webhook inbox
+# Webhooks are stored by the webhook view and processed by `python manage.py process_webhooks`.
+
+# Number of inbox items a worker claims at once.
+WEBHOOK_INBOX_BATCH_SIZE = 50
+# Number of attempts before an inbox item is marked as failed.
+WEBHOOK_INBOX_MAX_ATTEMPTS = 5
+# Seconds to wait before retrying a failed item, multiplied by the number of attempts so far.
+WEBHOOK_INBOX_RETRY_DELAY = 30
+# Seconds an item waits in the inbox before it is processed. Webhooks for the same hotel received
+# within this window are coalesced, so a reservation that is updated repeatedly is fetched once.
+WEBHOOK_COALESCE_WINDOW = 5
+# Maximum size of a webhook body in bytes, after decompression.
+WEBHOOK_MAX_BODY_BYTES = 2 * 1024 * 1024
+# Maximum number of events in a single webhook.
+WEBHOOK_MAX_EVENTS = 10000
+# Seconds after which an item claimed by a worker that never finished it can be claimed again.
+WEBHOOK_INBOX_CLAIM_TIMEOUT = 300
+# Seconds a worker may spend on the webhooks of one hotel, reservations that are not fetched by then are deferred.
+WEBHOOK_DEADLINE_SECONDS = 30
+# Seconds before a deferred reservation is fetched again, multiplied by the number of times it was deferred.
+WEBHOOK_DEFERRED_RETRY_DELAY = 60
+# Maximum number of deferred reservations that are picked up with every inbox batch.
+WEBHOOK_DEFERRED_BATCH_SIZE = 500
+
+# PMS API resilience
+
+# Number of attempts for a PMS API call that raises an APIError.
+PMS_RETRY_ATTEMPTS = 3
+# Seconds of backoff before the first retry, doubled for every next retry and randomized (full jitter).
+PMS_RETRY_BASE_DELAY = 0.2
+# Upper bound for the backoff in seconds.
+PMS_RETRY_MAX_DELAY = 5
+# Consecutive failed calls after which the circuit breaker of a PMS or hotel opens.
+PMS_CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+# Seconds an open circuit breaker waits before it lets a probe call through.
+PMS_CIRCUIT_BREAKER_RESET_TIMEOUT = 30
+
+# Dead letters
+# Reservations that failed on a PMS API error are stored as dead letters and replayed by
+# `python manage.py replay_dead_letters`.
+
+# Seconds before a dead letter is replayed, doubled after every failed attempt.
+DEAD_LETTER_RETRY_BASE_DELAY = 60
+# Upper bound for the replay backoff in seconds.
+DEAD_LETTER_RETRY_MAX_DELAY = 6 * 60 * 60
+# Number of failed attempts after which a dead letter is no longer replayed, it stays for inspection in the admin.
+DEAD_LETTER_MAX_ATTEMPTS = 10
+# Number of reservations of one hotel that are replayed together.
+DEAD_LETTER_REPLAY_BATCH_SIZE = 100
+# Number of batches that are replayed at the same time.
+DEAD_LETTER_REPLAY_CONCURRENCY = 4
+# Seconds that claimed dead letters are not claimed by another replay, in case the replay dies.
+DEAD_LETTER_CLAIM_TIMEOUT = 300
+
+# PMS API rate limits
+# Token buckets shared by all worker processes on a host, through files in PMS_RATE_LIMIT_DIR.
+# `rate` is the number of calls per second, `burst` the number of calls that can be made at once.
+# A PMS that is not listed is not rate limited.
+
+# Rate limit of all calls to a PMS.
+PMS_RATE_LIMITS = {
+    "Apaleo": {"rate": 50, "burst": 100},
+}
+# Rate limit of the calls for each hotel on a PMS.
+PMS_HOTEL_RATE_LIMITS = {
+    "Apaleo": {"rate": 10, "burst": 20},
+}
+# Seconds a call waits for a token before RateLimitExceeded is raised.
+PMS_RATE_LIMIT_TIMEOUT = 10
+# Directory of the token bucket files.
+PMS_RATE_LIMIT_DIR = os.path.join(tempfile.gettempdir(), "integrations-rate-limits")
+
+# Reservation sync
+
+# Number of fetched reservations written per upsert by sync_reservations.
+PMS_SYNC_BATCH_SIZE = 500
+# Number of check-in dates, starting today, that sync_reservations covers when --to is not given.
+PMS_SYNC_DAYS = 30
+
+# Guest cache
+# Guest details fetched from a PMS are cached in the database, shared by all worker processes.
+
+# Seconds that cached guest details are used.
+PMS_GUEST_CACHE_TTL = 60 * 60
+# Maximum number of cached guest details, the entries that expire first are evicted beyond that.
+PMS_GUEST_CACHE_MAX_ENTRIES = 100000
+# Seconds between two evictions of expired and surplus entries by a process, expired entries are never used.
+PMS_GUEST_CACHE_CULL_INTERVAL = 60
+
+# Hotel cache
+# Hotels are cached in every process to route webhooks without database queries.
+
+# Maximum number of cached entries per process.
+HOTEL_CACHE_SIZE = 1024
+# Seconds after which a cached hotel is loaded again, to pick up changes made by other processes.
+HOTEL_CACHE_TTL = 300
+
+# Upsell catalog cache
+# The upsell products endpoint serves the catalog of a hotel from a cache in every process.
+
+# Maximum number of cached catalogs per process.
+UPSELL_CATALOG_CACHE_SIZE = 1024
+# Seconds a cached catalog is served without fetching it again.
+UPSELL_CATALOG_CACHE_TTL = 300
+# Seconds after the TTL during which a stale catalog is still served, while it is fetched again in the background.
+UPSELL_CATALOG_CACHE_MAX_STALE = 60 * 60
+# Maximum number of hotels whose catalogs are requested at once from /api/hotels/upsell-products/.
+UPSELL_CATALOG_MAX_HOTELS = 100
+# Number of catalogs that /api/hotels/upsell-products/ fetches at the same time.
+UPSELL_CATALOG_CONCURRENCY = 8